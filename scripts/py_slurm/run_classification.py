@@ -6,8 +6,9 @@ import sys
 import numpy as np
 from pathlib import Path
 
-from src.mvpa.classification import classify_temporal
-from src.utils.file_access import read_json, read_data
+from src.mvpa.classification import classify_generalization, classify_temporal
+from src.mvpa.folds import get_fold_plan
+from src.utils.file_access import Dataset, read_json
 from src.utils.logger import get_logger
 
 
@@ -30,14 +31,19 @@ def run_classification(label_name, params, n_cores):
 
     # Load data
     x_path = Path(params["dataset-dir"]) / label_name #/ "x.dat"  #todo handle both
-    y_path = Path(params["dataset-dir"]) / label_name / params["conditions"] / "y.npy"
-    included_path = Path(params["dataset-dir"]) / label_name / params["conditions"] / "included.npy"
-    x = read_data(x_path) # np.load(str(x_path))
+    condition_dir = Path(params["dataset-dir"]) / label_name / params["conditions"]
+    y_path = condition_dir / "y.npy"
+    included_path = condition_dir / "included.npy"
     y = np.load(str(y_path))
     included = np.load(str(included_path))
-    x = x[included]
 
-    results = classify_temporal(x, y, params, n_jobs)
+    # Same folds for every time point, area and run of the condition, in a directory shared by the areas
+    folds_dir = Path(params.get("folds-dir", Path(params["dataset-dir"]) / "folds")) / params["conditions"]
+    folds = get_fold_plan(folds_dir, y[0], cv=params["cv"], seed=params.get("seed", 0))
+
+    # Lazy view of the included epochs, each time window is read when it is classified
+    x = Dataset(x_path).select(trials=included)
+    results = classify_temporal(x, y, params, n_jobs, folds=folds)
 
     dst_dir = Path(params["dst-dir"])
     if not dst_dir.exists():
@@ -45,6 +51,16 @@ def run_classification(label_name, params, n_cores):
     with open(Path(params["dst-dir"]) / f"{label_name}.pickle", "wb") as handle:
         pickle.dump(results, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+    # Temporal generalization (train x test times), in its own directory: `read_scores` reads every file of `dst-dir`
+    if params.get("generalization", False):
+        results = classify_generalization(x, y, params, n_jobs, folds=folds)
+
+        dst_dir = Path(params["generalization-dir"])
+        if not dst_dir.exists():
+            os.makedirs(dst_dir)
+        with open(dst_dir / f"{label_name}.pickle", "wb") as handle:
+            pickle.dump(results, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
 
 if __name__ == "__main__":
 
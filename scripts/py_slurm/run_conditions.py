@@ -4,7 +4,6 @@ import os
 import numpy as np
 from src.utils.file_access import read_json
 from pathlib import Path
-from mne import read_labels_from_annot
 #from events.conditions import convert_y
 from src.processing import convert_y
 from src.utils.logger import get_logger
@@ -47,8 +46,6 @@ if __name__ == "__main__":
 
     with open(params["idx-to-name"], "rb") as handle:
         idx_to_name = pickle.load(handle)
-    subjects_dir = params["subjects-dir"]
-    labels = read_labels_from_annot("fsaverage", params["parcellation"], params["hemi"], subjects_dir=subjects_dir)
 
     name = idx_to_name[area_id]
 
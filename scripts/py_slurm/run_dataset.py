@@ -3,16 +3,16 @@ import pickle
 import sys
 from src.utils.file_access import read_json
 from pathlib import Path
-from mne import read_labels_from_annot
-from src.processing import generate_dataset
+from src.processing.dataset import generate_dataset, generate_all_datasets
+from src.mvpa.classification import get_time_range
 from src.utils.logger import get_logger
 
 
 
 if __name__ == "__main__":
 
-    # Get input from the bash script
-    area_id = int(sys.argv[1])
+    # Get input from the bash script, the area ID or `all` to build every area in a single job
+    area_id = sys.argv[1]
     n_cores = int(sys.argv[2])
     param_dir = Path(sys.argv[3])
     logger = get_logger("/data/home/hiroyoshi/high-res/logs", f"dateset-{area_id}")
@@ -28,14 +28,31 @@ if __name__ == "__main__":
     if not dataset_dir.exists(): # todo remove this
         os.makedirs(dataset_dir)
 
+    # Crop the datasets to the time range used by the classification, `[tmin, tmax]` in seconds or `classification`
+    # to derive it from the classification parameters. The whole epochs are kept if not set
+    time_range = params.get("time-range")
+    if time_range == "classification":
+        time_range = get_time_range(read_json(param_dir, "classification-params.json"))
+
     with open(params["directories"]["idx-to-name"], "rb") as handle:
         idx_to_name = pickle.load(handle)
-    subjects_dir = params["directories"]["subjects-dir"]
-    labels = read_labels_from_annot("fsaverage", params["parcellation"], params["hemi"], subjects_dir=subjects_dir)
-    name = idx_to_name[area_id]
+
+    if area_id == "all":
+        area_names = [idx_to_name[idx] for idx in range(len(idx_to_name))]
+        generate_all_datasets(epoch_dir, dataset_dir, area_names=area_names, max_subjects=params["max"],
+                              summary=params.get("summary"), n_areas=params.get("areas-in-flight", 8),
+                              n_jobs=n_cores, layout=params.get("layout", "epochs"),
+                              chunks=params.get("chunks"), time_range=time_range,
+                              dtype=params.get("dtype", "float64"), append=params.get("append", False))
+        sys.exit(0)
+
+    name = idx_to_name[int(area_id)]
 
     dst_dir = dataset_dir / name
     if not dst_dir.exists():
         os.makedirs(dst_dir)
 
-    generate_dataset(epoch_dir, dst_dir, name, memmap=params["memmap"], max_subjects=params["max"])
+    generate_dataset(epoch_dir, dst_dir, name, memmap=params["memmap"], max_subjects=params["max"],
+                     summary=params.get("summary"), n_jobs=n_cores, layout=params.get("layout", "epochs"),
+                     chunks=params.get("chunks"), time_range=time_range,
+                     dtype=params.get("dtype", "float64"), append=params.get("append", False))
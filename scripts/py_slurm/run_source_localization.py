@@ -29,7 +29,11 @@ if __name__ == "__main__":
     root = Path(params["directories"]["root"])
     epochs_dir = root / "epochs-dir" / subj_name
 
-    epochs = read_epochs(epochs_dir / f"{subj_name}-epo.fif", verbose=False)
+    epochs_path = epochs_dir / f"{subj_name}-epo.fif"
+    epochs = read_epochs(epochs_path, verbose=False)
+
+    # With `cache dir` set, inverse operators are cached by the content of the epochs file
+    params["stc params"]["epochs-path"] = str(epochs_path)
 
     source_localize(dst_dir=epochs_dir, subject=subj_name, epochs=epochs, params=params["stc params"], n_jobs=n_cores)
 
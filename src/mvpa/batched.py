@@ -0,0 +1,311 @@
+import logging
+
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from src.mvpa.folds import FoldPlan
+from src.utils.logger import get_logger
+
+logger = get_logger(file_name="batched")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# BATCHED CLASSIFIERS                                                                                                  #
+########################################################################################################################
+# Linear classifiers with a closed-form fit, trained for many time points at once. The statistics of all the trials    #
+# (Gram matrix, class sums) are computed once per time point, the ones of the training set of a fold are obtained by   #
+# removing its test trials. The solves of all the time points are stacked into a single batched `np.linalg.solve`.     #
+# Features are standardized on the training set of each fold, as with the `StandardScaler` of the sklearn pipeline.    #
+# With more features than training trials (e.g. a whole window of an area), the n_features x n_features statistics     #
+# are replaced by the n_train x n_train kernel of the standardized training trials (dual form, same coefficients).     #
+#   LDA: linear discriminant analysis, pooled within-class covariance with Ledoit-Wolf shrinkage                       #
+#   Ridge: ridge regression on the classes encoded as -1 / 1 (as `RidgeClassifier`), penalty `alpha`                   #
+########################################################################################################################
+
+BATCHED_CLASSIFIERS = ("LDA", "Ridge")
+
+
+def classify_batched(x: np.array, y: np.array, folds: FoldPlan, clf: str, alpha=1.,
+                     seeds=None) -> Tuple[np.array, np.array]:
+    """
+    Cross-validate a batched classifier at every time point, and a stratified dummy classifier
+    :param x: windows of the time points, n_times x n_trials x n_features
+    :param y: binary labels, shape (n_trials,)
+    :param folds: cross-validation splits, see `FoldPlan`
+    :param clf: `LDA` or `Ridge`, see `BATCHED_CLASSIFIERS`
+    :param alpha: penalty of the ridge regression
+    :param seeds: seed of the dummy classifier at every time point, see `FoldPlan.get_seed`. The time points of `x` are
+        the first ones of the period if None
+    :return:
+        ROC AUC of the predicted labels (same as `roc_auc_score` in `classify`), n_folds x n_times, and the scores of
+        the dummy classifier
+    """
+
+    classes, y_idx = np.unique(y, return_inverse=True)
+    if len(classes) != 2:
+        raise ValueError(f"The batched classifiers are scored for two classes, got {len(classes)}")
+
+    x = np.asarray(x, dtype="float64")
+    scores = np.zeros((len(folds), x.shape[0]))
+
+    for i, ((_, test_idx), (coef, intercept)) in enumerate(zip(folds.split(),
+                                                               fit_batched(x, y, folds, clf, alpha=alpha))):
+        decision = np.matmul(x[:, test_idx], coef) + intercept[:, None]
+        scores[i] = get_auc(y_idx[test_idx], decision.argmax(axis=2))
+
+    if seeds is None:
+        seeds = [folds.get_seed(t_idx) for t_idx in range(x.shape[0])]
+    dummy_scores = np.stack([get_dummy_scores(y_idx, folds, seed) for seed in seeds], axis=1)
+    return scores, dummy_scores
+
+
+def get_dummy_scores(y_idx: np.array, folds: FoldPlan, seed) -> np.array:
+    """
+    Scores of a stratified dummy classifier at a time point: random labels drawn with the class frequencies of the
+    training set. The predictions do not depend on the data, the seed of the time point (see `FoldPlan.get_seed`)
+    gives the same draws whatever the batching of the times
+    :param y_idx: class indices (0 or 1), shape (n_trials,)
+    :param folds: cross-validation splits, see `FoldPlan`
+    :param seed: seed of the draws, random if None
+    :return:
+        ROC AUC of the dummy classifier per fold, shape (n_folds,)
+    """
+
+    rng = np.random.default_rng(seed)
+    dummy_scores = np.zeros((len(folds),))
+    for i, (train_idx, test_idx) in enumerate(folds.split()):
+        priors = np.bincount(y_idx[train_idx], minlength=2) / len(train_idx)
+        y_dummy = rng.choice(2, size=len(test_idx), p=priors)
+        dummy_scores[i] = get_auc(y_idx[test_idx], y_dummy[None])[0]
+
+    return dummy_scores
+
+
+def fit_batched(x: np.array, y: np.array, folds: FoldPlan, clf: str, alpha=1.) -> Iterator[Tuple[np.array, np.array]]:
+    """
+    Fit a batched classifier on the training set of every fold, for all the time points. The standardization is
+    folded into the returned coefficients, which apply to the features as they are in `x`
+    :param x: windows of the time points, n_times x n_trials x n_features
+    :param y: labels, shape (n_trials,)
+    :param folds: cross-validation splits, see `FoldPlan`
+    :param clf: `LDA` or `Ridge`, see `BATCHED_CLASSIFIERS`
+    :param alpha: penalty of the ridge regression
+    :return:
+        coefficients (n_times x n_features x n_classes) and intercepts (n_times x n_classes) of the decision function
+        of each fold, in the order of `folds.split()`. The predicted class is the argmax (classes sorted as in
+        `np.unique(y)`)
+    """
+
+    if clf not in BATCHED_CLASSIFIERS:
+        raise ValueError(f"Unknown batched classifier {clf}, use one of {BATCHED_CLASSIFIERS}")
+
+    classes, y_idx = np.unique(y, return_inverse=True)
+    x = np.asarray(x, dtype="float64")
+    one_hot = np.eye(len(classes))[y_idx]
+
+    # Dual form if a training set has fewer trials than features: the Gram matrices would be n_features x n_features
+    dual = x.shape[2] > min(len(train_idx) for train_idx, _ in folds.split())
+    if dual:
+        logger.debug(f"Dual form: {x.shape[2]} features for {len(y)} trials")
+    else:
+        # Statistics of all the trials, n_times x n_features x (n_features or n_classes)
+        x_t = x.transpose(0, 2, 1)
+        gram = np.matmul(x_t, x)
+        class_sums = np.matmul(x_t, one_hot)
+
+    for train_idx, test_idx in folds.split():
+        n_class = one_hot[train_idx].sum(axis=0)
+        n_train = len(train_idx)
+
+        if dual:
+            x_train = x[:, train_idx]
+            mean = x_train.mean(axis=1)
+            std = x_train.std(axis=1)
+            std[std == 0] = 1.
+
+            z = (x_train - mean[:, None]) / std[:, None]
+            if clf == "LDA":
+                coef, intercept = _fit_lda_dual(z, y_idx[train_idx], n_class)
+            else:
+                coef, intercept = _fit_ridge_dual(z, one_hot[train_idx], n_class, alpha)
+        else:
+            # Training statistics: all the trials minus the test trials
+            x_test = x[:, test_idx]
+            x_test_t = x_test.transpose(0, 2, 1)
+            train_gram = gram - np.matmul(x_test_t, x_test)
+            train_sums = class_sums - np.matmul(x_test_t, one_hot[test_idx])
+
+            mean = train_sums.sum(axis=2) / n_train
+            std = np.sqrt(np.maximum(np.diagonal(train_gram, axis1=1, axis2=2) / n_train - mean ** 2, 0))
+            std[std == 0] = 1.
+
+            if clf == "LDA":
+                coef, intercept = _fit_lda(x[:, train_idx], y_idx[train_idx], train_gram, train_sums, n_class, mean,
+                                           std)
+            else:
+                coef, intercept = _fit_ridge(train_gram, train_sums, n_class, mean, std, alpha)
+
+        # Decision function on the raw features: ((x - mean) / std) . coef + intercept
+        coef = coef / std[:, :, None]
+        yield coef, intercept - np.sum(mean[:, :, None] * coef, axis=1)
+
+
+def _fit_lda(x_train: np.array, y_train: np.array, gram: np.array, class_sums: np.array, n_class: np.array,
+             mean: np.array, std: np.array) -> Tuple[np.array, np.array]:
+    """
+    Fit a shrinkage LDA on standardized features, for all the time points
+    :param x_train: training windows, n_times x n_train x n_features
+    :param y_train: class indices of the training trials
+    :param gram: Gram matrix of the training trials, n_times x n_features x n_features
+    :param class_sums: sum of the training trials of each class, n_times x n_features x n_classes
+    :param n_class: number of training trials per class
+    :param mean: mean of the training trials, n_times x n_features
+    :param std: standard deviation of the training trials, n_times x n_features
+    :return:
+        coefficients (n_times x n_features x n_classes) and intercepts (n_times x n_classes) of the decision function
+    """
+
+    n_train, n_features = len(y_train), gram.shape[1]
+    class_means = class_sums / n_class
+    scale = std[:, :, None] * std[:, None, :]
+
+    # Pooled within-class covariance of the standardized features
+    scatter = gram - np.matmul(class_sums, class_means.transpose(0, 2, 1))
+    emp_cov = scatter / scale / n_train
+
+    # Ledoit-Wolf shrinkage intensity (as `sklearn.covariance.ledoit_wolf_shrinkage`), on the standardized trials
+    # centered on their class means
+    centered = (x_train - class_means.transpose(0, 2, 1)[:, y_train]) / std[:, None]
+    shrinkage, mu = _get_shrinkage(np.sum(centered ** 2, axis=2), np.sum(emp_cov ** 2, axis=(1, 2)), n_features)
+
+    cov = (1 - shrinkage)[:, None, None] * emp_cov + (shrinkage * mu)[:, None, None] * np.eye(n_features)
+
+    # Decision function of class c: z . inv(cov) mu_c - mu_c . inv(cov) mu_c / 2 + log(prior_c)
+    std_means = (class_means - mean[:, :, None]) / std[:, :, None]
+    coef = np.linalg.solve(cov, std_means)
+    intercept = -0.5 * np.sum(std_means * coef, axis=1) + np.log(n_class / n_train)
+    return coef, intercept
+
+
+def _fit_lda_dual(z: np.array, y_train: np.array, n_class: np.array) -> Tuple[np.array, np.array]:
+    """
+    Fit the shrinkage LDA of `_fit_lda` through the n_train x n_train kernel of the training trials, for more features
+    than trials. The shrunk covariance a.I + b.W'W (W: trials centered on their class means) is inverted with the
+    Woodbury identity, inv(cov) m = (m - b.W' inv(a.I + b.WW') W m) / a
+    :param z: standardized training windows, n_times x n_train x n_features
+    :param y_train: class indices of the training trials
+    :param n_class: number of training trials per class
+    :return:
+        coefficients (n_times x n_features x n_classes) and intercepts (n_times x n_classes) of the decision function
+    """
+
+    n_train, n_features = len(y_train), z.shape[2]
+
+    # Means of the standardized features per class, n_times x n_features x n_classes
+    one_hot = np.eye(len(n_class))[y_train]
+    std_means = np.matmul(z.transpose(0, 2, 1), one_hot) / n_class
+
+    centered = z - std_means.transpose(0, 2, 1)[:, y_train]
+    kernel = np.matmul(centered, centered.transpose(0, 2, 1))
+    shrinkage, mu = _get_shrinkage(np.sum(centered ** 2, axis=2), np.sum(kernel ** 2, axis=(1, 2)) / n_train ** 2,
+                                   n_features)
+
+    a, b = shrinkage * mu, (1 - shrinkage) / n_train
+    if np.any(a <= 0):
+        raise ValueError(f"The shrunk covariance of {n_features} features is singular with {n_train} training trials, "
+                         f"use fewer features or the `Ridge` classifier")
+
+    inner = np.linalg.solve(a[:, None, None] * np.eye(n_train) + b[:, None, None] * kernel,
+                            np.matmul(centered, std_means))
+    coef = (std_means - b[:, None, None] * np.matmul(centered.transpose(0, 2, 1), inner)) / a[:, None, None]
+    intercept = -0.5 * np.sum(std_means * coef, axis=1) + np.log(n_class / n_train)
+    return coef, intercept
+
+
+def _get_shrinkage(sq_norms: np.array, sum_sq_cov: np.array, n_features: int) -> Tuple[np.array, np.array]:
+    """
+    Ledoit-Wolf shrinkage intensity, as `sklearn.covariance.ledoit_wolf_shrinkage`, for all the time points
+    :param sq_norms: squared norm of each centered training trial, n_times x n_train
+    :param sum_sq_cov: sum of the squared entries of the empirical covariance, shape (n_times,)
+    :param n_features: number of features
+    :return:
+        shrinkage intensity and mean variance (trace / n_features), shape (n_times,)
+    """
+
+    n_train = sq_norms.shape[1]
+    trace = np.sum(sq_norms, axis=1) / n_train
+    mu = trace / n_features
+    beta = (np.sum(sq_norms ** 2, axis=1) / n_train - sum_sq_cov) / (n_features * n_train)
+    delta = (sum_sq_cov - trace ** 2 / n_features) / n_features
+    shrinkage = np.where(delta > 0, np.minimum(beta, delta) / np.where(delta > 0, delta, 1), 0.)
+    return shrinkage, mu
+
+
+def _fit_ridge(gram: np.array, class_sums: np.array, n_class: np.array, mean: np.array, std: np.array,
+               alpha: float) -> Tuple[np.array, np.array]:
+    """
+    Fit a ridge classifier on standardized features, for all the time points. Each class is a target column, 1 for
+    the trials of the class and -1 for the others
+    :param gram: Gram matrix of the training trials, n_times x n_features x n_features
+    :param class_sums: sum of the training trials of each class, n_times x n_features x n_classes
+    :param n_class: number of training trials per class
+    :param mean: mean of the training trials, n_times x n_features
+    :param std: standard deviation of the training trials, n_times x n_features
+    :param alpha: penalty
+    :return:
+        coefficients (n_times x n_features x n_classes) and intercepts (n_times x n_classes) of the decision function
+    """
+
+    n_train, n_features = n_class.sum(), gram.shape[1]
+    targets_mean = 2 * n_class / n_train - 1
+
+    # Centered normal equations of the standardized features
+    cov = (gram - n_train * mean[:, :, None] * mean[:, None, :]) / (std[:, :, None] * std[:, None, :])
+    cross = 2 * class_sums - n_train * mean[:, :, None] - n_train * mean[:, :, None] * targets_mean
+    cross = cross / std[:, :, None]
+
+    coef = np.linalg.solve(cov + alpha * np.eye(n_features), cross)
+    intercept = np.broadcast_to(targets_mean, (gram.shape[0], len(n_class)))
+    return coef, intercept
+
+
+def _fit_ridge_dual(z: np.array, one_hot: np.array, n_class: np.array, alpha: float) -> Tuple[np.array, np.array]:
+    """
+    Fit the ridge classifier of `_fit_ridge` through the n_train x n_train kernel of the training trials, for more
+    features than trials: coef = Z' inv(ZZ' + alpha.I) T, with Z the centered standardized trials and T the centered
+    targets
+    :param z: standardized training windows, n_times x n_train x n_features
+    :param one_hot: classes of the training trials, n_train x n_classes
+    :param n_class: number of training trials per class
+    :param alpha: penalty, strictly positive
+    :return:
+        coefficients (n_times x n_features x n_classes) and intercepts (n_times x n_classes) of the decision function
+    """
+
+    if alpha <= 0:
+        raise ValueError(f"The ridge penalty must be positive with more features ({z.shape[2]}) than training trials "
+                         f"({z.shape[1]}), got {alpha}")
+
+    n_train = len(one_hot)
+    targets_mean = 2 * n_class / n_train - 1
+    targets = 2 * one_hot - 1 - targets_mean
+
+    kernel = np.matmul(z, z.transpose(0, 2, 1))
+    dual_coef = np.linalg.solve(kernel + alpha * np.eye(n_train), targets)
+    coef = np.matmul(z.transpose(0, 2, 1), dual_coef)
+    intercept = np.broadcast_to(targets_mean, (z.shape[0], len(n_class)))
+    return coef, intercept
+
+
+def get_auc(y_true: np.array, y_pred: np.array) -> np.array:
+    """
+    ROC AUC of binary predicted labels, i.e. the mean of the true positive and true negative rates
+    :param y_true: class indices (0 or 1), shape (n_trials,)
+    :param y_pred: predicted class indices, n_times x n_trials
+    :return:
+        AUC per time point
+    """
+
+    positive = y_true == 1
+    return (np.mean(y_pred[:, positive] == 1, axis=1) + np.mean(y_pred[:, ~positive] == 0, axis=1)) / 2
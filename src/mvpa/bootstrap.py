@@ -0,0 +1,68 @@
+import logging
+
+from typing import Tuple
+
+import numpy as np
+
+from src.utils.logger import get_logger
+
+logger = get_logger(file_name="bootstrap")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# BOOTSTRAP CONFIDENCE INTERVALS                                                                                       #
+########################################################################################################################
+# Confidence intervals of the mean score over the folds, for all the time points. A single set of resamples of the     #
+# folds is drawn and shared by every column (time points of the real and the dummy scores). A resample is stored as    #
+# the number of times each fold is drawn, so the means of the resamples are a matrix product. The intervals are the    #
+# percentiles of these means, as `mne.stats.bootstrap_confidence_interval`. The columns are processed in blocks: the   #
+# means of a block take n_bootstraps x block size floats, whatever the number of columns (T^2 for a generalization).   #
+########################################################################################################################
+
+N_BOOTSTRAPS = 2000
+BLOCK_SIZE = 1024
+
+
+def get_resample_counts(n_samples: int, n_bootstraps=N_BOOTSTRAPS, seed=None) -> np.array:
+    """
+    Draw the bootstrap resamples, with replacement
+    :param n_samples: number of samples (folds) to resample
+    :param n_bootstraps: number of resamples
+    :param seed: seed of the draws, the same seed gives the same resamples. Random if None
+    :return:
+        number of times each sample is drawn, n_bootstraps x n_samples
+    """
+
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, n_samples, size=(n_bootstraps, n_samples))
+    counts = np.zeros((n_bootstraps, n_samples))
+    np.add.at(counts, (np.arange(n_bootstraps)[:, None], indices), 1)
+    return counts
+
+
+def get_confidence_intervals(scores: np.array, ci=.95, n_bootstraps=N_BOOTSTRAPS, seed=None, counts=None,
+                             block_size=BLOCK_SIZE) -> Tuple[np.array, np.array]:
+    """
+    Bootstrap confidence intervals of the mean over the first axis, for every column
+    :param scores: scores, n_folds x n_columns (e.g. cv x time steps)
+    :param ci: confidence level
+    :param n_bootstraps: number of resamples
+    :param seed: seed of the resamples, see `get_resample_counts`
+    :param counts: resamples to share with other scores, see `get_resample_counts`. Drawn with `n_bootstraps` and
+        `seed` if None
+    :param block_size: number of columns whose resample means are computed at once
+    :return:
+        lower and upper bounds, shape (n_columns,)
+    """
+
+    scores = np.asarray(scores, dtype="float64")
+    if counts is None:
+        counts = get_resample_counts(scores.shape[0], n_bootstraps=n_bootstraps, seed=seed)
+
+    lowers, uppers = np.zeros((scores.shape[1],)), np.zeros((scores.shape[1],))
+    for start in range(0, scores.shape[1], block_size):
+        # Mean of every resample for every column of the block, n_bootstraps x block size
+        means = np.matmul(counts, scores[:, start: start + block_size]) / scores.shape[0]
+        lowers[start: start + block_size], uppers[start: start + block_size] = np.percentile(
+            means, ((1 - ci) / 2 * 100, (1 + ci) / 2 * 100), axis=0)
+    return lowers, uppers
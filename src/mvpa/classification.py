@@ -4,15 +4,16 @@ from joblib import Parallel, delayed
 from typing import Tuple
 
 from sklearn.base import clone
-from sklearn.model_selection import StratifiedKFold
 from sklearn.dummy import DummyClassifier
 from sklearn.metrics import balanced_accuracy_score, roc_auc_score
 from sklearn.pipeline import make_pipeline, Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import LinearSVC
 
-from mne.stats import bootstrap_confidence_interval
-
+from src.mvpa.batched import BATCHED_CLASSIFIERS, classify_batched, fit_batched, get_auc, get_dummy_scores
+from src.mvpa.bootstrap import get_confidence_intervals, get_resample_counts
+from src.mvpa.folds import FoldPlan
+from src.utils.file_access import Dataset, dequantize
 from src.utils.logger import get_logger
 
 logger = get_logger(file_name="classification")
@@ -32,8 +33,8 @@ def _get_indices(times: np.array, start: float, end: float, sfreq: float) -> Tup
         start index, end index
     """
 
-    start_idx = int((start - times[0]) / (1 / sfreq))
-    end_idx = int((end - times[0]) / (1 / sfreq))
+    start_idx = int(round((start - times[0]) * sfreq))
+    end_idx = int(round((end - times[0]) * sfreq))
     return start_idx, end_idx
 
 
@@ -49,34 +50,70 @@ def _get_t_steps(window_size: int, sfreq: float) -> int:
     return int(window_size / (1e3 / sfreq))
 
 
-def get_slice(x: np.array, t_idx, window_size=-1., sfreq=-1):
+def get_time_range(params: dict) -> Tuple[float, float]:
     """
-    todo comment
-    :param x:
-    :param t_idx:
-    :param window_size:
-    :param sfreq:
+    Time range of the data used by `classify_temporal`: the classification period, plus the history of the first
+    window. Datasets can be cropped to it when they are generated
+    :param params: classification parameters
     :return:
+        tmin, tmax in seconds (tmax excluded)
     """
 
+    t_steps = max(_get_t_steps(params["window-size"], params["sfreq"]), 1)
+    return params["classification-tmin"] - (t_steps - 1) / params["sfreq"], params["classification-tmax"]
+
+
+def get_slice(x: np.array, t_idx, window_size=-1., sfreq=-1, layout="epochs", trials=None, scale=None):
+    """
+    Get the features of the time window ending at `t_idx`
+    :param x: data, n_epochs x n_vertices x n_times (`epochs` layout) or n_times x n_epochs x n_vertices (`times`
+        layout, the window is a single contiguous read), or a `Dataset` view (only the window is read)
+    :param t_idx: index of the last time point of the window
+    :param window_size: size of the window in ms, a single time point if negative
+    :param sfreq: sampling frequency
+    :param layout: layout of `x`, see `read_metadata`
+    :param trials: epochs to keep (boolean mask or indices), all if None
+    :param scale: scale and offset per vertex of `int16` datasets (see `read_scale`), only the window is converted
+    :return:
+        n_epochs x n_features, features ordered vertex by vertex then time by time for both layouts
+    """
+
+    if isinstance(x, Dataset):
+        t_steps = 1 if window_size < 0 else _get_t_steps(int(window_size), sfreq)
+        x_slice = (x if trials is None else x.select(trials=trials)).read(times=(t_idx - t_steps + 1, t_idx + 1))
+        return x_slice[..., 0] if window_size < 0 else x_slice.reshape(x_slice.shape[0], -1)
+
+    if layout == "times":
+        t_steps = 1 if window_size < 0 else _get_t_steps(int(window_size), sfreq)
+        x_slice = np.asarray(x[t_idx - t_steps + 1: t_idx + 1])   # times x epochs x vertices
+        if trials is not None:
+            x_slice = x_slice[:, trials]
+        x_slice = dequantize(np.moveaxis(x_slice, 0, -1), scale)
+        return x_slice[..., 0] if window_size < 0 else x_slice.reshape(x_slice.shape[0], -1)
+
+    # Window first (a view of the memory map), then the epochs: only the window of the selected epochs is read
     if window_size < 0:
-        return x[..., t_idx]
+        x_slice = x[..., t_idx]
     else:
         t_steps = _get_t_steps(int(window_size), sfreq)
-        return x[..., t_idx - t_steps + 1: t_idx + 1].reshape(x.shape[0], -1)
+        x_slice = x[..., t_idx - t_steps + 1: t_idx + 1]
 
+    if trials is not None:
+        x_slice = x_slice[trials]
+    x_slice = dequantize(np.asarray(x_slice), scale)
+    return x_slice if window_size < 0 else x_slice.reshape(x_slice.shape[0], -1)
 
-def classify(x: np.array, y: np.array, cv: int, clf: Pipeline, scoring):
-    # todo comment
 
-    kf = StratifiedKFold(cv, shuffle=True)
-    scores = np.zeros((cv,))
-    dummy_scores = np.zeros((cv,))
+def classify(x: np.array, y: np.array, cv: int, clf: Pipeline, scoring, folds=None, seed=None):
+    # todo comment
 
     y = y[0].reshape(-1,)  # todo tmp
-    dummy_clf = make_pipeline(StandardScaler(), DummyClassifier(strategy="stratified"))
 
-    for i, (train_idx, test_idx) in enumerate(kf.split(x, y)):
+    # Same splits for every call sharing the plan, random splits otherwise
+    folds = FoldPlan.from_labels(y, cv) if folds is None else folds
+    scores = np.zeros((len(folds),))
+
+    for i, (train_idx, test_idx) in enumerate(folds.split()):
 
         x_train, x_test = x[train_idx], x[test_idx]
         y_train, y_test = y[train_idx], y[test_idx]
@@ -89,75 +126,346 @@ def classify(x: np.array, y: np.array, cv: int, clf: Pipeline, scoring):
         y_pred = clf.predict(x_test)
         scores[i] = scoring(y_test, y_pred)
 
-        # Dummy test
-        dummy_clf.fit(x_train, y_train)
-        y_pred = dummy_clf.predict(x_test)
-        dummy_scores[i] = scoring(y_test, y_pred)
+    # The confidence intervals are estimated for all the time points at once, see `format_results`
+    return scores, _get_dummy_scores(y, folds, scoring, folds.seed if seed is None else seed)
 
-    # Estimate confidence intervals
-    lower, upper = bootstrap_confidence_interval(scores, ci=.95, n_bootstraps=2000, stat_fun="mean")
-    dummy_lower, dummy_upper = bootstrap_confidence_interval(dummy_scores, ci=.95, n_bootstraps=2000, stat_fun="mean")
-    return scores, lower, upper, dummy_scores, dummy_lower, dummy_upper
 
+def _get_dummy_scores(y: np.array, folds: FoldPlan, scoring, seed) -> np.array:
+    """
+    Scores of the stratified dummy classifier of `classify`. Its predictions only depend on the training labels, the
+    number of test trials and the seed, not on the data
+    :param y: labels, shape (n_trials,)
+    :param folds: cross-validation splits, see `FoldPlan`
+    :param scoring: scoring function
+    :param seed: seed of the dummy classifier, e.g. the seed of the time point (see `FoldPlan.get_seed`)
+    :return:
+        dummy score per fold, shape (n_folds,)
+    """
 
-def classify_temporal(x: np.array, y: np.array, params: dict, n_jobs=1):
-    # todo comment
+    dummy_scores = np.zeros((len(folds),))
+    dummy_clf = DummyClassifier(strategy="stratified", random_state=seed)
+    for i, (train_idx, test_idx) in enumerate(folds.split()):
+        dummy_clf.fit(np.zeros((len(train_idx), 1)), y[train_idx])
+        y_pred = dummy_clf.predict(np.zeros((len(test_idx), 1)))
+        dummy_scores[i] = scoring(y[test_idx], y_pred)
+
+    return dummy_scores
 
-    name_to_obj = {"LinearSVC": LinearSVC(max_iter=params["max-iter"])}
 
-    # Time array
-    times = np.arange(params["epochs-tmin"], params["epochs-tmax"], 1 / params["sfreq"])
+def _get_period(x: np.array, params: dict, meta: dict) -> Tuple[int, int]:
+    """
+    Indices of the time points of the classification period
+    :param x: data or `Dataset` view, see `classify_temporal`
+    :param params: classification parameters
+    :param meta: dataset metadata, see `read_metadata`
+    :return:
+        index of the first time point, index of the last time point (excluded)
+    """
+
+    # Time array, from the dataset metadata when the time axis was recorded (e.g. cropped datasets)
+    if "tmin" in meta and "sfreq" in meta:
+        if not np.isclose(meta["sfreq"], params["sfreq"]):
+            raise ValueError(f"The dataset is sampled at {meta['sfreq']} Hz, the parameters say {params['sfreq']} Hz")
+        n_times = x.shape[0] if meta.get("layout") == "times" and not isinstance(x, Dataset) else x.shape[-1]
+        times = meta["tmin"] + np.arange(n_times) / meta["sfreq"]
+    else:
+        times = np.arange(params["epochs-tmin"], params["epochs-tmax"], 1 / params["sfreq"])
     start_idx, end_idx = _get_indices(times,
                                       params["classification-tmin"],
                                       params["classification-tmax"],
                                       params["sfreq"])
-    clf = make_pipeline(StandardScaler(), name_to_obj[params["clf"]])
+    if start_idx - max(_get_t_steps(params["window-size"], params["sfreq"]), 1) + 1 < 0 or end_idx > len(times):
+        raise ValueError(f"The dataset covers {times[0]:.3f} - {times[-1]:.3f} s, too short for the classification "
+                         f"period and the window size")
+    return start_idx, end_idx
 
-    # Create parallel functions per time point
-    parallel_funcs = []
-    for t_idx in range(start_idx, end_idx):  # noqa
-        x_slice = get_slice(x=x, t_idx=t_idx, window_size=params["window-size"], sfreq=params["sfreq"])
 
-        func = delayed(classify)(x=x_slice, y=y, cv=params["cv"],
-                                 clf=clf, scoring=roc_auc_score)
-        parallel_funcs.append(func)
+def classify_temporal(x: np.array, y: np.array, params: dict, n_jobs=1, meta=None, trials=None, scale=None,
+                      folds=None):
+    """
+    Classify every time window of the classification period
+    :param x: `Dataset` view, or data in the layout given by `meta`
+    :param y: labels
+    :param params: classification parameters. `clf` is `LinearSVC` or one of the closed-form `BATCHED_CLASSIFIERS`
+        (`LDA`, `Ridge` with the penalty `alpha`), which fit many time points at once
+    :param n_jobs: number of jobs for parallelism
+    :param meta: dataset metadata (see `read_metadata`), `epochs` layout if None. Taken from the view for a `Dataset`
+    :param trials: epochs to keep, all if None. With the `times` layout, pass the selection here rather than indexing
+        `x`, so that it is applied to each window after the contiguous read
+    :param scale: scale and offset per vertex of `int16` datasets, see `read_scale`
+    :param folds: cross-validation splits shared by all the time points (see `get_fold_plan`). Made from `y`,
+        `params["cv"]` and `params["seed"]` if None
+    :return:
+        results dictionary, see `format_results`
+    """
 
-    logger.debug(f"Total of {len(parallel_funcs)} parallel functions added")
-    logger.debug(f"Executing {n_jobs} jobs in parallel")
+    if folds is None:
+        folds = FoldPlan.from_labels(y[0].reshape(-1,), params["cv"], seed=params.get("seed"))
+
+    if isinstance(x, Dataset):
+        meta, scale = x.meta, None  # the view converts int16 data itself
+
+    meta = meta or {}
+    layout = meta.get("layout", "epochs")
+
+    name_to_obj = {"LinearSVC": LinearSVC(max_iter=params["max-iter"])}
+
+    start_idx, end_idx = _get_period(x, params, meta)
+
+    # Only the time ranges are dispatched, each worker reads its own windows from the data. Memory maps and views of
+    # datasets are sent as references to their files, large in-memory arrays are memory-mapped once by joblib
+    n_batches = min(end_idx - start_idx, max(n_jobs, 1) * 4)
+    batches = [batch for batch in np.array_split(np.arange(start_idx, end_idx), n_batches) if len(batch)]
+    parallel_pool = Parallel(n_jobs=n_jobs, mmap_mode="r")
+
+    logger.debug(f"Executing {n_jobs} jobs in parallel for {end_idx - start_idx} time steps")
+
+    if params["clf"] in BATCHED_CLASSIFIERS:
+        # Closed-form classifiers: every batch of time points is fitted at once
+        parallel_funcs = [delayed(_classify_windows_batched)(x=x, y=y, t_start=batch[0], t_stop=batch[-1] + 1,
+                                                             params=params, layout=layout, trials=trials, scale=scale,
+                                                             folds=folds, t_first=start_idx)
+                          for batch in batches]
+        batch_scores = parallel_pool(parallel_funcs)
+        scores = np.concatenate([batch for batch, _ in batch_scores], axis=1)
+        dummy_scores = np.concatenate([batch for _, batch in batch_scores], axis=1)
+        results = list(zip(scores.T, dummy_scores.T))
+    else:
+        clf = make_pipeline(StandardScaler(), name_to_obj[params["clf"]])
+        parallel_funcs = [delayed(_classify_windows)(x=x, y=y, t_start=batch[0], t_stop=batch[-1] + 1, params=params,
+                                                     clf=clf, layout=layout, trials=trials, scale=scale, folds=folds,
+                                                     t_first=start_idx)
+                          for batch in batches]
+        results = [result for batch_results in parallel_pool(parallel_funcs) for result in batch_results]
 
-    parallel_pool = Parallel(n_jobs=n_jobs)
-    results = parallel_pool(parallel_funcs)
     results = format_results(data=results, params=params)
 
-    logger.debug(f"{len(parallel_funcs)} time steps processed")
+    logger.debug(f"{end_idx - start_idx} time steps processed")
     return results
 
 
+def _classify_windows(x: np.array, y: np.array, t_start: int, t_stop: int, params: dict, clf: Pipeline,
+                      layout="epochs", trials=None, scale=None, folds=None, t_first=0) -> list:
+    """
+    Classify the windows ending at consecutive time points, in a worker. Each window is read from `x` when it is
+    classified, see `get_slice`
+    :param x: data or `Dataset` view, see `classify_temporal`
+    :param y: labels
+    :param t_start: index of the last time point of the first window
+    :param t_stop: index of the last time point of the last window (excluded)
+    :param params: classification parameters
+    :param clf: classification pipeline
+    :param layout: layout of `x`
+    :param trials: epochs to keep, all if None
+    :param scale: scale and offset per vertex of `int16` datasets
+    :param folds: cross-validation splits, see `FoldPlan`
+    :param t_first: index of the first time point of the classification period, the dummy classifier is seeded with
+        the position of the time point in the period (see `FoldPlan.get_seed`)
+    :return:
+        output of `classify` for every time point
+    """
+
+    return [classify(x=get_slice(x=x, t_idx=t_idx, window_size=params["window-size"], sfreq=params["sfreq"],
+                                 layout=layout, trials=trials, scale=scale),
+                     y=y, cv=params["cv"], clf=clf, scoring=roc_auc_score, folds=folds,
+                     seed=folds.get_seed(t_idx - t_first))
+            for t_idx in range(t_start, t_stop)]
+
+
+def _classify_windows_batched(x: np.array, y: np.array, t_start: int, t_stop: int, params: dict, layout="epochs",
+                              trials=None, scale=None, folds=None, t_first=0) -> Tuple[np.array, np.array]:
+    """
+    Classify the windows ending at consecutive time points with a batched classifier, in a worker. The windows are
+    stacked and fitted together, see `classify_batched`
+    :param x: data or `Dataset` view, see `classify_temporal`
+    :param y: labels
+    :param t_start: index of the last time point of the first window
+    :param t_stop: index of the last time point of the last window (excluded)
+    :param params: classification parameters, `clf` is one of `BATCHED_CLASSIFIERS`, `alpha` is the ridge penalty
+    :param layout: layout of `x`
+    :param trials: epochs to keep, all if None
+    :param scale: scale and offset per vertex of `int16` datasets
+    :param folds: cross-validation splits, see `FoldPlan`
+    :param t_first: index of the first time point of the classification period, see `_classify_windows`
+    :return:
+        scores and dummy scores, n_folds x n_time_points
+    """
+
+    windows = np.stack([get_slice(x=x, t_idx=t_idx, window_size=params["window-size"], sfreq=params["sfreq"],
+                                  layout=layout, trials=trials, scale=scale)
+                        for t_idx in range(t_start, t_stop)])
+    return classify_batched(windows, y[0].reshape(-1,), folds, params["clf"], alpha=params.get("alpha", 1.),
+                            seeds=[folds.get_seed(t_idx - t_first) for t_idx in range(t_start, t_stop)])
+
+
+def classify_generalization(x: np.array, y: np.array, params: dict, n_jobs=1, meta=None, trials=None, scale=None,
+                            folds=None) -> dict:
+    """
+    Temporal generalization: train at every time window of the classification period, test at every time window.
+    One model is fitted per training time and fold (`LinearSVC` pipeline or a batched classifier, see
+    `classify_temporal`). Each job fits a batch of training times, then reads the test windows one at a time and
+    scores all its models on them. The diagonal is the score of `classify_temporal` with the same folds.
+    :param x: `Dataset` view, or data in the layout given by `meta`
+    :param y: labels
+    :param params: classification parameters, see `classify_temporal`
+    :param n_jobs: number of jobs for parallelism, each job fits a batch of training times
+    :param meta: dataset metadata, see `classify_temporal`
+    :param trials: epochs to keep, all if None
+    :param scale: scale and offset per vertex of `int16` datasets, see `read_scale`
+    :param folds: cross-validation splits, see `classify_temporal`
+    :return:
+        results dictionary, see `format_results`, with n_folds x n_train_times x n_test_times scores and
+        n_train_times x n_test_times bounds
+    """
+
+    if folds is None:
+        folds = FoldPlan.from_labels(y[0].reshape(-1,), params["cv"], seed=params.get("seed"))
+
+    if isinstance(x, Dataset):
+        meta, scale = x.meta, None  # the view converts int16 data itself
+
+    meta = meta or {}
+    layout = meta.get("layout", "epochs")
+    start_idx, end_idx = _get_period(x, params, meta)
+
+    classes, y_idx = np.unique(y[0].reshape(-1,), return_inverse=True)
+    if len(classes) != 2:
+        raise ValueError(f"Generalization scores are computed for two classes, got {len(classes)}")
+
+    # Only the time ranges are dispatched, as in `classify_temporal`
+    n_batches = min(end_idx - start_idx, max(n_jobs, 1) * 4)
+    batches = [batch for batch in np.array_split(np.arange(start_idx, end_idx), n_batches) if len(batch)]
+
+    logger.debug(f"Executing {n_jobs} jobs in parallel for {end_idx - start_idx} x {end_idx - start_idx} time steps")
+
+    parallel_pool = Parallel(n_jobs=n_jobs, mmap_mode="r")
+    scores = parallel_pool(delayed(_generalize_windows)(x=x, y=y, t_start=batch[0], t_stop=batch[-1] + 1,
+                                                        test_times=(start_idx, end_idx), params=params, layout=layout,
+                                                        trials=trials, scale=scale, folds=folds)
+                           for batch in batches)
+    scores = np.concatenate(scores, axis=1)
+
+    # The dummy predictions do not depend on the data: the dummy classifier of each training time (seeded as in
+    # `classify_temporal`) gives the same scores at every test time
+    seeds = [folds.get_seed(t_idx) for t_idx in range(end_idx - start_idx)]
+    if params["clf"] in BATCHED_CLASSIFIERS:
+        d_scores = np.stack([get_dummy_scores(y_idx, folds, seed) for seed in seeds], axis=1)
+    else:
+        d_scores = np.stack([_get_dummy_scores(y[0].reshape(-1,), folds, roc_auc_score, seed) for seed in seeds],
+                            axis=1)
+    return _get_results(scores, d_scores, params)
+
+
+def _generalize_windows(x: np.array, y: np.array, t_start: int, t_stop: int, test_times: Tuple[int, int],
+                        params: dict, layout="epochs", trials=None, scale=None, folds=None) -> np.array:
+    """
+    Fit the models of a batch of training times and score them at all the test times, in a worker. The windows of
+    the batch are read together, the test windows are read one at a time, see `get_slice`
+    :param x: data or `Dataset` view, see `classify_generalization`
+    :param y: labels
+    :param t_start: index of the last time point of the first training window
+    :param t_stop: index of the last time point of the last training window (excluded)
+    :param test_times: indices of the last time points of the first and last (excluded) test windows
+    :param params: classification parameters
+    :param layout: layout of `x`
+    :param trials: epochs to keep, all if None
+    :param scale: scale and offset per vertex of `int16` datasets
+    :param folds: cross-validation splits, see `FoldPlan`
+    :return:
+        scores, n_folds x n_train_times x n_test_times
+    """
+
+    y = y[0].reshape(-1,)
+    _, y_idx = np.unique(y, return_inverse=True)
+
+    windows = np.stack([get_slice(x=x, t_idx=t_idx, window_size=params["window-size"], sfreq=params["sfreq"],
+                                  layout=layout, trials=trials, scale=scale)
+                        for t_idx in range(t_start, t_stop)])
+    if params["clf"] in BATCHED_CLASSIFIERS:
+        models = list(fit_batched(windows, y, folds, params["clf"], alpha=params.get("alpha", 1.)))
+    else:
+        models = [_fit_linear(windows, y, train_idx, params) for train_idx, _ in folds.split()]
+    del windows
+
+    scores = np.zeros((len(folds), t_stop - t_start, test_times[1] - test_times[0]))
+    for j, t_idx in enumerate(range(*test_times)):
+        window = np.asarray(get_slice(x=x, t_idx=t_idx, window_size=params["window-size"], sfreq=params["sfreq"],
+                                      layout=layout, trials=trials, scale=scale), dtype="float64")
+
+        # Decision function of every training time of the batch: n_train_times x n_test x classes
+        for i, ((_, test_idx), (coef, intercept)) in enumerate(zip(folds.split(), models)):
+            decision = np.matmul(window[test_idx], coef) + intercept[:, None]
+            scores[i, :, j] = get_auc(y_idx[test_idx], decision.argmax(axis=2))
+
+    return scores
+
+
+def _fit_linear(windows: np.array, y: np.array, train_idx: np.array, params: dict) -> Tuple[np.array, np.array]:
+    """
+    Fit the `StandardScaler` + linear classifier pipeline of `classify` at a batch of training times, and express each
+    model as a linear decision function on the raw features
+    :param windows: windows of the training times, n_times x n_trials x n_features
+    :param y: binary labels
+    :param train_idx: training trials
+    :param params: classification parameters
+    :return:
+        coefficients (n_times x n_features x 2) and intercepts (n_times x 2), the predicted class is the argmax
+    """
+
+    coefs, intercepts = [], []
+    for window in windows:
+        clf = make_pipeline(StandardScaler(), LinearSVC(max_iter=params["max-iter"]))
+        clf.fit(window[train_idx], y[train_idx])
+        scaler, svc = clf[0], clf[-1]
+
+        coef = svc.coef_[0] / scaler.scale_
+        intercept = svc.intercept_[0] - np.dot(coef, scaler.mean_)
+
+        # Binary decision d > 0 for the second class, as two columns for the argmax
+        coefs.append(np.stack([-coef, coef], axis=1))
+        intercepts.append(np.array([-intercept, intercept]))
+
+    return np.stack(coefs), np.stack(intercepts)
+
+
 def format_results(data, params):
     """
-    todo comment
-    :param data:
-    :param params:
+    Gather the scores of the time steps and estimate their confidence intervals, see `get_confidence_intervals`
+    :param data: (scores, dummy scores) of the folds for every time step, as returned by `classify`
+    :param params: classification parameters, `seed` and `n-bootstraps` set the bootstrap resamples
     :return:
+        results dictionary, cv x time steps scores and per time step bounds
     """
     # todo tidy
 
-    scores, lowers, uppers = [], [], []
-    d_scores, d_lowers, d_uppers = [], [], []
-    for s, l, u, ds, dl, du in data:  # per time step
-        scores.append(s)
-        lowers.append(l)
-        uppers.append(u)
-        d_scores.append(ds)
-        d_lowers.append(dl)
-        d_uppers.append(du)
-
-    scores = np.stack(scores, axis=1)  # cv x time steps
-    lowers = np.array(lowers)
-    uppers = np.array(uppers)
-    d_scores = np.stack(d_scores, axis=1)
-    d_lowers = np.array(d_lowers)
-    d_uppers = np.array(d_uppers)
+    scores = np.stack([s for s, _ in data], axis=1)  # cv x time steps
+    d_scores = np.stack([ds for _, ds in data], axis=1)
+    return _get_results(scores, d_scores, params)
+
+
+def _get_results(scores: np.array, d_scores: np.array, params: dict) -> dict:
+    """
+    Results dictionary of the scores and their confidence intervals, see `format_results`
+    :param scores: scores, cv x time steps (or cv x training time steps x test time steps)
+    :param d_scores: dummy scores, same shape, or cv x training time steps for a generalization (the dummy scores of
+        a training time are the same at every test time)
+    :param params: classification parameters, `seed` and `n-bootstraps` set the bootstrap resamples
+    :return:
+        results dictionary, the bounds have the shape of the scores without the folds
+    """
+
+    # 95% bootstrap confidence intervals of the mean over the folds, the same resamples for every time step and for
+    # both the real and the dummy scores. The dummy bounds of a generalization are computed per training time only.
+    n_folds = scores.shape[0]
+    counts = get_resample_counts(n_folds, n_bootstraps=params.get("n-bootstraps", 2000), seed=params.get("seed"))
+    lowers, uppers = get_confidence_intervals(scores.reshape(n_folds, -1), ci=.95, counts=counts)
+    d_lowers, d_uppers = get_confidence_intervals(d_scores.reshape(n_folds, -1), ci=.95, counts=counts)
+
+    d_shape = d_scores.shape[1:] + (1,) * (scores.ndim - d_scores.ndim)
+    lowers, uppers = lowers.reshape(scores.shape[1:]), uppers.reshape(scores.shape[1:])
+    d_lowers = np.broadcast_to(d_lowers.reshape(d_shape), scores.shape[1:])
+    d_uppers = np.broadcast_to(d_uppers.reshape(d_shape), scores.shape[1:])
+    d_scores = np.broadcast_to(d_scores.reshape((n_folds,) + d_shape), scores.shape)
 
     results = {"meta": params,
                "data":
@@ -0,0 +1,148 @@
+import logging
+import os
+
+from pathlib import Path
+from typing import Iterator, Tuple, Union
+
+import numpy as np
+
+from sklearn.model_selection import StratifiedKFold
+
+from src.utils.file_access import get_array_hash
+from src.utils.logger import get_logger
+
+logger = get_logger(file_name="folds")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# FOLD PLAN                                                                                                            #
+########################################################################################################################
+# The cross-validation splits of a condition are computed once per (y, cv, seed) and saved in a directory shared by    #
+# all the areas of the condition (`folds-dir`), under a name made of the hash of the labels: areas with the same       #
+# trials share one plan. Every time point, area and classifier of the condition is then scored on the same folds:      #
+# scores are comparable across time points, areas and reruns, and anything computed per fold (scaler statistics, Gram  #
+# matrices) can be reused.                                                                                             #
+########################################################################################################################
+
+
+class FoldPlan:
+    """
+    Stratified K-fold splits of a set of labels. `fold[i]` is the fold in which trial `i` is tested, the trials of the
+    other folds are used for training.
+    """
+
+    def __init__(self, fold: np.array, seed=None, y_hash=None):
+        """
+        :param fold: fold of every trial, shape (n_trials,)
+        :param seed: seed of the shuffle, None if the plan is not reproducible
+        :param y_hash: hash of the labels the plan was made for, see `get_array_hash`
+        """
+
+        self.fold = np.asarray(fold)
+        self.seed = seed
+        self.y_hash = y_hash
+        self.n_splits = int(self.fold.max()) + 1
+
+        self.test_idx = [np.flatnonzero(self.fold == i) for i in range(self.n_splits)]
+        self.train_idx = [np.flatnonzero(self.fold != i) for i in range(self.n_splits)]
+
+    @classmethod
+    def from_labels(cls, y: np.array, cv: int, seed=None) -> "FoldPlan":
+        """
+        Split the labels, same splits as `StratifiedKFold(cv, shuffle=True, random_state=seed)`
+        :param y: labels, shape (n_trials,)
+        :param cv: number of folds
+        :param seed: seed of the shuffle, the splits are random if None
+        :return:
+            FoldPlan
+        """
+
+        fold = np.zeros(len(y), dtype="int16")
+        kf = StratifiedKFold(cv, shuffle=True, random_state=seed)
+        for i, (_, test_idx) in enumerate(kf.split(np.zeros((len(y), 1)), y)):
+            fold[test_idx] = i
+
+        return cls(fold, seed=seed, y_hash=get_array_hash(np.asarray(y)))
+
+    def __len__(self) -> int:
+        return self.n_splits
+
+    def get_seed(self, t_idx: int) -> Union[int, None]:
+        """
+        Seed of the random draws made at a time point, e.g. the predictions of the dummy classifier. Each time point
+        gets its own draws, reproducible with the seed of the plan
+        :param t_idx: index of the time point in the classification period
+        :return:
+            seed, None if the plan is not seeded
+        """
+        return None if self.seed is None else self.seed + int(t_idx)
+
+    def split(self) -> Iterator[Tuple[np.array, np.array]]:
+        """
+        Iterate over the folds, like `StratifiedKFold.split`
+        :return:
+            (train indices, test indices) per fold
+        """
+        return zip(self.train_idx, self.test_idx)
+
+    def save(self, dir_path: Path) -> Path:
+        """
+        Save the plan, see `get_fold_plan`
+        :param dir_path: directory of the fold plans of the condition
+        :return:
+            path to the saved plan
+        """
+
+        path = dir_path / _get_fname(self.n_splits, self.seed, self.y_hash)
+        tmp_path = dir_path / f".{path.stem}.{os.getpid()}.npz"
+        np.savez(str(tmp_path), fold=self.fold, y_hash=np.array(self.y_hash))
+        os.replace(tmp_path, path)
+        return path
+
+
+def get_fold_plan(dir_path: Path, y: np.array, cv: int, seed: int) -> FoldPlan:
+    """
+    Load the fold plan of a set of labels, or make and save it on the first call. The areas of a condition with the
+    same labels share the same plan, concurrent jobs save identical plans
+    :param dir_path: directory of the fold plans of the condition, shared by all the areas
+    :param y: labels, shape (n_trials,)
+    :param cv: number of folds
+    :param seed: seed of the shuffle
+    :return:
+        FoldPlan
+    """
+
+    y_hash = get_array_hash(np.asarray(y))
+    plan = _load_fold_plan(dir_path / _get_fname(cv, seed, y_hash), seed)
+    if plan is not None and plan.y_hash == y_hash:
+        return plan
+
+    logger.info(f"Making the {cv}-fold plan with seed {seed} in {dir_path}")
+    if not dir_path.exists():
+        os.makedirs(dir_path, exist_ok=True)
+    plan = FoldPlan.from_labels(y, cv, seed=seed)
+    plan.save(dir_path)
+    return plan
+
+
+def _load_fold_plan(path: Path, seed: int) -> Union[FoldPlan, None]:
+    """
+    Load a saved fold plan
+    :param path: path to the `.npz` file
+    :param seed: seed of the shuffle
+    :return:
+        FoldPlan, None if there is no such file
+    """
+
+    if not path.exists():
+        return None
+
+    with np.load(str(path)) as data:
+        return FoldPlan(data["fold"], seed=seed, y_hash=str(data["y_hash"]))
+
+
+def _get_fname(cv: int, seed, y_hash: str) -> str:
+    """
+    File name of a fold plan, e.g. `folds-100-0-3f2a9c1e0b7d4a65.npz`
+    """
+    return f"folds-{cv}-{seed}-{y_hash[:16]}.npz"
@@ -1,12 +1,19 @@
+import hashlib
 import logging
 import re
 import os
 from pathlib import Path
-from typing import List
+from typing import List, Tuple, Union
 import numpy as np
 
-from src.utils.file_access import write_json
+from joblib import Parallel, delayed
+
+from src.utils.chunked import convert_to_chunked
+from src.utils.file_access import SCALE_FNAME, load_json, write_json
+from src.utils.fsaverage import DEFAULT_SRC_NAME
 from src.utils.logger import get_logger
+from src.utils.manifest import read_manifest
+from src.utils.source_store import STORE_NAME, read_store, read_store_index, read_label, get_summary_store_name
 
 logger = get_logger(file_name="artifact")
 logger.setLevel(logging.INFO)
@@ -17,151 +24,525 @@ logger.setLevel(logging.INFO)
 # DATASET GENERATION                                                                                                   #
 ########################################################################################################################
 
+# Layouts of `x.dat`: `epochs` is n_epochs x n_vertices x n_times, `times` is n_times x n_epochs x n_vertices
+LAYOUTS = ("epochs", "times")
+
+# Data types of `x.dat`. `int16` datasets are quantized with a scale and an offset per vertex, saved in `x_scale.npy`
+DTYPES = ("float64", "float32", "int16")
+INT16_MAX = 32767
 
-def _get_events_paths(epoch_dir: Path, reject_list: List[str]):
+
+def _load_stc(path: Path, area_name: str) -> np.array:
     """
-    Collect list of available events arrays
-    :param epoch_dir: directory containing all epochs
-    :param reject_list: todo comment reject_list
+    Load the source localization of an area for a single subject, as a memory map: the data is only read when it is
+    copied
+    :param path: path to the source store or to the `.npy` file of the area
+    :param area_name: name of the area
     :return:
-        list of paths to events array
+        n_epochs x n_vertices x n_times (n_components instead of n_vertices for a summary store)
     """
 
-    fname = "events.npy"
-    events_path_list = []
+    if path.suffix == ".dat":
+        return read_label(path.parent, area_name, name=path.stem)
+    return np.load(str(path), mmap_mode="r")
 
-    for subject_dir in os.listdir(epoch_dir):   # e.g. "sub-V1001"
 
-        # Skip rejected subjects
-        if subject_dir in reject_list:
-            continue
+def _get_stc_shape(path: Path, area_name: str) -> tuple:
+    """
+    Shape of the source localization of an area for a single subject, without reading the data. Uses the store index,
+    or the header of the `.npy` file (memory map, nothing else is read).
+    :param path: path to the source store or to the `.npy` file of the area
+    :param area_name: name of the area
+    :return:
+        (n_epochs, n_vertices, n_times)
+    """
 
-        subject_path = epoch_dir / subject_dir  # "epochs/sub-V1001"
+    if path.suffix == ".dat":
+        index = read_store_index(path.parent, name=path.stem)
+        start, stop = index["labels"][area_name]
+        return index["shape"][0], stop - start, index["shape"][2]
 
-        if re.match(r"^sub-[AV]\d+$", str(subject_dir)):  # there are hidden files in the directory
-            events_path = subject_path / fname
-            if events_path.exists():
-                events_path_list.append(events_path)
-            else:
-                logger.debug(f"events file not found in {subject_dir}. Skipping...")
-    logger.info(f"Found {len(events_path_list)}  events found")
-    return events_path_list
+    return np.load(str(path), mmap_mode="r").shape
 
 
-def _get_stc_paths(epoch_dir: Path, area_name: str, reject_list: List[str]):
+def _get_source_meta(data_paths: List[Path]) -> dict:
     """
-    ollect list of available source localizations
-    :param epoch_dir: directory containing all epochs
-    :param area_name: name of the area
-    :param reject_list: todo reject_list
+    Source space and vertex decimation the data was extracted with. `.npy` files of older subjects were always
+    extracted on the default source space with all the vertices.
+    :param data_paths: paths to the source stores or to the `.npy` files of the area
     :return:
-        list of source localization
+        {"src-name": name of the fsaverage source space, "decimate": vertex decimation factor}
     """
 
-    stc_path_list = []
+    source_meta = None
+    for path in data_paths:
+        index = read_store_index(path.parent, name=path.stem) if path.suffix == ".dat" else {}
+        meta = {"src-name": index.get("src-name", DEFAULT_SRC_NAME), "decimate": index.get("decimate", 1)}
 
-    for subject_dir in os.listdir(epoch_dir):   # e.g. "sub-V1001"
+        if source_meta is None:
+            source_meta = meta
+        elif meta != source_meta:
+            raise ValueError(f"{path} was extracted with {meta}, other subjects with {source_meta}")
+
+    return source_meta or {}
 
-        # Skip rejected subjects
-        if subject_dir in reject_list:
-            continue
 
-        subject_path = epoch_dir / subject_dir  # "epochs/sub-V1001"
+def _get_time_meta(data_paths: List[Path]) -> dict:
+    """
+    Time axis of the source data, from the source stores
+    :param data_paths: paths to the source stores or to the `.npy` files of the area
+    :return:
+        {"tmin": time of the first sample, "sfreq": sampling frequency}, empty if unknown for any subject (`.npy`
+        files of older subjects)
+    """
 
-        if re.match(r"^sub-[AV]\d+$", str(subject_dir)):  # there are hidden files in the directory
+    time_meta = None
+    for path in data_paths:
+        index = read_store_index(path.parent, name=path.stem) if path.suffix == ".dat" else {}
+        if "tmin" not in index or "sfreq" not in index:
+            return {}
 
-            # Look for matching cortical area
-            stc_dir = subject_path / "stc"                      # e.g. "epochs/sub-V1001/stc"
-            if stc_dir.exists():
-                for area_file in os.listdir(stc_dir):               # e.g. "epochs/sub-V1001/stc/..."
-                    if area_file.startswith(area_name):             # e.g. "fusiform_1-h.npy"
-                        stc_path_list.append(stc_dir / area_file)   # e.g. "epochs/sub-V1001/stc/fusiform_1-h.npy"
-            else:
-                logger.info(f"No source reconstruction data for {subject_dir} available. Skipping...")
+        meta = {"tmin": index["tmin"], "sfreq": index["sfreq"]}
+        if time_meta is None:
+            time_meta = meta
+        elif not np.allclose(list(meta.values()), list(time_meta.values())):
+            raise ValueError(f"{path} has the time axis {meta}, other subjects {time_meta}")
 
-    logger.info(f"Found {len(stc_path_list)} source reconstruction files found")
-    return stc_path_list
+    return time_meta or {}
 
 
-def _validate_paths(stc_paths: list, events_paths: list):
+def _get_crop(time_meta: dict, n_times: int, time_range) -> Tuple[int, int]:
     """
-    Validate the paths by making sure they are of the same subjectt
-    :param stc_paths: list of paths to stc data
-    :param events_paths: list of paths to events array
-    :return: validated lists of paths
+    Samples to keep for a time range
+    :param time_meta: see `_get_time_meta`
+    :param n_times: number of samples of the source data
+    :param time_range: (tmin, tmax) in seconds, tmax excluded. All the samples if None
+    :return:
+        first sample, last sample (excluded)
     """
 
-    logger.info(f"Validating the paths")
+    if time_range is None:
+        return 0, n_times
 
-    valid_stcs, valid_events = [], []
-    for stc_path in stc_paths:
-        subject = re.findall(r"sub-[AV]\d+", str(stc_path))[0]
+    if not time_meta:
+        raise ValueError("Cannot crop the data, the time axis of some subjects is unknown")
 
-        for event_path in events_paths:
+    tmin, sfreq = time_meta["tmin"], time_meta["sfreq"]
+    start = max(int(round((time_range[0] - tmin) * sfreq)), 0)
+    stop = min(int(round((time_range[1] - tmin) * sfreq)), n_times)
+    if stop <= start:
+        raise ValueError(f"The time range {time_range} is outside of the data")
 
-            if re.search(rf"\.*{subject}\.*", str(event_path)):
-                valid_stcs.append(stc_path)
-                valid_events.append(event_path)
-                break
+    return start, stop
 
-    logger.info(f"{len(valid_stcs)} valid subject data found")
-    return valid_stcs, valid_events
 
+def _generate_mmap(dst_dir: Path, data_paths: List[Path], event_paths, area_name: str, summary=None, n_jobs=1,
+                   layout="epochs", time_range=None, dtype="float64"):
+    """
+    Concatenate all subjects into a memory map. The output is sized from the headers and the offset of every subject is
+    computed up front, then the subjects are copied into their own disjoint slices, in parallel if `n_jobs` > 1.
+    Each subject is read once.
+    :param dst_dir: path to directory to store the results
+    :param data_paths: paths to the source stores or to the `.npy` files of the area
+    :param event_paths: paths to events arrays
+    :param area_name: name of the area
+    :param summary: summary mode the data comes from, recorded in `x_shape.json`
+    :param n_jobs: number of subjects copied at the same time
+    :param layout: `epochs` (n_epochs x n_vertices x n_times) or `times` (n_times x n_epochs x n_vertices)
+    :param time_range: (tmin, tmax) in seconds to crop the data to, tmax excluded. No cropping if None
+    :param dtype: data type of `x.dat`, see `DTYPES`
+    """
 
-def _generate_mmap(dst_dir: Path, data_paths: List[Path], event_paths):
-    # todo
+    plan = _plan_dataset(dst_dir, data_paths, event_paths, area_name, layout=layout, time_range=time_range,
+                         dtype=dtype)
+    _set_scales([plan], n_jobs=n_jobs)
 
-    # Get the size of final array
-    x_shape = _get_array_size(data_paths)
-    fname = "x.dat"
+    # Each worker opens the memory map and writes its own slice
+    logger.info(f"Copying {len(data_paths)} subjects with {n_jobs} jobs")
+    file_targets = _group_targets([plan])
+    parallel_funcs = [delayed(_copy_areas)(data_path=data_path, targets=targets)
+                      for data_path, targets in file_targets.items()]
+    parallel_pool = Parallel(n_jobs=n_jobs)
+    _set_hashes([plan], file_targets, parallel_pool(parallel_funcs))
 
-    x_map = np.memmap(str(dst_dir / fname), dtype="float64", mode="w+", shape=x_shape)
+    _write_dataset_meta(plan, summary=summary)
 
-    y_list = []
 
-    # Use memory map for x
-    curr_idx = 0
-    for idx, (data_path, event_path) in enumerate(zip(data_paths, event_paths)):
-        logger.debug(f"{idx} / {len(data_paths)}")
-        logger.debug(f"Appending {data_path}")
+def _plan_dataset(dst_dir: Path, data_paths: List[Path], event_paths: List[Path], area_name: str,
+                  layout="epochs", time_range=None, dtype="float64") -> dict:
+    """
+    Check the subjects of a dataset, compute the rows of every subject and preallocate `x.dat`
+    :param dst_dir: path to directory to store the results
+    :param data_paths: paths to the source stores or to the `.npy` files of the area
+    :param event_paths: paths to events arrays
+    :param area_name: name of the area
+    :param layout: layout of `x.dat`, see `LAYOUTS`
+    :param time_range: (tmin, tmax) in seconds to crop the data to, tmax excluded. No cropping if None
+    :param dtype: data type of `x.dat`, see `DTYPES`
+    :return:
+        plan of the dataset: destination, area, shape, layout, dtype, samples kept, subject paths and rows, y and
+        metadata. The scales of `int16` datasets are added by `_set_scales`, the content hashes by `_set_hashes`
+    """
 
-        # Read x
-        x = np.load(str(data_path))
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, use one of {LAYOUTS}")
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype {dtype}, use one of {DTYPES}")
+
+    # Subjects must share the same source space and time axis to be concatenated
+    source_meta = _get_source_meta(data_paths)
+    time_meta = _get_time_meta(data_paths)
+
+    # Read y and check the number of epochs of every subject before writing anything
+    y_list, bounds = [], [0]
+    for data_path, event_path in zip(data_paths, event_paths):
+        n_epochs = _get_stc_shape(data_path, area_name)[0]
 
-        # Read y
         events = np.load(str(event_path))
         y = events[:, 2]
 
-        # Make sure the shape stays the same
-        if x.shape[0] == y.shape[0]:
-            x_map[curr_idx: curr_idx + x.shape[0]] = x
-            curr_idx += x.shape[0]
-            x_map.flush()
+        if n_epochs != y.shape[0]:
+            raise ValueError(f"The numbers of epochs for x {n_epochs} and y {y.shape[0]} are different")
+
+        y_list.append(y)
+        bounds.append(bounds[-1] + n_epochs)
+
+    # Get the size of final array, only the samples of the time range are kept
+    x_shape = _get_array_size(data_paths, area_name)
+    times = _get_crop(time_meta, x_shape[2], time_range)
+    x_shape = (x_shape[0], x_shape[1], times[1] - times[0])
+    if time_meta:
+        source_meta.update(tmin=time_meta["tmin"] + times[0] / time_meta["sfreq"], sfreq=time_meta["sfreq"])
+
+    if layout == "times":
+        x_shape = (x_shape[2], x_shape[0], x_shape[1])
+
+    x_map = np.memmap(str(dst_dir / "x.dat"), dtype=dtype, mode="w+", shape=x_shape)
+    del x_map
+
+    return {"dst-dir": dst_dir, "area": area_name, "shape": x_shape, "layout": layout, "dtype": dtype,
+            "scale": None, "times": times, "data-paths": list(data_paths), "bounds": bounds, "y": np.hstack(y_list),
+            "source-meta": source_meta, "hashes": {}}
+
+
+def _get_targets(plan: dict) -> List[dict]:
+    """
+    Destination of every subject of a dataset plan
+    :param plan: see `_plan_dataset`
+    :return:
+        one target per subject, in the order of `plan["data-paths"]`, see `_copy_areas`
+    """
+
+    bounds = plan["bounds"]
+    return [{"x-path": plan["dst-dir"] / "x.dat", "shape": plan["shape"], "layout": plan["layout"],
+             "dtype": plan["dtype"], "scale": plan["scale"], "times": plan["times"], "area": plan["area"],
+             "start": start, "stop": stop}
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _group_targets(plans: List[dict]) -> dict:
+    """
+    Group the targets of dataset plans by source file, so that each file is read once for all the plans
+    :param plans: see `_plan_dataset`
+    :return:
+        {data path: list of targets}
+    """
+
+    file_targets = {}
+    for plan in plans:
+        for data_path, target in zip(plan["data-paths"], _get_targets(plan)):
+            file_targets.setdefault(data_path, []).append(target)
+    return file_targets
+
+
+def _set_hashes(plans: List[dict], file_targets: dict, results: list) -> None:
+    """
+    Record the content hash of every subject of the datasets, as returned by `_copy_areas`
+    :param plans: see `_plan_dataset`, updated in place
+    :param file_targets: see `_group_targets`
+    :param results: results of `_copy_areas`, one list per file of `file_targets`
+    """
+
+    plan_hashes = {plan["dst-dir"] / "x.dat": plan["hashes"] for plan in plans}
+    for (data_path, targets), file_results in zip(file_targets.items(), results):
+        for target, (data_hash, _) in zip(targets, file_results):
+            plan_hashes[target["x-path"]][_get_subject(data_path)] = data_hash
 
-            y_list.append(y)
-        else:
-            raise ValueError(f"The numbers of epochs for x {x.shape[0]} and y {y.shape[0]} are different")
 
-    shape = {"shape": x_shape}
+def _set_scales(plans: List[dict], n_jobs=1) -> None:
+    """
+    Compute the scale and offset of every vertex of the `int16` datasets, from the range of the data of all the
+    subjects. Values are mapped linearly from [min, max] to [-INT16_MAX, INT16_MAX]. Other datasets are left unchanged
+    :param plans: see `_plan_dataset`, updated in place
+    :param n_jobs: number of subjects read in parallel
+    """
+
+    plans = [plan for plan in plans if plan["dtype"] == "int16"]
+    if not plans:
+        return
+
+    file_targets = _group_targets(plans)
+    logger.info(f"Reading the range of {len(file_targets)} files to quantize {len(plans)} datasets")
+    parallel_pool = Parallel(n_jobs=n_jobs)
+    ranges = parallel_pool(delayed(_get_vertex_range)(data_path=data_path, targets=targets)
+                           for data_path, targets in file_targets.items())
+
+    # Reduce the ranges of all the subjects of each dataset
+    lows, highs = {}, {}
+    for targets, file_ranges in zip(file_targets.values(), ranges):
+        for target, (low, high) in zip(targets, file_ranges):
+            key = target["x-path"]
+            lows[key] = np.minimum(lows[key], low) if key in lows else low
+            highs[key] = np.maximum(highs[key], high) if key in highs else high
+
+    for plan in plans:
+        low, high = lows[plan["dst-dir"] / "x.dat"], highs[plan["dst-dir"] / "x.dat"]
+        scale = (high - low) / (2 * INT16_MAX)
+        scale[scale == 0] = 1.
+        plan["scale"] = np.stack([scale, (high + low) / 2])
+
+
+def _get_vertex_range(data_path: Path, targets: List[dict], block_size=64) -> List[Tuple[np.array, np.array]]:
+    """
+    Minimum and maximum of every vertex of the data of a single subject, for one or more areas
+    :param data_path: path to the source store or to the `.npy` file of the area
+    :param targets: see `_copy_areas`
+    :param block_size: number of epochs read at a time from a source store
+    :return:
+        (min, max) per target, arrays of shape (n_vertices,)
+    """
+
+    if data_path.suffix != ".dat":
+        ranges = []
+        for target in targets:
+            t_start, t_stop = target["times"]
+            data = _load_stc(data_path, target["area"])[..., t_start: t_stop]
+            ranges.append((np.asarray(data.min(axis=(0, 2)), dtype="float64"),
+                           np.asarray(data.max(axis=(0, 2)), dtype="float64")))
+        return ranges
+
+    store, index = read_store(data_path.parent, name=data_path.stem)
+    slices = [index["labels"][target["area"]] for target in targets]
+    low, high = min(start for start, _ in slices), max(stop for _, stop in slices)
+    t_start, t_stop = targets[0]["times"]
+
+    v_min, v_max = np.full(high - low, np.inf), np.full(high - low, -np.inf)
+    for block_start in range(0, store.shape[0], block_size):
+        block = np.asarray(store[block_start: block_start + block_size, low: high, t_start: t_stop])
+        v_min = np.minimum(v_min, block.min(axis=(0, 2)))
+        v_max = np.maximum(v_max, block.max(axis=(0, 2)))
+
+    return [(v_min[start - low: stop - low], v_max[start - low: stop - low]) for start, stop in slices]
+
+
+def _write_dataset_meta(plan: dict, summary=None) -> None:
+    """
+    Write `x_shape.json` and `y.npy` once `x.dat` is complete
+    :param plan: see `_plan_dataset`
+    :param summary: summary mode the data comes from
+    """
+
+    dst_dir, bounds = plan["dst-dir"], plan["bounds"]
+
+    shape = {"shape": plan["shape"], "layout": plan["layout"], "dtype": plan["dtype"]}
+    shape.update(plan["source-meta"])
+    if summary:
+        shape["summary"] = summary
+    shape["subjects"] = {_get_subject(data_path): [start, stop]
+                         for data_path, start, stop in zip(plan["data-paths"], bounds[:-1], bounds[1:])}
+    shape["hashes"] = plan["hashes"]
     fname = "x_shape.json"
     write_json(dst_dir, file_name=fname, data=shape)  # needed to recover the shape
 
-    y = np.hstack(y_list)
     fname = "y.npy"
-    np.save(str(dst_dir / fname), y)
+    np.save(str(dst_dir / fname), plan["y"])
 
+    if plan["scale"] is not None:
+        np.save(str(dst_dir / SCALE_FNAME), plan["scale"])
+
+
+def _copy_areas(data_path: Path, targets: List[dict], block_size=64, get_range=False) -> List[tuple]:
+    """
+    Copy the data of a single subject into the datasets of one or more areas. A source store is streamed once, by
+    blocks of epochs covering all the areas, whatever the number of areas. The content of each area is hashed on the
+    way, to recognize the subject when appending to the dataset (see `append_dataset`).
+    :param data_path: path to the source store or to the `.npy` file of the area
+    :param targets: list of {"x-path": path to the preallocated dataset, "shape": shape of the dataset, "layout": layout
+        of the dataset, "dtype": data type of the dataset, "scale": scale and offset per vertex (`int16` only),
+        "times": samples to keep (start, stop), "area": name of the area, "start": first epoch of the subject in the
+        dataset, "stop": last epoch (excluded)}
+    :param block_size: number of epochs read at a time from a source store
+    :param get_range: if true, the minimum and maximum of every vertex are also computed on the way, before
+        quantization (see `_check_scale_range`)
+    :return:
+        (hash of the data, see `_init_hash`, (min, max) per vertex or None) of every target
+    """
+
+    logger.debug(f"Appending {data_path} to {len(targets)} datasets")
+
+    x_maps = [np.memmap(str(target["x-path"]), dtype=target["dtype"], mode="r+", shape=target["shape"])
+              for target in targets]
+
+    shas, ranges = _init_target_hashes(data_path, targets), [None] * len(targets)
+    for block_start, blocks in _read_areas(data_path, targets, block_size=block_size):
+        for idx, (x_map, target, data, sha) in enumerate(zip(x_maps, targets, blocks, shas)):
+            _write_epochs(x_map, target["layout"], target["start"] + block_start, _quantize(data, target["scale"]))
+            sha.update(data.data)
+
+            if get_range:
+                low, high = data.min(axis=(0, 2)).astype("float64"), data.max(axis=(0, 2)).astype("float64")
+                ranges[idx] = (low, high) if ranges[idx] is None else (np.minimum(ranges[idx][0], low),
+                                                                       np.maximum(ranges[idx][1], high))
+
+    for x_map in x_maps:
+        x_map.flush()
+    return [(sha.hexdigest(), v_range) for sha, v_range in zip(shas, ranges)]
+
+
+def _read_areas(data_path: Path, targets: List[dict], block_size=64):
+    """
+    Read the data of a single subject for one or more areas, by blocks of epochs. Only the vertex range spanned by the
+    areas and the samples kept are read from a source store (same time axis for all the areas)
+    :param data_path: path to the source store or to the `.npy` file of the area
+    :param targets: see `_copy_areas`
+    :param block_size: number of epochs read at a time
+    :return:
+        generator of (first epoch of the block, [n_block_epochs x n_vertices x n_times, C-contiguous, per target])
+    """
+
+    t_start, t_stop = targets[0]["times"]
+
+    if data_path.suffix != ".dat":
+        arrays = [_load_stc(data_path, target["area"]) for target in targets]
+        for block_start in range(0, arrays[0].shape[0], block_size):
+            yield block_start, [np.ascontiguousarray(array[block_start: block_start + block_size, :, t_start: t_stop])
+                                for array in arrays]
+        return
+
+    store, index = read_store(data_path.parent, name=data_path.stem)
+    slices = [index["labels"][target["area"]] for target in targets]
+    low, high = min(start for start, _ in slices), max(stop for _, stop in slices)
+
+    for block_start in range(0, store.shape[0], block_size):
+        block = np.asarray(store[block_start: block_start + block_size, low: high, t_start: t_stop])
+        yield block_start, [np.ascontiguousarray(block[:, start - low: stop - low]) for start, stop in slices]
+
+
+def _init_target_hashes(data_path: Path, targets: List[dict]) -> list:
+    """
+    Start the hash of the data of a subject for every target, see `_init_hash`
+    :param data_path: path to the source store or to the `.npy` file of the area
+    :param targets: see `_copy_areas`
+    :return:
+        hashlib objects, one per target
+    """
+
+    if data_path.suffix == ".dat":
+        dtype = read_store_index(data_path.parent, name=data_path.stem)["dtype"]
+    else:
+        dtype = _load_stc(data_path, targets[0]["area"]).dtype
+
+    shas = []
+    for target in targets:
+        n_epochs, n_vertices, _ = _get_stc_shape(data_path, target["area"])
+        shas.append(_init_hash((n_epochs, n_vertices, target["times"][1] - target["times"][0]), dtype))
+    return shas
+
+
+def _init_hash(shape: tuple, dtype: np.dtype):
+    """
+    SHA-1 of the data of a subject, updated block by block in C order. Same digest as `get_array_hash` of the whole
+    array of the area (as stored by the source localization, before any conversion to the dtype of the dataset)
+    :param shape: shape of the data of the area
+    :param dtype: data type of the source data
+    :return:
+        hashlib object
+    """
+
+    sha = hashlib.sha1()
+    sha.update(str((np.dtype(dtype).str, tuple(int(n) for n in shape))).encode())
+    return sha
+
+
+def _write_epochs(x_map: np.memmap, layout: str, start: int, data: np.array) -> None:
+    """
+    Write consecutive epochs into a dataset
+    :param x_map: dataset memory map
+    :param layout: layout of the dataset, see `LAYOUTS`
+    :param start: index of the first epoch
+    :param data: n_epochs x n_vertices x n_times
+    """
+
+    if layout == "times":
+        x_map[:, start: start + data.shape[0]] = np.moveaxis(data, 2, 0)
+    else:
+        x_map[start: start + data.shape[0]] = data
 
-def _get_array_size(paths):
-    # todo comment
+
+def _quantize(data: np.array, scale) -> np.array:
+    """
+    Quantize epochs to int16, see `_set_scales`
+    :param data: n_epochs x n_vertices x n_times
+    :param scale: scale and offset per vertex, 2 x n_vertices. The data is returned as is if None
+    :return:
+        quantized data
+    """
+
+    if scale is None:
+        return data
+
+    data = (data - scale[1][:, None]) / scale[0][:, None]
+    return np.clip(np.rint(data), -INT16_MAX, INT16_MAX).astype("int16")
+
+
+def _check_container(layout: str, chunks) -> None:
+    """
+    Check the layout and the chunking of a dataset before anything is written, see `convert_to_chunked`
+    :param layout: layout of the memory map, see `LAYOUTS`
+    :param chunks: chunking of the dataset, None if not chunked
+    """
+
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, use one of {LAYOUTS}")
+    if chunks is not None and layout != "epochs":
+        raise ValueError("Only datasets in the epochs layout can be chunked, the chunks already give time access")
+
+
+def _chunk_dataset(dst_dir: Path, chunks: dict, n_jobs=1) -> None:
+    """
+    Convert a memory-mapped dataset to a compressed chunked dataset
+    :param dst_dir: directory of the dataset
+    :param chunks: dictionary with optional `trial-block`, `time-block`, `codec` and `shuffle`
+    :param n_jobs: number of threads compressing the chunks
+    """
+
+    convert_to_chunked(dst_dir, trial_block=chunks.get("trial-block", 64), time_block=chunks.get("time-block", 25),
+                       codec=chunks.get("codec", "zlib"), shuffle=chunks.get("shuffle", True), n_jobs=n_jobs)
+
+
+def _get_subject(path: Path) -> str:
+    """
+    Name of the subject a path belongs to
+    :param path: any path inside the directory of a subject
+    :return:
+        subject name, e.g. `sub-V1001`
+    """
+    return re.findall(r"sub-[AV]\d+", str(path))[0]
+
+
+def _get_array_size(paths, area_name: str):
+    """
+    Get the shape of the concatenation of all subjects from the headers only
+    :param paths: paths to the source stores or to the `.npy` files of the area
+    :param area_name: name of the area
+    :return:
+        (total number of epochs, n_vertices, n_times)
+    """
 
     dim_0 = 0
     dim_rest = None
     for path in paths:
-
-        # Read single x data
-        x = np.load(str(path))
-        shape = x.shape
-        del x
+        shape = _get_stc_shape(path, area_name)
 
         dim_0 += shape[0]
         if dim_rest is None:
@@ -182,12 +563,13 @@ def _get_reject_list(reject_path: Path):
     return reject_text.splitlines()
 
 
-def _generate_data(dst_dir: Path, data_paths: list, event_paths: list):
+def _generate_data(dst_dir: Path, data_paths: list, event_paths: list, area_name: str):
     """
     Generate data by concatenating all arrays
     :param dst_dir: path to directory to store the results
     :param data_paths: paths the source localization data
     :param event_paths: paths to events arrays
+    :param area_name: name of the area
     """
 
     x_list = []
@@ -199,7 +581,7 @@ def _generate_data(dst_dir: Path, data_paths: list, event_paths: list):
         logger.debug(f"Appending {data_path}")
 
         # Read x
-        x = np.load(str(data_path))
+        x = np.array(_load_stc(data_path, area_name))
 
         # Read y
         events = np.load(str(event_path))
@@ -224,18 +606,40 @@ def _generate_data(dst_dir: Path, data_paths: list, event_paths: list):
 
 
 def generate_dataset(epoch_dir: Path, dst_dir: Path, area_name: str, max_subjects=-1,
-                     memmap=True, reject=None) -> None:
+                     memmap=True, reject=None, summary=None, n_jobs=1, layout="epochs", chunks=None,
+                     time_range=None, dtype="float64", append=False) -> None:
     """
     :param epoch_dir: directory in which stc and epochs are stored
     :param dst_dir: directory in which to save the results
     :param area_name: name of the cortical area
-    :param memmap: if true, use memmap to store the results
+    :param memmap: if true, use memmap to store the results. Otherwise the data is saved to `x.npy` as read from the
+        source stores, the layout, chunks, time range, dtype and append options are refused
     :param max_subjects: maximum number of subjects to include, if negative use all available data
     :param reject: allows specific to reject subjects
+    :param summary: summary mode (`mean`, `mean_flip` or `pca_flip`). If given, the dataset is built from the label
+        summaries saved during source localization (n_epochs x n_components x n_times) instead of all the vertices
+    :param n_jobs: number of subjects copied in parallel into the memory map
+    :param layout: layout of the memory map, `epochs` (n_epochs x n_vertices x n_times, default) or `times`
+        (n_times x n_epochs x n_vertices, each time window is a contiguous read, see `get_slice`). Recorded in
+        `x_shape.json`
+    :param chunks: if given, the memory map is converted to a compressed chunked dataset (see `convert_to_chunked`),
+        dictionary with optional `trial-block`, `time-block`, `codec` and `shuffle`
+    :param time_range: (tmin, tmax) in seconds, tmax excluded. Only these samples are stored, e.g. the classification
+        period padded by the window size (see `get_time_range`). The time axis is recorded in `x_shape.json`
+    :param dtype: data type of the memory map, `float64`, `float32` or `int16`. `int16` datasets are quantized with a
+        scale and an offset per vertex (`x_scale.npy`), the slices are converted back when they are read (see
+        `dequantize`)
+    :param append: if true and the dataset exists, only the subjects that are not in it yet are added, see
+        `append_dataset`. The other options must be the ones the dataset was generated with
     :return:
     """
 
     logger.debug(f"Generating dataset for {area_name}")
+    _check_container(layout, chunks)
+    if not memmap and (layout != "epochs" or chunks is not None or time_range is not None or dtype != "float64"
+                       or append):
+        raise ValueError("The layout, chunks, time_range, dtype and append options need `memmap=True`, `x.npy` "
+                         "datasets keep all the samples in the dtype of the source stores")
 
     # Get list of subjects to ignore
     if reject is not None:
@@ -243,10 +647,11 @@ def generate_dataset(epoch_dir: Path, dst_dir: Path, area_name: str, max_subject
     else:
         reject_list = []
 
-    # List of path to event.npy
-    events_paths = _get_events_paths(epoch_dir, reject_list)
-    stc_paths = _get_stc_paths(epoch_dir, area_name, reject_list)
-    stc_paths, events_paths = _validate_paths(stc_paths, events_paths)
+    # Subjects with their events and source data, from the manifest and the subject directories
+    subjects = _index_epoch_dir(epoch_dir, reject_list, summary=summary)
+    area_subjects = [subject for subject in subjects if area_name in subjects[subject]["areas"]]
+    stc_paths = [subjects[subject]["areas"][area_name] for subject in area_subjects]
+    events_paths = [subjects[subject]["events"] for subject in area_subjects]
 
     if 0 < max_subjects < len(events_paths):
         events_paths = events_paths[:max_subjects]
@@ -254,9 +659,399 @@ def generate_dataset(epoch_dir: Path, dst_dir: Path, area_name: str, max_subject
         logger.info(f"Using {max_subjects} subject data")
 
     # Generate x array
-    if memmap:
-        _generate_mmap(dst_dir, stc_paths, events_paths)
+    if append and (dst_dir / "x_shape.json").exists():
+        append_dataset(dst_dir, stc_paths, events_paths, area_name, n_jobs=n_jobs, summary=summary, layout=layout,
+                       chunks=chunks, time_range=time_range, dtype=dtype)
+    elif memmap:
+        _generate_mmap(dst_dir, stc_paths, events_paths, area_name, summary=summary, n_jobs=n_jobs, layout=layout,
+                       time_range=time_range, dtype=dtype)
+        if chunks is not None:
+            _chunk_dataset(dst_dir, chunks, n_jobs=n_jobs)
     else:
-        _generate_data(dst_dir, stc_paths, events_paths)
+        _generate_data(dst_dir, stc_paths, events_paths, area_name)
+    logger.info("Process terminated")
+
+
+########################################################################################################################
+# ALL AREAS                                                                                                            #
+########################################################################################################################
+# The epochs directory is indexed once (from its manifest if it has one), subjects are paired with their events once,  #
+# and each source store is streamed once per group of areas (a single time if all the areas are in flight together).   #
+########################################################################################################################
+
+
+def _index_epoch_dir(epoch_dir: Path, reject_list: List[str], summary=None) -> dict:
+    """
+    List the subjects of the epochs directory with their events and the areas of their source localization. If the
+    directory has a manifest (see `src.utils.manifest`), the subjects are the ones it records and the directory is not
+    listed: subjects processed without the manifest must be added with `build_manifest`. Recorded subjects without
+    events or without the store are looked up in their directory (e.g. `.npy` files of older subjects). Without a
+    manifest, every subject directory is looked up.
+    :param epoch_dir: directory containing all epochs
+    :param reject_list: subjects to ignore
+    :param summary: summary mode (e.g. `mean_flip`) to use the label summary stores instead of the vertices
+    :return:
+        {subject: {"events": path to the events array, "areas": {area name: path to the source store or `.npy`}}},
+        subjects in sorted order
+    """
+
+    manifest = read_manifest(epoch_dir)
+    store_name = get_summary_store_name(summary) if summary else STORE_NAME
+
+    # Sorted, the order decides which subjects are kept with `max_subjects`
+    names = sorted(manifest) if manifest else sorted(os.listdir(epoch_dir))
+
+    subjects, n_indexed = {}, 0
+    for name in names:   # e.g. "sub-V1001"
+
+        # Skip rejected subjects and hidden files
+        if name in reject_list or not re.match(r"^sub-[AV]\d+$", name):
+            continue
+
+        subject = _index_manifest(epoch_dir, manifest[name], store_name) if manifest else None
+        if subject is not None:
+            n_indexed += 1
+        else:
+            subject = _index_subject_dir(epoch_dir / name, summary=summary)
+            if subject is not None and manifest:
+                logger.warning(f"The records of {name} in the manifest of {epoch_dir} are incomplete, read from its "
+                               f"directory")
+
+        if subject is not None:
+            subjects[name] = subject
+
+    logger.info(f"Found {len(subjects)} subjects with events and source reconstruction, {n_indexed} in the manifest")
+    return subjects
+
+
+def _index_subject_dir(subject_dir: Path, summary=None) -> Union[dict, None]:
+    """
+    Events and areas of a subject, from its directory
+    :param subject_dir: directory of the subject, e.g. `epochs-dir/sub-V1001`
+    :param summary: summary mode (e.g. `mean_flip`) to use the label summary stores instead of the vertices
+    :return:
+        {"events": path to the events array, "areas": {area name: path to the source store or `.npy`}}, None if the
+        events or the source reconstruction are missing
+    """
+
+    store_name = get_summary_store_name(summary) if summary else STORE_NAME
+
+    events_path = subject_dir / "events.npy"
+    stc_dir = subject_dir / "stc"
+    if not events_path.exists() or not stc_dir.exists():
+        logger.debug(f"events or source reconstruction not found in {subject_dir}. Skipping...")
+        return None
+
+    areas = {}
+    if not summary:
+        areas.update({fname[:-len(".npy")]: stc_dir / fname for fname in os.listdir(stc_dir)
+                      if fname.endswith(".npy")})
+
+    index = read_store_index(stc_dir, name=store_name)
+    if index is not None:
+        areas.update({name: stc_dir / f"{store_name}.dat" for name in index["labels"]})
+
+    return {"events": events_path, "areas": areas}
+
+
+def _index_manifest(epoch_dir: Path, records: dict, store_name: str) -> Union[dict, None]:
+    """
+    Same as `_index_subject_dir`, from the manifest records of the subject. The recorded paths are trusted, nothing
+    is looked up on disk
+    :param epoch_dir: directory containing all epochs
+    :param records: records of the subject, see `read_manifest`
+    :param store_name: name of the source store
+    :return:
+        {"events": path to the events array, "areas": {area name: path to the source store}}, None if the events or
+        the store are not recorded
+    """
+
+    if "events" not in records or store_name not in records.get("stores", {}):
+        return None
+
+    store = records["stores"][store_name]
+    store_path = epoch_dir / store["path"]
+    return {"events": epoch_dir / records["events"]["path"],
+            "areas": {name: store_path for name in store["labels"]}}
+
+
+def generate_all_datasets(epoch_dir: Path, dst_dir: Path, area_names=None, max_subjects=-1, reject=None,
+                          summary=None, n_areas=8, n_jobs=1, layout="epochs", chunks=None, time_range=None,
+                          dtype="float64", append=False) -> None:
+    """
+    Generate the memory-mapped datasets of many areas at once, in `dst_dir/<area name>`. Same outputs as
+    `generate_dataset`, without listing the epochs directory and reading the source stores once per area.
+    :param epoch_dir: directory in which stc and epochs are stored
+    :param dst_dir: directory in which to save the datasets, one sub-directory per area
+    :param area_names: names of the areas, all the areas found in the source stores if None
+    :param max_subjects: maximum number of subjects to include per area, if negative use all available data
+    :param reject: allows specific to reject subjects
+    :param summary: summary mode (`mean`, `mean_flip` or `pca_flip`), see `generate_dataset`
+    :param n_areas: number of areas in flight, i.e. written during the same pass over the subjects
+    :param n_jobs: number of subjects processed in parallel
+    :param layout: layout of the memory maps, see `generate_dataset`
+    :param chunks: chunking of the datasets, see `generate_dataset`
+    :param time_range: time range to crop the datasets to, see `generate_dataset`
+    :param dtype: data type of the memory maps, see `generate_dataset`
+    :param append: if true, the new subjects are appended to the existing datasets (area by area), see
+        `generate_dataset`
+    """
+
+    _check_container(layout, chunks)
+
+    reject_list = _get_reject_list(reject) if reject is not None else []
+    subjects = _index_epoch_dir(epoch_dir, reject_list, summary=summary)
+
+    if area_names is None:
+        area_names = list(dict.fromkeys(name for subject in subjects.values() for name in subject["areas"]))
+
+    logger.info(f"Generating datasets for {len(area_names)} areas, {n_areas} at a time")
+
+    for group_start in range(0, len(area_names), n_areas):
+        group = area_names[group_start: group_start + n_areas]
+
+        # Preallocate the datasets of the group
+        plans = []
+        for area_name in group:
+            area_subjects = [subject for subject in subjects if area_name in subjects[subject]["areas"]]
+            if 0 < max_subjects < len(area_subjects):
+                area_subjects = area_subjects[:max_subjects]
+
+            if not area_subjects:
+                logger.info(f"No source reconstruction data for {area_name}. Skipping...")
+                continue
+
+            area_dir = dst_dir / area_name
+            if not area_dir.exists():
+                os.makedirs(area_dir)
+
+            if append and (area_dir / "x_shape.json").exists():
+                append_dataset(area_dir, data_paths=[subjects[s]["areas"][area_name] for s in area_subjects],
+                               event_paths=[subjects[s]["events"] for s in area_subjects], area_name=area_name,
+                               n_jobs=n_jobs, summary=summary, layout=layout, chunks=chunks, time_range=time_range,
+                               dtype=dtype)
+                continue
+
+            plans.append(_plan_dataset(area_dir, data_paths=[subjects[s]["areas"][area_name] for s in area_subjects],
+                                       event_paths=[subjects[s]["events"] for s in area_subjects],
+                                       area_name=area_name, layout=layout, time_range=time_range, dtype=dtype))
+        _set_scales(plans, n_jobs=n_jobs)
+
+        # Group the targets by source file, so that each file is read once for the whole group
+        file_targets = _group_targets(plans)
+
+        logger.info(f"Copying {len(file_targets)} files into {len(plans)} datasets with {n_jobs} jobs")
+        parallel_funcs = [delayed(_copy_areas)(data_path=data_path, targets=targets)
+                          for data_path, targets in file_targets.items()]
+        parallel_pool = Parallel(n_jobs=n_jobs)
+        _set_hashes(plans, file_targets, parallel_pool(parallel_funcs))
+
+        for plan in plans:
+            _write_dataset_meta(plan, summary=summary)
+            if chunks is not None:
+                _chunk_dataset(plan["dst-dir"], chunks, n_jobs=n_jobs)
+
     logger.info("Process terminated")
 
+
+########################################################################################################################
+# INCREMENTAL UPDATES                                                                                                  #
+########################################################################################################################
+# New subjects are appended at the end of `x.dat`, the rows of the other subjects are not touched. The file is grown,  #
+# then the new subjects are copied, hashed and (int16 datasets) range-checked in a single pass over their source data. #
+# A subject with the content of a subject of the dataset is refused and the file is cut back to its previous size.     #
+# Then `y.npy` and `x_shape.json` are replaced (renames), the metadata last: a dataset interrupted in between still    #
+# reads as the previous version, the extra rows are overwritten by the next append.                                    #
+########################################################################################################################
+
+
+def append_dataset(dst_dir: Path, data_paths: List[Path], event_paths: List[Path], area_name: str, n_jobs=1,
+                   summary=None, layout="epochs", chunks=None, time_range=None, dtype="float64") -> None:
+    """
+    Append new subjects to a memory-mapped dataset (`epochs` layout, not chunked). Subjects already in the dataset are
+    skipped. A subject with the same content as a subject of the dataset (see `_copy_areas`) is refused. The options
+    must be the ones the dataset was generated with (see `_check_append_options`): int16 data of the new subjects is
+    quantized with the scales of the dataset and clipped to their range. The conditions (`y.npy` and `included.npy` of
+    each condition) need to be made again.
+    :param dst_dir: directory of the dataset
+    :param data_paths: paths to the source stores or to the `.npy` files of the area, may include subjects that are
+        already in the dataset
+    :param event_paths: paths to events arrays
+    :param area_name: name of the area
+    :param n_jobs: number of subjects copied at the same time
+    :param summary: summary mode, see `generate_dataset`
+    :param layout: layout of the memory map, see `generate_dataset`
+    :param chunks: chunking of the dataset, see `generate_dataset`
+    :param time_range: time range the dataset was cropped to, see `generate_dataset`
+    :param dtype: data type of the memory map, see `generate_dataset`
+    """
+
+    meta = load_json(dst_dir / "x_shape.json")
+    if meta.get("layout", "epochs") != "epochs" or meta.get("container") == "chunked":
+        raise ValueError(f"Cannot append to {dst_dir}, only memory maps in the epochs layout can grow. Generate the "
+                         f"dataset again")
+    if "subjects" not in meta:
+        raise ValueError(f"The dataset in {dst_dir} does not record its subjects (generated by an older version). "
+                         f"Generate the dataset again to append to it")
+
+    new = [(data_path, event_path) for data_path, event_path in zip(data_paths, event_paths)
+           if _get_subject(data_path) not in meta["subjects"]]
+    if not new:
+        logger.info(f"No new subject for {dst_dir}")
+        return
+    data_paths, event_paths = [data_path for data_path, _ in new], [event_path for _, event_path in new]
+
+    _check_append_options(dst_dir, meta, data_paths, area_name, summary=summary, layout=layout, chunks=chunks,
+                          time_range=time_range, dtype=dtype)
+
+    n_vertices = meta["shape"][1]
+    source_meta = _get_source_meta(data_paths)
+    dataset_meta = {key: meta.get(key, value) for key, value in source_meta.items()}
+    if dataset_meta != source_meta:
+        raise ValueError(f"The new subjects were extracted with {source_meta}, the dataset with {dataset_meta}")
+
+    plan = _plan_append(dst_dir, data_paths, event_paths, area_name, meta)
+    if plan["shape"][1] != n_vertices:
+        raise ValueError(f"The new subjects have {plan['shape'][1]} vertices, the dataset {n_vertices}")
+
+    # Grow `x.dat`, the rows of the new subjects are after the ones recorded in the metadata
+    x_path = dst_dir / "x.dat"
+    size = os.path.getsize(x_path)
+    os.truncate(x_path, np.dtype(plan["dtype"]).itemsize * int(np.prod(plan["shape"])))
+
+    # Copy, hash and get the range of the new subjects in one pass over their data
+    logger.info(f"Appending {len(data_paths)} subjects to {dst_dir} with {n_jobs} jobs")
+    file_targets = _group_targets([plan])
+    try:
+        results = Parallel(n_jobs=n_jobs)(delayed(_copy_areas)(data_path=data_path, targets=targets,
+                                                               get_range=plan["scale"] is not None)
+                                          for data_path, targets in file_targets.items())
+        _set_hashes([plan], file_targets, results)
+
+        # Refuse the subjects that are already in the dataset under another name
+        hashes = dict(meta.get("hashes", {}))
+        for subject, data_hash in plan["hashes"].items():
+            duplicates = [other for other, other_hash in hashes.items() if other_hash == data_hash]
+            if duplicates:
+                raise ValueError(f"{subject} has the same data as {duplicates[0]}, nothing was appended")
+            hashes[subject] = data_hash
+    except BaseException:
+        os.truncate(x_path, size)
+        raise
+
+    if plan["scale"] is not None:
+        _check_scale_range(plan["scale"], [[v_range for _, v_range in file_results] for file_results in results])
+
+    # Commit: y first, the metadata last
+    y = np.concatenate([np.load(str(dst_dir / "y.npy")), plan["y"]])
+    tmp_fname = f".y.{os.getpid()}.npy"
+    np.save(str(dst_dir / tmp_fname), y)
+    os.replace(dst_dir / tmp_fname, dst_dir / "y.npy")
+
+    bounds = plan["bounds"]
+    meta["shape"] = list(plan["shape"])
+    meta["subjects"].update({_get_subject(data_path): [start, stop]
+                             for data_path, start, stop in zip(data_paths, bounds[:-1], bounds[1:])})
+    meta["hashes"] = hashes
+
+    tmp_fname = f".x_shape.{os.getpid()}.json"
+    write_json(dst_dir, file_name=tmp_fname, data=meta)
+    os.replace(dst_dir / tmp_fname, dst_dir / "x_shape.json")
+
+    logger.info(f"{len(data_paths)} subjects appended to {dst_dir}, {plan['shape'][0]} epochs in total")
+
+
+def _check_append_options(dst_dir: Path, meta: dict, data_paths: List[Path], area_name: str, summary=None,
+                          layout="epochs", chunks=None, time_range=None, dtype="float64") -> None:
+    """
+    Refuse to append to a dataset with other options than the ones it was generated with, the new rows would not
+    match the other ones
+    :param dst_dir: directory of the dataset
+    :param meta: metadata of the dataset
+    :param data_paths: paths to the source data of the new subjects
+    :param area_name: name of the area
+    :param summary: summary mode, see `generate_dataset`
+    :param layout: layout of the memory map, see `generate_dataset`
+    :param chunks: chunking of the dataset, see `generate_dataset`
+    :param time_range: time range to crop the data to, see `generate_dataset`
+    :param dtype: data type of the memory map, see `generate_dataset`
+    """
+
+    options = {"summary": (summary, meta.get("summary")), "layout": (layout, meta.get("layout", "epochs")),
+               "dtype": (dtype, meta.get("dtype", "float64")),
+               "chunks": (chunks is not None, meta.get("container") == "chunked")}
+    mismatches = [f"{name}={value}" for name, (value, dataset_value) in options.items() if value != dataset_value]
+
+    # The crop of the new subjects must give the time axis of the dataset
+    time_meta = _get_time_meta(data_paths)
+    start, stop = _get_crop(time_meta, _get_stc_shape(data_paths[0], area_name)[2], time_range)
+    if stop - start != meta["shape"][2] or \
+            (time_meta and "tmin" in meta and not np.isclose(time_meta["tmin"] + start / time_meta["sfreq"],
+                                                             meta["tmin"])):
+        mismatches.append(f"time_range={time_range}")
+
+    if mismatches:
+        raise ValueError(f"Cannot append to {dst_dir} with {', '.join(mismatches)}, the dataset was generated with "
+                         f"other options. Use the same options or generate the dataset again")
+
+
+def _check_scale_range(scale: np.array, ranges: list) -> None:
+    """
+    Warn when the data of new subjects exceeds the range of the quantization of a dataset, the values are clipped
+    :param scale: scale and offset per vertex, see `_set_scales`
+    :param ranges: (min, max) per vertex of every target of every new subject file, see `_get_vertex_range`
+    """
+
+    low, high = scale[1] - scale[0] * INT16_MAX, scale[1] + scale[0] * INT16_MAX
+    n_clipped = sum(int(np.sum((v_min < low) | (v_max > high)))
+                    for file_ranges in ranges for v_min, v_max in file_ranges)
+    if n_clipped:
+        logger.warning(f"{n_clipped} vertices of the new subjects exceed the int16 range of the dataset and are "
+                       f"clipped. Generate the dataset again to quantize all the subjects together")
+
+
+def _plan_append(dst_dir: Path, data_paths: List[Path], event_paths: List[Path], area_name: str, meta: dict) -> dict:
+    """
+    Plan of the rows of new subjects, after the rows of the dataset, see `_plan_dataset`
+    :param dst_dir: directory of the dataset
+    :param data_paths: paths to the source data of the new subjects
+    :param event_paths: paths to the events arrays of the new subjects
+    :param area_name: name of the area
+    :param meta: metadata of the dataset
+    :return:
+        plan of the new rows, with the shape of the grown dataset
+    """
+
+    n_epochs, _, n_times = meta["shape"]
+
+    # Samples matching the time axis of the dataset
+    time_meta = _get_time_meta(data_paths)
+    n_src_times = _get_stc_shape(data_paths[0], area_name)[2]
+    if "tmin" in meta:
+        if not time_meta or not np.isclose(time_meta["sfreq"], meta["sfreq"]):
+            raise ValueError(f"The time axis of the new subjects {time_meta} does not match the dataset")
+        start = int(round((meta["tmin"] - time_meta["tmin"]) * meta["sfreq"]))
+    else:
+        start = 0
+    times = (start, start + n_times)
+    if start < 0 or times[1] > n_src_times:
+        raise ValueError(f"The new subjects have {n_src_times} samples, the dataset needs samples {times}")
+
+    y_list, bounds = [], [n_epochs]
+    for data_path, event_path in zip(data_paths, event_paths):
+        n_subject_epochs = _get_stc_shape(data_path, area_name)[0]
+
+        y = np.load(str(event_path))[:, 2]
+        if n_subject_epochs != y.shape[0]:
+            raise ValueError(f"The numbers of epochs for x {n_subject_epochs} and y {y.shape[0]} are different")
+
+        y_list.append(y)
+        bounds.append(bounds[-1] + n_subject_epochs)
+
+    dtype = meta.get("dtype", "float64")
+    scale = np.load(str(dst_dir / SCALE_FNAME)) if dtype == "int16" else None
+    n_vertices = _get_stc_shape(data_paths[0], area_name)[1]
+
+    return {"dst-dir": dst_dir, "area": area_name, "shape": (bounds[-1], n_vertices, n_times), "layout": "epochs",
+            "dtype": dtype, "scale": scale, "times": times, "data-paths": data_paths, "bounds": bounds,
+            "y": np.hstack(y_list), "source-meta": {}, "hashes": {}}
@@ -0,0 +1,325 @@
+import logging
+from typing import List, Iterator, Tuple
+
+import numpy as np
+
+from mne import Epochs, Label
+from mne.forward import is_fixed_orient
+from mne.minimum_norm import prepare_inverse_operator
+from mne.minimum_norm.inverse import _assemble_kernel
+
+from src.utils.fsaverage import get_label_rows
+from src.utils.logger import get_logger
+
+logger = get_logger(file_name="label-operator")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# LABEL OPERATOR                                                                                                       #
+########################################################################################################################
+# For a fixed subject and a fixed `lambda2` the inverse solution is a matrix product, and the morph to fsaverage is a  #
+# sparse matrix. Both are restricted to the vertices of the labels of interest and applied to batches of epochs,       #
+# instead of building one SourceEstimate per epoch.                                                                    #
+########################################################################################################################
+
+
+class LabelOperator:
+    """
+    Maps sensor data of a subject to the fsaverage source activity of a set of labels.
+
+    With fixed orientations (or `pick_ori="normal"`) the inverse kernel, the noise normalization and the morph are
+    precomposed into a single (n_label_vertices x n_channels) matrix. With free orientations the current components are
+    combined non-linearly, so the kernel (restricted to the sources the labels depend on) and the sparse morph are
+    applied one after the other.
+    """
+
+    def __init__(self, inv, morph, label_rows: dict, method="dSPM", snr=3., pick_ori=None, dtype="float64"):
+        """
+        :param inv: inverse operator, as returned by `get_inv`
+        :param morph: morph from the subject to fsaverage, `SourceMorph` or `FsaverageMorph` (see `get_morph`)
+        :param label_rows: {label name: rows of the fsaverage source estimate}, see `get_label_rows` and
+            `FsaverageResources.get_label_rows`
+        :param method: source estimation method
+        :param snr: signal to noise ratio
+        :param pick_ori: `None` or `normal`
+        :param dtype: dtype of the operator and of the results, `float64` or `float32`
+        """
+
+        if pick_ori not in (None, "normal"):
+            raise ValueError(f"pick_ori={pick_ori} is not supported, use None or 'normal'")
+
+        self.dtype = np.dtype(dtype)
+
+        # Same preparation as `apply_inverse_epochs`
+        lambda2 = 1. / snr ** 2
+        inv = prepare_inverse_operator(inv, nave=1, lambda2=lambda2, method=method, verbose=False)
+        kernel, noise_norm, _, _ = _assemble_kernel(inv, None, method, pick_ori, verbose=False)
+
+        self.ch_names = list(inv["noise_cov"].ch_names)
+        self.is_free_ori = not (is_fixed_orient(inv) or pick_ori == "normal")
+
+        # Rows of the fsaverage source estimate, label after label
+        self.names, self.slices, rows = [], [], []
+        offset = 0
+        for name, label_rows in label_rows.items():
+            self.names.append(name)
+            self.slices.append(slice(offset, offset + label_rows.size))
+            rows.append(label_rows)
+            offset += label_rows.size
+        rows = np.concatenate(rows) if rows else np.zeros((0,), dtype=int)
+
+        # Only the subject sources that contribute to the labels are needed
+        morph_mat = morph.morph_mat.tocsr()[rows]
+        sources = np.unique(morph_mat.indices)
+        morph_mat = morph_mat[:, sources]
+
+        if noise_norm is not None:
+            noise_norm = noise_norm[sources]
+
+        if self.is_free_ori:
+            n_channels = kernel.shape[1]
+            self.kernel = kernel.reshape(-1, 3, n_channels)[sources].reshape(-1, n_channels).astype(self.dtype)
+            self.noise_norm = noise_norm.astype(self.dtype) if noise_norm is not None else None
+            self.morph_mat = morph_mat.astype(self.dtype)
+        else:
+            kernel = kernel[sources]
+            if noise_norm is not None:
+                kernel *= noise_norm
+            self.kernel = np.asarray(morph_mat @ kernel, dtype=self.dtype)
+            self.noise_norm = None
+            self.morph_mat = None
+
+        logger.info(f"Label operator for {len(self.names)} labels, {offset} vertices and {sources.size} sources")
+
+    @classmethod
+    def from_labels(cls, inv, morph, labels: List[Label], **kwargs):
+        """
+        Build the operator from labels, e.g. as returned by `read_labels_from_annot`
+        :param inv: inverse operator
+        :param morph: morph from the subject to fsaverage
+        :param labels: fsaverage labels
+        :param kwargs: see `__init__`
+        :return:
+            LabelOperator
+        """
+
+        label_rows = {label.name: get_label_rows(morph.vertices_to, label) for label in labels}
+        return cls(inv, morph, label_rows, **kwargs)
+
+    @property
+    def n_vertices(self) -> int:
+        """
+        Total number of label vertices in the output
+        """
+        return self.slices[-1].stop if self.slices else 0
+
+    def pick_channels(self, ch_names: List[str]) -> List[int]:
+        """
+        Indices of the channels used by the inverse operator, in the order the operator expects
+        :param ch_names: channel names of the data
+        :return:
+            list of indices
+        """
+
+        missing = [name for name in self.ch_names if name not in ch_names]
+        if missing:
+            raise ValueError(f"The inverse operator was computed with channels {missing} not present in the data")
+
+        return [ch_names.index(name) for name in self.ch_names]
+
+    def apply(self, data: np.array) -> np.array:
+        """
+        Apply the operator to a batch of epochs
+        :param data: sensor data, n_epochs x n_channels x n_times, channels already picked with `pick_channels`
+        :return:
+            source data, n_epochs x n_label_vertices x n_times
+        """
+
+        data = np.asarray(data, dtype=self.dtype)
+        sol = np.matmul(self.kernel, data)  # one BLAS call per epoch, no python objects per epoch
+
+        if not self.is_free_ori:
+            return sol
+
+        # Combine the current components, same as `combine_xyz`
+        n_epochs, _, n_times = sol.shape
+        sol = sol.reshape(n_epochs, -1, 3, n_times)
+        sol = np.sqrt(np.einsum("esot,esot->est", sol, sol))
+
+        if self.noise_norm is not None:
+            sol *= self.noise_norm
+
+        # Morph all epochs at once: sources x (epochs * times)
+        n_sources = sol.shape[1]
+        sol = sol.transpose(1, 0, 2).reshape(n_sources, -1)
+        sol = np.asarray(self.morph_mat @ sol, dtype=self.dtype)
+        return sol.reshape(-1, n_epochs, n_times).transpose(1, 0, 2)
+
+    def apply_epochs(self, epochs: Epochs, batch_size=32) -> Iterator[Tuple[int, int, np.array]]:
+        """
+        Apply the operator to all the epochs, in batches
+        :param epochs: preloaded epochs object
+        :param batch_size: number of epochs per batch
+        :return:
+            generator of (start index, stop index, n_epochs x n_label_vertices x n_times array)
+        """
+
+        picks = self.pick_channels(epochs.ch_names)
+        data = epochs.get_data()
+
+        for start in range(0, data.shape[0], batch_size):
+            stop = min(start + batch_size, data.shape[0])
+            yield start, stop, self.apply(data[start: stop, picks])
+
+    def split(self, data: np.array) -> dict:
+        """
+        Split the output of `apply` into label arrays (views, no copy)
+        :param data: n_epochs x n_label_vertices x n_times
+        :return:
+            {label name: n_epochs x n_vertices x n_times}
+        """
+        return {name: data[:, sl] for name, sl in zip(self.names, self.slices)}
+
+
+########################################################################################################################
+# LABEL SUMMARY                                                                                                        #
+########################################################################################################################
+# Compact alternative to keeping every vertex: each label is reduced to a few time courses, the same way as            #
+# `mne.extract_label_time_course`, directly on the batches produced by the label operator.                             #
+########################################################################################################################
+
+SUMMARY_MODES = ("mean", "mean_flip", "pca_flip")
+
+
+def get_sign_flip(normals: np.array) -> np.array:
+    """
+    Sign flip of the vertices of a label, same as `mne.label_sign_flip`
+    :param normals: surface normals of the label vertices, n_vertices x 3
+    :return:
+        array of +1 / -1 of shape (n_vertices,)
+    """
+
+    if len(normals) == 0:
+        return np.zeros((0,))
+
+    _, _, vh = np.linalg.svd(normals, full_matrices=False)
+
+    # The sign of vh is ambiguous, align it to the mean (outward) direction
+    dots = normals @ vh[0]
+    if np.mean(dots) < 0:
+        dots *= -1
+    return np.sign(dots)
+
+
+class LabelSummary:
+    """
+    Summarizes the output of a `LabelOperator` label by label:
+        - `mean`: average over the vertices
+        - `mean_flip`: average over the vertices after flipping the sign of the vertices whose normal points against
+          the dominant direction of the label
+        - `pca_flip`: first `n_components` right singular vectors of the vertices x times data of every epoch, with
+          the sign and the scaling of `mne.extract_label_time_course` (the first component is identical to mne)
+    """
+
+    def __init__(self, names: List[str], slices: List[slice], mode="mean_flip", normals=None, n_components=1,
+                 dtype="float64"):
+        """
+        :param names: label names, as in `LabelOperator.names`
+        :param slices: vertex slices of the labels, as in `LabelOperator.slices`
+        :param mode: `mean`, `mean_flip` or `pca_flip`
+        :param normals: surface normals of the vertices of the operator output, n_vertices x 3. Required by the
+            flip modes
+        :param n_components: number of time courses per label, only `pca_flip` supports more than one
+        :param dtype: dtype of the results
+        """
+
+        if mode not in SUMMARY_MODES:
+            raise ValueError(f"Unknown summary mode {mode}, use one of {SUMMARY_MODES}")
+        if mode != "pca_flip" and n_components != 1:
+            raise ValueError(f"Summary mode {mode} gives a single component per label")
+        if mode.endswith("flip") and normals is None:
+            raise ValueError(f"Summary mode {mode} requires the normals of the vertices")
+
+        self.names = list(names)
+        self.slices = list(slices)
+        self.mode = mode
+        self.n_components = n_components
+        self.dtype = np.dtype(dtype)
+        self.flips = [get_sign_flip(np.asarray(normals[sl])) for sl in self.slices] if normals is not None else None
+
+    @classmethod
+    def from_operator(cls, operator: LabelOperator, **kwargs):
+        """
+        Build the summary of the labels of an operator
+        :param operator: label operator
+        :param kwargs: see `__init__`
+        :return:
+            LabelSummary
+        """
+        return cls(operator.names, operator.slices, dtype=operator.dtype, **kwargs)
+
+    @property
+    def n_outputs(self) -> int:
+        """
+        Total number of time courses in the output
+        """
+        return len(self.names) * self.n_components
+
+    @property
+    def label_slices(self) -> dict:
+        """
+        Position of the time courses of every label in the output
+        :return:
+            {label name: (start, stop)}
+        """
+        return {name: (idx * self.n_components, (idx + 1) * self.n_components) for idx, name in enumerate(self.names)}
+
+    def apply(self, data: np.array) -> np.array:
+        """
+        Summarize a batch of label operator output
+        :param data: n_epochs x n_label_vertices x n_times, as returned by `LabelOperator.apply`
+        :return:
+            n_epochs x (n_labels * n_components) x n_times
+        """
+
+        n_epochs, _, n_times = data.shape
+        out = np.zeros((n_epochs, self.n_outputs, n_times), dtype=self.dtype)
+
+        for idx, sl in enumerate(self.slices):
+            label_data = data[:, sl]
+            if label_data.shape[1] == 0:
+                continue
+
+            start = idx * self.n_components
+            if self.mode == "mean":
+                out[:, start] = label_data.mean(axis=1)
+            elif self.mode == "mean_flip":
+                out[:, start] = np.einsum("v,evt->et", self.flips[idx], label_data) / label_data.shape[1]
+            else:
+                out[:, start: start + self.n_components] = self._pca_flip(label_data, self.flips[idx])
+
+        return out
+
+    def _pca_flip(self, label_data: np.array, flip: np.array) -> np.array:
+        """
+        Batched `pca_flip`, one SVD per epoch
+        :param label_data: n_epochs x n_vertices x n_times
+        :param flip: sign flip of the vertices
+        :return:
+            n_epochs x n_components x n_times
+        """
+
+        u, s, vh = np.linalg.svd(label_data, full_matrices=False)
+        n_components = min(self.n_components, s.shape[1])
+
+        # Sign of each component from its alignment with the flip, scaling by the average power in the label
+        sign = np.sign(np.einsum("evc,v->ec", u[:, :, :n_components], flip))
+        scale = np.linalg.norm(s, axis=1, keepdims=True) / np.sqrt(label_data.shape[1])
+
+        # Further components keep their size relative to the first one
+        ratio = np.divide(s[:, :n_components], s[:, :1], out=np.zeros_like(s[:, :n_components]),
+                          where=s[:, :1] > 0)
+
+        out = np.zeros((label_data.shape[0], self.n_components, label_data.shape[2]), dtype=self.dtype)
+        out[:, :n_components] = (sign * scale * ratio)[:, :, np.newaxis] * vh[:, :n_components]
+        return out
@@ -6,18 +6,16 @@ import traceback
 from pathlib import Path
 from typing import Callable, Tuple
 import numpy as np
-from mne import (compute_covariance, read_labels_from_annot,
-                 find_events, Epochs, Evoked, Label, read_forward_solution,
-                 read_source_spaces, compute_source_morph)
+from mne import find_events, Epochs
 
-from joblib import Parallel, delayed
 from mne.io import Raw
 from mne.preprocessing import ICA
-from mne.minimum_norm import make_inverse_operator, apply_inverse, apply_inverse_epochs
 from src.events.formatting import get_event_array, select_conditions
+from src.processing.source_localization import source_localize as _source_localize
 from src.utils.exceptions import SubjectNotProcessedError
 from src.utils.file_access import read_mous_subject, get_mous_meg_channels, read_raw
 from src.utils.logger import get_logger
+from src.utils.manifest import record_epochs, record_events
 
 logger = get_logger(file_name="filter")
 
@@ -192,6 +190,12 @@ def epoch(dst_dir: Path, events_dir: Path, subject: str,
     fname = "events.npy"
     np.save(str(dst_dir / fname), epochs.events)
 
+    # Keep the manifest of the epochs directory up to date
+    epochs_path = dst_dir / f"{subject}-epo.fif"
+    if epochs_path.exists():
+        record_epochs(dst_dir.parent, subject, epochs_path, n_epochs=len(epochs))
+    record_events(dst_dir.parent, subject, dst_dir / fname)
+
     return epochs
 
 
@@ -253,237 +257,24 @@ def _save_epochs(epochs: Epochs, subject: str, dst_dir: Path) -> None:
 ########################################################################################################################
 
 
-def source_localize(dst_dir: Path, subject: str, epochs: Epochs, params: dict, n_jobs=1) -> None:
-    """
-    todo commet
-    :param dst_dir:
-    :param subject:
-    :param epochs:
-    :param params:
-    :param n_jobs:
-    :return:
-    """
-
-    logger.info(f"Source localizing {subject} files")
-
-    # Make inverse model
-    logger.info(f"Making an inverse model for the subject {subject} ")
-    inv = get_inv(epochs, fwd_path=str(Path(params["fwd_path"]) / f"{subject}-fwd.fif"), n_jobs=n_jobs)
-
-    # Common source space
-    logger.info(f"Setting up morph to FS average")
-    fsaverage_src_path = Path(params["subjects dir"]) / "fsaverage" / "bem" / "fsaverage-ico-5-src.fif"
-    fs_src = read_source_spaces(str(fsaverage_src_path))
-    morph = compute_source_morph(src=inv["src"], subject_from=subject, subject_to="fsaverage", src_to=fs_src,
-                                 subjects_dir=params["subjects dir"], verbose=False)
-
-    # Generate set of labels
-    logger.info(f"Reading labels")
-    labels = read_labels_from_annot("fsaverage", params["parcellation"], params["hemi"],
-                                    subjects_dir=params["subjects dir"], verbose=False)
-
-    # Create parallel functions per time point
-    parallel_funcs = []
-
-    for label in labels:
-        # Ignore irrelevant labels
-        if re.match(r".*(unknown|\?|deeper|cluster|default|ongur|medial\.wall).*", label.name.lower()):
-            continue
-        func = delayed(_process_single_label)(dst_dir=dst_dir,
-                                              epochs=epochs, label=label, inv=inv,
-                                              params=params, morph=morph)
-        parallel_funcs.append(func)
-
-    logger.info(f"Total of {len(parallel_funcs)} parallel functions added")
-    logger.info(f"Executing {n_jobs} jobs in parallel")
-    parallel_pool = Parallel(n_jobs=n_jobs)
-    parallel_pool(parallel_funcs)
-
-    logger.debug(f"{len(parallel_funcs)} time steps processed")
-
-
-def _process_single_label(dst_dir: Path, epochs: Epochs, label: Label, inv, params, morph):  # todo data type
-    """
-    Perform source localization on a particular cortical area.
-    :param dst_dir: directory to store the results in
-    :param epochs: epochs object to perform source localization on
-    :param label: cortical area of interest
-    :param inv: inverse operator
-    :param params: should contain `method` and `pick ori`
-    :param morph: todo
-    :return:
-    """
-
-    logger.info(f"Processing single subject for {label.name} ")
-
-    stcs = _inverse_epochs(epochs, inv=inv, method=params["method"], pick_ori=params["pick ori"])
-    stcs = _morph_to_common(stcs, morph)
-
-    data_list = []
-    for stc in stcs:
-        stc = stc.in_label(label)
-        data_list.append(stc.data)
-
-    data = np.stack(data_list)
-
-    _write_array(dst_dir=dst_dir, label=label, data_array=data)
-
-
-def _morph_to_common(stcs: list, morph): #todo data type
-    """
-    Morph the source localization into a common (fsaverge) space
-    :param stcs: list of source localizations (per epoch)
-    :param morph: todo what’s morph
-    :return:
-    """
-
-    logger.info(f"Morphing to fsaverage")
-
-    for stc in stcs:
-        fs_stc = morph.apply(stc)
-        yield fs_stc
-
-
-def _write_array(dst_dir: Path, label: Label, data_array):
-    """
-    Write the resulting file into appropriate directory
-    :param dst_dir: path to directory in which results will be saved
-    :param label: name of the cortical area
-    :param data_array: data array to be saved
-    """
-
-    logger.info(f"Writing the data for {label.name} to file")
+# `stc params` in preprocessing-params.json use a different naming than source_localization.py
+_STC_KEYS = {"fwd_path": "fwd-dir", "subjects dir": "subjects-dir", "pick ori": "pick-ori",
+             "n components": "n-components", "src name": "src-name", "cache dir": "cache-dir"}
 
-    stc_fname = f"{label.name}.npy"
 
-    logger.info(f"Saving {stc_fname} to file in {dst_dir}")
-
-    stc_dir = dst_dir / "stc"
-
-    if not stc_dir.exists():
-        os.makedirs(stc_dir)
-
-    try:
-        np.save(str(stc_dir / stc_fname), data_array)
-
-    except OSError as e:
-        logger.exception(f"Failed to write {dst_dir / stc_fname} to file. {e.strerror}")
-        raise SubjectNotProcessedError(e)
-
-
-def _inverse_evoked(evoked: Evoked, fwd_path: str, method="dSPM", snr=3., return_residual=True, pick_ori=None, inv=None,
-                    epochs=None, n_jobs=1, tmax=0.,
-                    inv_method=("shrunk", "empirical"), rank=None,
-                    loose=0.2, depth=0.8, verbose=False):
-    """
-    todo comment
-    :param evoked: evoked object
-    :param fwd_path: path to precomputed forward object
-    :param method:
-    :param snr: signal to noise ratio
-    :param return_residual: return residual (see MNE)
-    :param pick_ori: pick orientation (see MNE)
-    :param inv: inverse operator object
-    :param epochs: epochs object
-    :param n_jobs: number of jobs
-    :param tmax: todo tmax
-    :param inv_method: source estimation method
-    :param rank: todo rank
-    :param loose: todo loose
-    :param depth: todo depth
-    :param verbose: verbose
-    :return:
-        source estimation
-    """
-
-    if not inv:
-        inv = get_inv(epochs, fwd_path=fwd_path, n_jobs=n_jobs, tmax=tmax, method=inv_method, rank=rank,
-                      loose=loose, depth=depth, verbose=verbose)
-
-    lambda2 = 1. / snr ** 2
-    return apply_inverse(evoked, inv, lambda2,
-                         method=method, pick_ori=pick_ori,
-                         return_residual=return_residual, verbose=False)
-
-
-def _inverse_epochs(epochs: Epochs, label=None, method="dSPM", snr=3., pick_ori=None, inv=None,
-                    n_jobs=1, tmax=0., fwd_path="",
-                    inv_method=("shrunk", "empirical"), rank=None,
-                    loose=0.2, depth=0.8, verbose=False):
-    """
-    todo comment
-    :param epochs: epochs object
-    :param label: labels (cortical area)
-    :param method: source estimation method
-    :param snr: signal to noise ratio
-    :param pick_ori: todo pick ori
-    :param inv: inverse operator
-    :param n_jobs: number of jobs
-    :param tmax: todo tmax
-    :param fwd_path: path to precomputed forward operator
-    :param inv_method: todo inv_method
-    :param rank: todo rank
-    :param loose: todo loose
-    :param depth: todo depth
-    :param verbose: verbosity
-    :return:
-        source estiamtion
-    """
-
-    logger.info(f"Inverting epochs")
-
-    if not inv:
-        inv = get_inv(epochs, fwd_path=fwd_path, n_jobs=n_jobs, tmax=tmax, method=inv_method, rank=rank,
-                      loose=loose, depth=depth, verbose=verbose)
-
-    lambda2 = 1. / snr ** 2
-    return apply_inverse_epochs(epochs, inv, lambda2, label=label,
-                                method=method, pick_ori=pick_ori, verbose=verbose, return_generator=True)
-
-
-def get_inv(epochs: Epochs, fwd_path: str, tmax=0., n_jobs=1, method=("shrunk", "empirical"),
-            rank=None, loose=0.2, depth=0.8, verbose=False):
+def source_localize(dst_dir: Path, subject: str, epochs: Epochs, params: dict, n_jobs=1) -> None:
     """
-    todo comment
-    :param epochs: epochs object
-    :param fwd_path: path to precomputed forward operator
-    :param tmax: todo tmax
+    Source localize the epoch data and save the results. Thin wrapper around
+    `src.processing.source_localization.source_localize` that accepts the `stc params` of the preprocessing pipeline.
+    :param dst_dir: path to directory to save the results in
+    :param subject: name of the subject
+    :param epochs: Epochs object to perform source localization on
+    :param params: `stc params` dictionary
     :param n_jobs: number of jobs for parallelism
-    :param method: todo method
-    :param rank: todo rank
-    :param loose: todo loose
-    :param depth: todo depth
-    :param verbose: verbosity
-    :return:
-        inverse operator
     """
 
-    fwd = read_forward_solution(fwd_path, verbose=verbose)
-    noise_cov = compute_covariance(epochs, tmax=tmax, method=method, rank=rank, n_jobs=n_jobs, verbose=verbose)
-    inv = make_inverse_operator(epochs.info, fwd, noise_cov, loose=loose, depth=depth, verbose=verbose)
-
-    return inv
-
-
-def get_labels_names(params: dict):
-    """
-    todo comment
-    :param params: todo params
-    :return: todo return
-    """
-
-    # Generate set of labels
-    labels = read_labels_from_annot("fsaverage", params["parcellation"], params["hemi"],
-                                    subjects_dir=params["subjects dir"], verbose=False)
-    label_names = []
-    for label in labels:
-
-        # Ignore irrelevant labels
-        if not re.match(r".*(unknown|\?|deeper|cluster|default|ongur|medial\.wall).*", label.name.lower()):
-
-            label_names.append(label.name)
-
-    return label_names
+    stc_params = {_STC_KEYS.get(key, key): value for key, value in params.items()}
+    _source_localize(dst_dir=dst_dir, subject=subject, epochs=epochs, params=stc_params, n_jobs=n_jobs)
 
 
 ########################################################################################################################
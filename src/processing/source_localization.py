@@ -2,21 +2,30 @@ import argparse
 import logging
 import os
 import re
+import shutil
 import sys
+import tempfile
 import traceback
 
 from pathlib import Path
+from typing import List
 
 import numpy as np
 
 from joblib import Parallel, delayed
-from mne import (compute_covariance, read_labels_from_annot, Epochs, Evoked, Label, read_forward_solution,
-                 read_source_spaces, compute_source_morph, read_epochs)
-from mne.minimum_norm import make_inverse_operator, apply_inverse, apply_inverse_epochs
+from scipy.sparse import csr_matrix
+from mne import (compute_covariance, read_labels_from_annot, Epochs, Evoked, read_forward_solution,
+                 read_source_spaces, compute_source_morph, read_epochs, read_cov, write_cov)
+from mne.minimum_norm import (make_inverse_operator, apply_inverse, apply_inverse_epochs, read_inverse_operator,
+                              write_inverse_operator)
 
+from src.processing.label_operator import LabelOperator, LabelSummary
 from src.utils.exceptions import SubjectNotProcessedError
-from src.utils.file_access import load_json
+from src.utils.fsaverage import DEFAULT_SRC_NAME, get_fsaverage_resources
+from src.utils.file_access import load_json, read_json, write_json, get_file_hash, get_array_hash, get_params_hash
 from src.utils.logger import get_logger
+from src.utils.manifest import record_store
+from src.utils.source_store import STORE_FNAME, create_store, close_store, get_summary_store_name
 
 logger = get_logger(file_name="source-localization")
 logger.setLevel(logging.INFO)
@@ -35,7 +44,10 @@ def source_localize(dst_dir: Path, subject: str, epochs: Epochs, params: dict, n
     :param dst_dir: path to directory to save the results in
     :param subject: name of the subject
     :param epochs: Epochs object to perform source localization on
-    :param params: parameter dictionary
+    :param params: parameter dictionary. `parcellation` can be a list of parcellations, they all share the same
+        inverse solution and morph. `src-name` selects the fsaverage source space to morph to (`fsaverage-ico-5` by
+        default) and `decimate` keeps every n-th vertex of each label. The noise covariance and the inverse operator
+        are cached in `cache-dir` if given (see `get_inv`), not cached by default
     :param n_jobs: number of jobs for parallelism
     """
 
@@ -43,106 +55,236 @@ def source_localize(dst_dir: Path, subject: str, epochs: Epochs, params: dict, n
 
     # Make inverse model
     logging.info(f"Making an inverse model for the subject {subject} ")
-    inv = get_inv(epochs, fwd_path=str(Path(params["fwd-dir"]) / f"{subject}-fwd.fif"), n_jobs=n_jobs)
+    inv = get_inv(epochs, fwd_path=str(Path(params["fwd-dir"]) / f"{subject}-fwd.fif"), n_jobs=n_jobs,
+                  cache_dir=params.get("cache-dir"), subject=subject,
+                  epochs_path=params.get("epochs-path"))
 
     # Common source space
     logging.info(f"Setting up morph to FS average")
-    fsaverage_src_path = Path(params["subjects-dir"]) / "fsaverage" / "bem" / "fsaverage-ico-5-src.fif"
-    fs_src = read_source_spaces(str(fsaverage_src_path))
-    morph = compute_source_morph(src=inv["src"], subject_from=subject, subject_to="fsaverage", src_to=fs_src,
-                                 subjects_dir=params["subjects-dir"], verbose=False)
+    morph = get_morph(src=inv["src"], subject=subject, subjects_dir=params["subjects-dir"],
+                      morph_dir=params.get("morph-dir", params["fwd-dir"]),
+                      src_name=params.get("src-name", DEFAULT_SRC_NAME))
 
-    # Generate set of labels
-    logging.info(f"Reading labels")
-    labels = read_labels_from_annot("fsaverage", params["parcellation"], params["hemi"],
-                                    subjects_dir=params["subjects-dir"], verbose=False)
+    # Invert and morph every epoch once, then cut all labels of all parcellations out of the same result
+    label_rows = _get_label_rows(params, morph)
 
-    # Create parallel functions per time point
-    parallel_funcs = []
+    logging.info(f"Processing {len(label_rows)} labels in a single pass")
+    _process_all_labels(dst_dir=dst_dir, epochs=epochs, label_rows=label_rows, inv=inv, params=params, morph=morph,
+                        n_jobs=n_jobs)
 
-    for label in labels:
-        # Ignore irrelevant labels
-        if re.match(r".*(unknown|\?|deeper|cluster|default|ongur|medial\.wall).*", label.name.lower()):
-            continue
-        func = delayed(_process_single_label)(dst_dir=dst_dir,
-                                              epochs=epochs, label=label, inv=inv,
-                                              params=params, morph=morph)
-        parallel_funcs.append(func)
+    # Keep the manifest of the epochs directory (parent of `dst_dir`) up to date
+    if params.get("manifest", True):
+        record_store(dst_dir.parent, subject, dst_dir / "stc")
+        if params.get("summary"):
+            record_store(dst_dir.parent, subject, dst_dir / "stc", name=get_summary_store_name(params["summary"]))
 
-    logging.info(f"Total of {len(parallel_funcs)} parallel functions added")
-    logging.info(f"Executing {n_jobs} jobs in parallel")
-    parallel_pool = Parallel(n_jobs=n_jobs)
-    parallel_pool(parallel_funcs)
 
-    logging.debug(f"{len(parallel_funcs)} time steps processed")
+def _as_list(value) -> list:
+    """
+    Parameters such as `parcellation` can be given either as a single value or as a list
+    :param value: single value or list
+    :return:
+        list
+    """
+    return list(value) if isinstance(value, (list, tuple)) else [value]
 
 
-def _process_single_label(dst_dir: Path, epochs: Epochs, label: Label, inv, params, morph) -> None:
+def _get_label_rows(params: dict, morph) -> dict:
+    """
+    Get the fsaverage rows of every label of every parcellation requested
+    :param params: should contain `subjects-dir`, `parcellation` (name or list of names) and `hemi` (`lh`, `rh` or
+        `both`), optionally `src-name`, `decimate` (keep every n-th vertex of each label) and `resource-dir`
+    :param morph: morph from the subject to fsaverage
+    :return:
+        {label name: rows of the fsaverage source estimate}, parcellation after parcellation
     """
-    Perform source localization on a particular cortical area.
+
+    hemis = ["lh", "rh"] if params["hemi"] == "both" else _as_list(params["hemi"])
+    decimate = params.get("decimate", 1)
+    if decimate < 1:
+        raise ValueError(f"decimate should be a positive integer, got {decimate}")
+
+    label_rows = {}
+    for parcellation in _as_list(params["parcellation"]):
+        resources = get_fsaverage_resources(params["subjects-dir"], parcellation,
+                                            src_name=params.get("src-name", DEFAULT_SRC_NAME),
+                                            resource_dir=params.get("resource-dir"))
+        if len(resources.label_index) != sum(len(v) for v in morph.vertices_to):
+            raise ValueError(f"The fsaverage resources for {parcellation} and the morph use different source spaces")
+
+        for name, rows in resources.get_label_rows().items():
+            if not any(name.endswith(f"-{hemi}") for hemi in hemis):
+                continue
+            if name in label_rows:
+                raise ValueError(f"Label {name} appears in more than one parcellation")
+            label_rows[name] = rows[::decimate]
+
+    return label_rows
+
+
+def _process_all_labels(dst_dir: Path, epochs: Epochs, label_rows: dict, inv, params, morph, n_jobs=1) -> None:
+    """
+    Perform source localization once for all the epochs and extract every cortical area from the same result.
+    The inverse kernel and the morph are restricted to the labels and applied to batches of epochs (see
+    `LabelOperator`). The output of the operator is laid out label after label, exactly like the source store of the
+    subject, so every batch is written in place with a single contiguous write.
+    If `summary` is given, the same batches are also reduced to a few time courses per label (see `LabelSummary`)
+    and written to a second, compact store next to the full one.
     :param dst_dir: directory to store the results in
     :param epochs: epochs object to perform source localization on
-    :param label: cortical area of interest
+    :param label_rows: {label name: rows of the fsaverage source estimate}
     :param inv: inverse operator
-    :param params: should contain `method` and `pick ori`
-    :param morph: todo morph
+    :param params: should contain `method` and `pick-ori`, optionally `snr`, `dtype`, `batch-size`, `n-chunks`,
+        `tmp-dir`, `summary` (`mean`, `mean_flip` or `pca_flip`) and `n-components`
+    :param morph: source morph from the subject to fsaverage
+    :param n_jobs: number of jobs for parallelism. If more than one, the epochs are split into chunks (see
+        `_apply_parallel`)
     """
 
-    logging.info(f"Processing single subject for {label.name} ")
+    dtype = params.get("dtype", "float32")
+    batch_size = params.get("batch-size", 32)
+    operator = LabelOperator(inv, morph, label_rows, method=params["method"], snr=params.get("snr", 3.),
+                             pick_ori=params["pick-ori"], dtype=dtype)
+    summary = _get_label_summary(params, operator, label_rows) if params.get("summary") else None
 
-    stcs = _inverse_epochs(epochs, inv=inv, method=params["method"], pick_ori=params["pick-ori"])
-    stcs = _morph_to_common(stcs, morph)
+    stc_dir = dst_dir / "stc"
+    n_epochs, n_times = len(epochs), len(epochs.times)
+    label_slices = {name: (sl.start, sl.stop) for name, sl in zip(operator.names, operator.slices)}
+    meta = {"tmin": float(epochs.times[0]), "sfreq": float(epochs.info["sfreq"]),
+            "src-name": params.get("src-name", DEFAULT_SRC_NAME), "decimate": params.get("decimate", 1)}
 
-    data_list = []
-    for stc in stcs:
-        stc = stc.in_label(label)
-        data_list.append(stc.data)
+    try:
+        shape = (n_epochs, operator.n_vertices, n_times)
+        x_map = create_store(stc_dir, label_slices=label_slices, shape=shape, dtype=dtype, meta=meta)
+
+        s_map, summary_name = None, None
+        if summary is not None:
+            summary_name = get_summary_store_name(summary.mode)
+            summary_meta = dict(meta, mode=summary.mode, n_components=summary.n_components)
+            s_map = create_store(stc_dir, label_slices=summary.label_slices,
+                                 shape=(n_epochs, summary.n_outputs, n_times), dtype=dtype, meta=summary_meta,
+                                 name=summary_name)
+
+        if n_jobs > 1:
+            _apply_parallel(operator, epochs, store_path=stc_dir / STORE_FNAME, shape=shape, dtype=dtype,
+                            n_jobs=n_jobs, n_chunks=params.get("n-chunks", n_jobs), batch_size=batch_size,
+                            tmp_dir=params.get("tmp-dir"), summary=summary,
+                            summary_path=stc_dir / f"{summary_name}.dat" if summary is not None else None)
+        else:
+            for start, stop, data in operator.apply_epochs(epochs, batch_size=batch_size):
+                logger.debug(f"Epochs {start} - {stop} / {n_epochs}")
+                x_map[start: stop] = data
+                if summary is not None:
+                    s_map[start: stop] = summary.apply(data)
+
+        close_store(stc_dir, x_map)
+        if summary is not None:
+            close_store(stc_dir, s_map, name=summary_name)
 
-    data = np.stack(data_list)
+    except OSError as e:
+        logger.exception(f"Failed to write the source store in {stc_dir}. {e.strerror}")
+        raise SubjectNotProcessedError(e)
 
-    _write_array(dst_dir=dst_dir, label=label, data_array=data)
+    logger.info(f"{len(label_slices)} labels written to the source store")
 
 
-def _morph_to_common(stcs: list, morph):
+def _get_label_summary(params: dict, operator: LabelOperator, label_rows: dict) -> LabelSummary:
     """
-    Morph the source localization into a common (fsaverge) space
-    :param stcs: list of source localizations (per epoch)
-    :param morph: todo morph
-    :return: todo return
+    Set up the summary of the labels of an operator
+    :param params: should contain `summary`, `subjects-dir` and `parcellation`, optionally `n-components` and
+        `resource-dir`
+    :param operator: label operator
+    :param label_rows: {label name: rows of the fsaverage source estimate}
+    :return:
+        LabelSummary
     """
 
-    logging.info(f"Morphing to fsaverage")
+    # The normals only depend on the source space, any parcellation gives the same
+    resources = get_fsaverage_resources(params["subjects-dir"], _as_list(params["parcellation"])[0],
+                                        src_name=params.get("src-name", DEFAULT_SRC_NAME),
+                                        resource_dir=params.get("resource-dir"))
+    rows = np.concatenate([label_rows[name] for name in operator.names]) if operator.names else np.zeros(0, int)
 
-    for stc in stcs:
-        fs_stc = morph.apply(stc)
-        yield fs_stc
+    logging.info(f"Summarizing the labels with {params['summary']}")
+    return LabelSummary.from_operator(operator, mode=params["summary"], normals=resources.normals[rows],
+                                      n_components=params.get("n-components", 1))
 
 
-def _write_array(dst_dir: Path, label: Label, data_array) -> None:
+def _apply_parallel(operator: LabelOperator, epochs: Epochs, store_path: Path, shape: tuple, dtype: str,
+                    n_jobs: int, n_chunks: int, batch_size: int, tmp_dir=None, summary=None,
+                    summary_path=None) -> None:
     """
-    Write the resulting file into appropriate directory
-    :param dst_dir: path to directory in which results will be saved
-    :param label: name of the cortical area
-    :param data_array: data array to be saved
+    Apply the label operator to chunks of epochs in parallel. The epochs data is written once to a memmap, the workers
+    only receive the epoch range they work on and write their results straight into the source store.
+    :param operator: label operator
+    :param epochs: epochs object
+    :param store_path: path to the (preallocated) source store
+    :param shape: shape of the source store
+    :param dtype: data type of the source store
+    :param n_jobs: number of jobs
+    :param n_chunks: number of epoch chunks
+    :param batch_size: number of epochs a worker processes at a time
+    :param tmp_dir: directory for the shared epochs data, system default if None
+    :param summary: optional label summary, written to `summary_path`
+    :param summary_path: path to the (preallocated) summary store
     """
 
-    logger.info(f"Writing the data for {label.name} to file")
+    n_epochs = shape[0]
+    bounds = np.linspace(0, n_epochs, min(n_chunks, n_epochs) + 1).astype(int)
 
-    stc_fname = f"{label.name}.npy"
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as shared_dir:
 
-    logger.info(f"Saving {stc_fname} to file in {dst_dir}")
+        # Only the channels used by the operator are shared
+        picks = operator.pick_channels(epochs.ch_names)
+        data = epochs.get_data()[:, picks]
+        data_path = str(Path(shared_dir) / "epochs.npy")
+        np.save(data_path, data.astype(operator.dtype, copy=False))
+        del data
+        data = np.load(data_path, mmap_mode="r")
 
-    stc_dir = dst_dir / "stc"
+        logger.info(f"Processing {n_epochs} epochs in {len(bounds) - 1} chunks with {n_jobs} jobs")
+        parallel_funcs = [delayed(_process_epoch_chunk)(operator=operator, data=data, store_path=store_path,
+                                                        shape=shape, dtype=dtype, start=start, stop=stop,
+                                                        batch_size=batch_size, summary=summary,
+                                                        summary_path=summary_path)
+                          for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
 
-    if not stc_dir.exists():
-        os.makedirs(stc_dir)
+        parallel_pool = Parallel(n_jobs=n_jobs)
+        parallel_pool(parallel_funcs)
 
-    try:
-        np.save(str(stc_dir / stc_fname), data_array)
 
-    except OSError as e:
-        logger.exception(f"Failed to write {dst_dir / stc_fname} to file. {e.strerror}")
-        raise SubjectNotProcessedError(e)
+def _process_epoch_chunk(operator: LabelOperator, data: np.memmap, store_path: Path, shape: tuple, dtype: str,
+                         start: int, stop: int, batch_size: int, summary=None, summary_path=None) -> None:
+    """
+    Apply the operator to a range of epochs and write the result into the source store
+    :param operator: label operator
+    :param data: shared epochs data, n_epochs x n_channels x n_times (channels already picked)
+    :param store_path: path to the source store
+    :param shape: shape of the source store
+    :param dtype: data type of the source store
+    :param start: first epoch of the chunk
+    :param stop: last epoch of the chunk (excluded)
+    :param batch_size: number of epochs processed at a time
+    :param summary: optional label summary
+    :param summary_path: path to the summary store
+    """
+
+    x_map = np.memmap(str(store_path), dtype=dtype, mode="r+", shape=shape)
+
+    s_map = None
+    if summary is not None:
+        s_map = np.memmap(str(summary_path), dtype=dtype, mode="r+", shape=(shape[0], summary.n_outputs, shape[2]))
+
+    for batch_start in range(start, stop, batch_size):
+        batch_stop = min(batch_start + batch_size, stop)
+        batch = operator.apply(data[batch_start: batch_stop])
+        x_map[batch_start: batch_stop] = batch
+        if s_map is not None:
+            s_map[batch_start: batch_stop] = summary.apply(batch)
+
+    x_map.flush()
+    if s_map is not None:
+        s_map.flush()
 
 
 def _inverse_evoked(evoked: Evoked, fwd_path: str, method="dSPM", snr=3., return_residual=True, pick_ori=None, inv=None,
@@ -216,29 +358,190 @@ def _inverse_epochs(epochs: Epochs, label=None, method="dSPM", snr=3., pick_ori=
 
 
 def get_inv(epochs: Epochs, fwd_path: str, tmax=0., n_jobs=1, method=("shrunk", "empirical"),
-            rank=None, loose=0.2, depth=0.8, verbose=False):
+            rank=None, loose=0.2, depth=0.8, verbose=False, cache_dir=None, subject=None, epochs_path=None):
     """
-    todo comment
+    Compute the noise covariance and the inverse operator. If `cache_dir` is given, both are stored on disk under a key
+    made of the subject, the content of the epochs (data and measurement info, see `_get_info_hash`) and forward files
+    and the parameters, and reused on reruns.
     :param epochs: epochs object
     :param fwd_path: path to precomputed forward operator
-    :param tmax: todo tmax
+    :param tmax: end of the baseline used for the noise covariance
     :param n_jobs: number of jobs for parallelism
-    :param method: todo method
-    :param rank: todo rank
-    :param loose: todo loose
-    :param depth: todo depth
+    :param method: covariance estimation method(s)
+    :param rank: rank of the data (see MNE)
+    :param loose: loose orientation constraint
+    :param depth: depth weighting
     :param verbose: verbosity
+    :param cache_dir: directory of the covariance and inverse operator cache, no caching if None
+    :param subject: name of the subject, used in the names of the cached files
+    :param epochs_path: path to the epochs file. If None, the epochs data is hashed instead. The measurement info is
+        hashed in both cases, it can be changed after reading the file (bads, projections)
     :return:
         inverse operator
     """
 
+    if cache_dir is None:
+        fwd = read_forward_solution(fwd_path, verbose=verbose)
+        noise_cov = compute_covariance(epochs, tmax=tmax, method=method, rank=rank, n_jobs=n_jobs, verbose=verbose)
+        return make_inverse_operator(epochs.info, fwd, noise_cov, loose=loose, depth=depth, verbose=verbose)
+
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        os.makedirs(cache_dir)
+
+    # Content addressed keys
+    epochs_hash = get_file_hash(epochs_path) if epochs_path else get_array_hash(epochs.get_data())
+    cov_key = get_params_hash(subject, epochs_hash, _get_info_hash(epochs.info), tmax, method, rank)
+    inv_key = get_params_hash(cov_key, get_file_hash(fwd_path), loose, depth)
+
+    inv_path = cache_dir / f"{subject}-{inv_key}-inv.fif"
+    if inv_path.exists():
+        logger.info(f"Reading cached inverse operator {inv_path}")
+        return read_inverse_operator(str(inv_path), verbose=verbose)
+
+    cov_path = cache_dir / f"{subject}-{cov_key}-cov.fif"
+    if cov_path.exists():
+        logger.info(f"Reading cached noise covariance {cov_path}")
+        noise_cov = read_cov(str(cov_path), verbose=verbose)
+    else:
+        noise_cov = compute_covariance(epochs, tmax=tmax, method=method, rank=rank, n_jobs=n_jobs, verbose=verbose)
+        write_cov(str(cov_path), noise_cov)
+
     fwd = read_forward_solution(fwd_path, verbose=verbose)
-    noise_cov = compute_covariance(epochs, tmax=tmax, method=method, rank=rank, n_jobs=n_jobs, verbose=verbose)
     inv = make_inverse_operator(epochs.info, fwd, noise_cov, loose=loose, depth=depth, verbose=verbose)
+    write_inverse_operator(str(inv_path), inv, verbose=verbose)
+    logger.info(f"Inverse operator cached in {inv_path}")
 
     return inv
 
 
+def _get_info_hash(info) -> str:
+    """
+    Hash the parts of the measurement info the covariance and the inverse operator depend on: channels (names, types,
+    positions, calibration), bad channels, projections, compensation grade and device to head transform
+    :param info: measurement info, e.g. `epochs.info`
+    :return:
+        hexadecimal digest (16 characters)
+    """
+
+    chs = [(ch["ch_name"], int(ch["kind"]), int(ch["coil_type"]), float(ch["cal"]), float(ch["range"]),
+            get_array_hash(np.asarray(ch["loc"]))) for ch in info["chs"]]
+    projs = [(proj["desc"], bool(proj["active"]), list(proj["data"]["col_names"]),
+              get_array_hash(np.asarray(proj["data"]["data"]))) for proj in info["projs"]]
+    comps = [(int(comp["kind"]), bool(comp["save_calibrated"])) for comp in info["comps"]]
+    dev_head_t = None if info["dev_head_t"] is None else get_array_hash(np.asarray(info["dev_head_t"]["trans"]))
+
+    return get_params_hash(chs, sorted(info["bads"]), projs, comps, dev_head_t, float(info["sfreq"]),
+                           bool(info["custom_ref_applied"]))
+
+
+########################################################################################################################
+# MORPH TO FSAVERAGE                                                                                                   #
+########################################################################################################################
+
+
+class FsaverageMorph:
+    """
+    Sparse morph matrix from a subject source space to fsaverage. Provides the parts of `SourceMorph` used in this
+    module (`morph_mat` and `vertices_to`), and can be saved to a directory of `.npy` files which are memory-mapped
+    when loaded again.
+    """
+
+    def __init__(self, morph_mat, vertices_from: List[np.array], vertices_to: List[np.array]):
+        """
+        :param morph_mat: sparse matrix, n_fsaverage_vertices x n_subject_vertices
+        :param vertices_from: vertices of the subject source space, [left hemisphere, right hemisphere]
+        :param vertices_to: vertices of the fsaverage source space, [left hemisphere, right hemisphere]
+        """
+
+        self.morph_mat = morph_mat
+        self.vertices_from = vertices_from
+        self.vertices_to = vertices_to
+
+    def save(self, morph_dir: Path) -> None:
+        """
+        Save the morph. The files are written to a temporary directory first, so that concurrent jobs never see a
+        partially written morph.
+        :param morph_dir: directory to save the morph in
+        """
+
+        tmp_dir = morph_dir.parent / f".{morph_dir.name}-{os.getpid()}"
+        os.makedirs(tmp_dir)
+
+        morph_mat = csr_matrix(self.morph_mat)
+        np.save(str(tmp_dir / "data.npy"), morph_mat.data)
+        np.save(str(tmp_dir / "indices.npy"), morph_mat.indices)
+        np.save(str(tmp_dir / "indptr.npy"), morph_mat.indptr)
+        for hemi, vertices_from, vertices_to in zip(("lh", "rh"), self.vertices_from, self.vertices_to):
+            np.save(str(tmp_dir / f"vertices-from-{hemi}.npy"), vertices_from)
+            np.save(str(tmp_dir / f"vertices-to-{hemi}.npy"), vertices_to)
+        write_json(tmp_dir, file_name="shape.json", data={"shape": list(morph_mat.shape)})
+
+        try:
+            os.rename(tmp_dir, morph_dir)
+        except OSError:
+            # Another job saved the same morph in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, morph_dir: Path):
+        """
+        Load a saved morph, the arrays are memory-mapped
+        :param morph_dir: directory containing the morph
+        :return:
+            FsaverageMorph
+        """
+
+        shape = tuple(read_json(morph_dir, file_name="shape.json")["shape"])
+        data, indices, indptr = [np.load(str(morph_dir / f"{name}.npy"), mmap_mode="r")
+                                 for name in ("data", "indices", "indptr")]
+        morph_mat = csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+        vertices_from = [np.load(str(morph_dir / f"vertices-from-{hemi}.npy")) for hemi in ("lh", "rh")]
+        vertices_to = [np.load(str(morph_dir / f"vertices-to-{hemi}.npy")) for hemi in ("lh", "rh")]
+        return cls(morph_mat, vertices_from=vertices_from, vertices_to=vertices_to)
+
+
+def get_morph(src, subject: str, subjects_dir, morph_dir, src_name=DEFAULT_SRC_NAME) -> FsaverageMorph:
+    """
+    Get the morph from the subject source space to fsaverage. The morph only depends on the anatomy of the subject and
+    the source spaces, so it is computed once and saved in `morph_dir` (next to the forward models).
+    :param src: source space of the subject, e.g. `inv["src"]`
+    :param subject: name of the subject
+    :param subjects_dir: FreeSurfer subjects directory
+    :param morph_dir: directory in which the morphs are saved
+    :param src_name: name of the fsaverage source space, `<subjects_dir>/fsaverage/bem/<src_name>-src.fif`
+    :return:
+        morph
+    """
+
+    morph_path = Path(morph_dir) / f"{subject}-{src_name}-morph"
+    vertices_from = [s["vertno"] for s in src]
+
+    if morph_path.exists():
+        morph = FsaverageMorph.load(morph_path)
+
+        # The cached morph is only valid for the same subject source space
+        if all(np.array_equal(a, b) for a, b in zip(morph.vertices_from, vertices_from)):
+            logger.info(f"Reading cached morph {morph_path}")
+            return morph
+
+        logger.info(f"Source space of {subject} has changed, recomputing the morph")
+        shutil.rmtree(morph_path, ignore_errors=True)
+
+    fsaverage_src_path = Path(subjects_dir) / "fsaverage" / "bem" / f"{src_name}-src.fif"
+    fs_src = read_source_spaces(str(fsaverage_src_path), verbose=False)
+    source_morph = compute_source_morph(src=src, subject_from=subject, subject_to="fsaverage", src_to=fs_src,
+                                        subjects_dir=subjects_dir, verbose=False)
+
+    morph = FsaverageMorph(source_morph.morph_mat, vertices_from=vertices_from,
+                           vertices_to=source_morph.vertices_to)
+    morph.save(morph_path)
+    logger.info(f"Morph cached in {morph_path}")
+
+    return morph
+
+
 def get_labels_names(params: dict):
     """
     todo comment
@@ -272,11 +575,21 @@ def get_args():
     parser.add_argument("--dst_dir", type=str, required=False, help="Directory to save the results in")
     parser.add_argument("--subject", type=str, required=False, help="Name of the subject. e.g. `sub-V1001`")
     parser.add_argument("--epochs_path", type=str, required=False, help="Path to epochs data")
-    parser.add_argument("--parc", type=str, required=False, default="aparc",
-                        help="Parcellation scheme to use. Default is `aparc`")
+    parser.add_argument("--parc", type=str, nargs="+", required=False, default=["aparc"],
+                        help="Parcellation scheme(s) to use. Default is `aparc`")
     parser.add_argument("--subjects_dir", type=str, required=False, help="Path to subjects_dir")
     parser.add_argument("--hemi", type=str, required=False, help="Hemisphere, `lh`, `rh` or `both`")
     parser.add_argument("--fwd_dir", type=str, required=False, help="Directory containing all forward models")
+    parser.add_argument("--src_name", type=str, required=False, default=DEFAULT_SRC_NAME,
+                        help=f"fsaverage source space to morph to. Default is `{DEFAULT_SRC_NAME}`")
+    parser.add_argument("--decimate", type=int, required=False, default=1,
+                        help="Keep every n-th vertex of each label. Default is 1 (all vertices)")
+    parser.add_argument("--summary", type=str, required=False, default=None,
+                        help="Also save label summaries, `mean`, `mean_flip` or `pca_flip`")
+    parser.add_argument("--n_components", type=int, required=False, default=1,
+                        help="Number of `pca_flip` components per label. Default is 1")
+    parser.add_argument("--cache_dir", type=str, required=False, default=None,
+                        help="Directory to cache the noise covariance and the inverse operator in. Default is no cache")
     #todo method, pickori
     args = parser.parse_args()
 
@@ -286,9 +599,15 @@ def get_args():
         dst_dir, subject, epochs_path = params["dst-dir"], params["subject"], params["epochs-path"]
         parc, subjects_dir, hemi, fwd_dir = params["parc"], params["subjects-dir"], params["hemi"], params["fwd-dir"]
         method, pick_ori = params["method"], params["pick-ori"]
+        summary, n_components = params.get("summary"), params.get("n-components", 1)
+        src_name, decimate = params.get("src-name", DEFAULT_SRC_NAME), params.get("decimate", 1)
+        cache_dir = params.get("cache-dir")
     else:
         dst_dir, subject, epochs_path, parc, subjects_dir, hemi, fwd_dir, method, pick_ori = \
             args.dst_dir, args.subject, args.epochs_path, args.parc, args.subjects_dir, args.hemi, args.fwd_dir, args.method, args.pick_ori
+        summary, n_components = args.summary, args.n_components
+        src_name, decimate = args.src_name, args.decimate
+        cache_dir = args.cache_dir
 
     # Convert to Path object
     dst_dir = Path(dst_dir)
@@ -301,7 +620,9 @@ def get_args():
     # Convert to appropriate format
     params = {"parcellation": parc, "hemi": hemi,
               "subjects-dir": subjects_dir, "fwd-dir": fwd_dir,
-              "method": method, "pick-ori": pick_ori}
+              "method": method, "pick-ori": pick_ori, "epochs-path": str(epochs_path),
+              "summary": summary, "n-components": n_components, "src-name": src_name, "decimate": decimate,
+              "cache-dir": cache_dir}
 
     return dst_dir, subject, epochs_path, params
 
@@ -0,0 +1,260 @@
+import bz2
+import logging
+import lzma
+import os
+import shutil
+import zlib
+
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+from joblib import Parallel, delayed
+
+from src.utils.file_access import load_json, write_json
+from src.utils.logger import get_logger
+
+logger = get_logger(file_name="chunked")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# CHUNKED DATASETS                                                                                                     #
+########################################################################################################################
+# Alternative container for the datasets: `x.dat` is cut into (trial block, all vertices, time block) chunks, each     #
+# compressed losslessly and saved as its own file in `x.chunks/`. A time window of a subset of trials only reads and   #
+# decompresses the chunks it overlaps, in parallel threads (zlib, lzma and bz2 release the GIL).                       #
+########################################################################################################################
+
+CHUNK_DIR = "x.chunks"
+
+CODECS = {"zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+          "lzma": (lzma.compress, lzma.decompress),
+          "bz2": (bz2.compress, bz2.decompress),
+          "none": (bytes, bytes)}
+
+
+def _shuffle(data: bytes, item_size: int) -> bytes:
+    """
+    Byte shuffle: group the first bytes of all the values, then the second bytes, etc. Floats compress much better
+    """
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, item_size).T.tobytes()
+
+
+def _unshuffle(data: bytes, item_size: int) -> bytes:
+    """
+    Inverse of `_shuffle`
+    """
+    return np.frombuffer(data, dtype=np.uint8).reshape(item_size, -1).T.tobytes()
+
+
+def _chunk_fname(trial_block: int, time_block: int) -> str:
+    """
+    File name of a chunk, e.g. `3.0` for the fourth trial block and the first time block
+    """
+    return f"{trial_block}.{time_block}"
+
+
+def _encode(array: np.array, codec: str, shuffle: bool) -> bytes:
+    """
+    Serialize and compress a chunk
+    """
+
+    data = np.ascontiguousarray(array).tobytes()
+    if shuffle:
+        data = _shuffle(data, array.dtype.itemsize)
+    return CODECS[codec][0](data)
+
+
+def _decode(data: bytes, dtype: np.dtype, shape: tuple, codec: str, shuffle: bool) -> np.array:
+    """
+    Decompress and deserialize a chunk
+    """
+
+    data = CODECS[codec][1](data)
+    if shuffle:
+        data = _unshuffle(data, dtype.itemsize)
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def convert_to_chunked(data_dir: Path, trial_block=64, time_block=25, codec="zlib", shuffle=True, n_jobs=1) -> None:
+    """
+    Convert the `x.dat` memory map of a dataset (`epochs` layout) to chunks, then remove `x.dat`. The chunking is
+    recorded in `x_shape.json`
+    :param data_dir: directory of the dataset
+    :param trial_block: number of trials per chunk
+    :param time_block: number of time samples per chunk
+    :param codec: `zlib`, `lzma`, `bz2` or `none`
+    :param shuffle: if true, byte-shuffle the values before compression
+    :param n_jobs: number of threads compressing chunks
+    """
+
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, use one of {list(CODECS)}")
+
+    meta = load_json(data_dir / "x_shape.json")
+    if meta.get("layout", "epochs") != "epochs":
+        raise ValueError("Only datasets in the epochs layout can be chunked, the chunks already give time access")
+
+    shape = tuple(meta["shape"])
+    dtype = np.dtype(meta.get("dtype", "float64"))
+    x = np.memmap(str(data_dir / "x.dat"), dtype=dtype, mode="r", shape=shape)
+
+    chunk_dir = data_dir / CHUNK_DIR
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    os.makedirs(chunk_dir)
+
+    n_time_blocks = int(np.ceil(shape[2] / time_block))
+    parallel_pool = Parallel(n_jobs=n_jobs, prefer="threads")
+
+    n_bytes = 0
+    for i, start in enumerate(range(0, shape[0], trial_block)):
+        block = np.asarray(x[start: start + trial_block])     # contiguous read of whole trials
+
+        chunks = parallel_pool(delayed(_encode)(block[..., j * time_block: (j + 1) * time_block], codec, shuffle)
+                               for j in range(n_time_blocks))
+        for j, chunk in enumerate(chunks):
+            with open(chunk_dir / _chunk_fname(i, j), "wb") as file:
+                file.write(chunk)
+            n_bytes += len(chunk)
+
+    del x
+
+    # The header is replaced in one step before `x.dat` goes, an interrupted conversion leaves a readable dataset
+    meta.update({"container": "chunked", "chunks": [trial_block, shape[1], time_block], "codec": codec,
+                 "shuffle": shuffle, "dtype": dtype.name})
+    tmp_fname = f".x_shape.{os.getpid()}.json"
+    write_json(data_dir, file_name=tmp_fname, data=meta)
+    os.replace(data_dir / tmp_fname, data_dir / "x_shape.json")
+    os.remove(data_dir / "x.dat")
+
+    logger.info(f"Dataset in {data_dir} chunked: {n_bytes / max(dtype.itemsize * np.prod(shape), 1):.2f} of the size")
+
+
+class ChunkedArray:
+    """
+    Read-only array over a chunked dataset, n_trials x n_vertices x n_times.
+
+    Selecting trials only (`x[included]`, `x[10:20]`) returns another lazy `ChunkedArray`. Any selection along the
+    vertices or the times (`x[..., 10:20]`, `x[:, :, 5]`) reads the overlapping chunks and returns a numpy array, so
+    the array can be used in place of the `x.dat` memory map, e.g. with `get_slice`.
+    """
+
+    def __init__(self, data_dir: Path, trials=None, n_jobs=4):
+        """
+        :param data_dir: directory of the dataset
+        :param trials: indices of the trials of the view, all the trials if None
+        :param n_jobs: number of threads decompressing chunks
+        """
+
+        self.data_dir = Path(data_dir)
+        self.meta = load_json(self.data_dir / "x_shape.json")
+        self.n_jobs = n_jobs
+
+        self._shape = tuple(self.meta["shape"])
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.trial_block, _, self.time_block = self.meta["chunks"]
+        self.trials = np.arange(self._shape[0]) if trials is None else np.asarray(trials)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """
+        Shape of the view, (n_trials, n_vertices, n_times)
+        """
+        return len(self.trials), self._shape[1], self._shape[2]
+
+    @property
+    def ndim(self) -> int:
+        """
+        Always 3, trials x vertices x times
+        """
+        return 3
+
+    def __len__(self) -> int:
+        return len(self.trials)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            idx = [i for i, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:idx] + (slice(None),) * (3 - len(key) + 1) + key[idx + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        trial_key, vertex_key, time_key = key
+
+        trials = self.trials[trial_key]
+        single = np.ndim(trials) == 0
+        if not single and _is_full(vertex_key) and _is_full(time_key):
+            return ChunkedArray(self.data_dir, trials=trials, n_jobs=self.n_jobs)
+
+        # Single trial or integer time index: read them as batches of one and drop the axes
+        trials = np.atleast_1d(trials)
+        if isinstance(time_key, (int, np.integer)):
+            time = range(self._shape[2])[time_key]
+            data = self._read(trials, times=slice(time, time + 1))[:, vertex_key, 0]
+        else:
+            data = self._read(trials, times=time_key)[:, vertex_key]
+        return data[0] if single else data
+
+    def read(self, trials=None, times=slice(None)) -> np.array:
+        """
+        Read a subset of trials and a time range
+        :param trials: indices of the trials, relative to this view. All the trials of the view if None
+        :param times: slice along the time axis
+        :return:
+            n_trials x n_vertices x n_selected_times
+        """
+        return self._read(self.trials if trials is None else self.trials[np.asarray(trials)], times=times)
+
+    def _read(self, trials: np.array, times=slice(None)) -> np.array:
+        """
+        Read trials of the dataset, only decompressing the chunks they overlap
+        :param trials: indices of the trials in the whole dataset
+        :param times: slice along the time axis
+        :return:
+            n_trials x n_vertices x n_selected_times
+        """
+
+        t_idx = np.arange(self._shape[2])[times]
+
+        out = np.empty((len(trials), self._shape[1], len(t_idx)), dtype=self.dtype)
+        if out.size == 0:
+            return out
+
+        trial_blocks = trials // self.trial_block
+        time_blocks = range(t_idx.min() // self.time_block, t_idx.max() // self.time_block + 1)
+        needed = [(i, j) for i in np.unique(trial_blocks) for j in time_blocks]
+
+        chunks = Parallel(n_jobs=self.n_jobs, prefer="threads")(delayed(self._read_chunk)(i, j) for i, j in needed)
+        chunks = dict(zip(needed, chunks))
+
+        first_time = time_blocks[0] * self.time_block
+        for i in np.unique(trial_blocks):
+            block = np.concatenate([chunks[(i, j)] for j in time_blocks], axis=2)
+            rows = np.flatnonzero(trial_blocks == i)
+            out[rows] = block[trials[rows] - i * self.trial_block][:, :, t_idx - first_time]
+
+        return out
+
+    def _read_chunk(self, trial_block: int, time_block: int) -> np.array:
+        """
+        Read and decompress a single chunk
+        """
+
+        n_trials = min(self.trial_block, self._shape[0] - trial_block * self.trial_block)
+        n_times = min(self.time_block, self._shape[2] - time_block * self.time_block)
+
+        with open(self.data_dir / CHUNK_DIR / _chunk_fname(trial_block, time_block), "rb") as file:
+            data = file.read()
+        return _decode(data, self.dtype, (n_trials, self._shape[1], n_times), self.meta["codec"], self.meta["shuffle"])
+
+
+def _is_full(key) -> bool:
+    """
+    Whether an index selects a whole axis
+    """
+    return isinstance(key, slice) and key == slice(None)
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import os
@@ -9,6 +10,7 @@ import numpy as np
 
 from typing import Union, Callable, Tuple, List
 from collections import OrderedDict
+from copy import copy
 from pathlib import Path
 
 from mne.io import read_raw_ctf, Raw
@@ -21,6 +23,9 @@ from src.utils.logger import get_logger
 logger = get_logger(file_name="file_access")
 logger.setLevel(logging.INFO)
 
+# Scale and offset per vertex of the `int16` datasets, 2 x n_vertices
+SCALE_FNAME = "x_scale.npy"
+
 
 def read_raw(src_dir: Path, dst_dir: Path, file_reader: Callable) -> Union[None, Raw]:
     """
@@ -97,6 +102,53 @@ def write_json(dir_path: Path, file_name: str, data):
         file.write(json_file)
 
 
+########################################################################################################################
+# Content hashes                                                                                                       #
+########################################################################################################################
+
+
+def get_file_hash(path: Path, block_size=2 ** 24) -> str:
+    """
+    Compute the SHA-1 hash of a file, reading it block by block
+    :param path: path to the file
+    :param block_size: number of bytes read at a time
+    :return:
+        hexadecimal digest
+    """
+
+    sha = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def get_array_hash(array: np.array) -> str:
+    """
+    Compute the SHA-1 hash of the content of an array
+    :param array: numpy array
+    :return:
+        hexadecimal digest
+    """
+
+    sha = hashlib.sha1()
+    sha.update(str((array.dtype.str, array.shape)).encode())
+    sha.update(np.ascontiguousarray(array).data)
+    return sha.hexdigest()
+
+
+def get_params_hash(*values) -> str:
+    """
+    Compute a short hash from a set of JSON serializable parameters, e.g. for naming cached files
+    :param values: parameters
+    :return:
+        hexadecimal digest (16 characters)
+    """
+
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
 ########################################################################################################################
 # File processing specific to MOUS dataset                                                                             #
 ########################################################################################################################
@@ -259,7 +311,7 @@ def read_scores(results_dir: Path):
             results = pickle.load(handle)
 
         if not meta:  # metadata is the same for all
-            mata = results["meta"]
+            meta = results["meta"]
 
         data.append(results["data"]["scores"])
 
@@ -267,22 +319,46 @@ def read_scores(results_dir: Path):
     return meta, data
 
 
-def read_data(data_dir: Path):
+def read_metadata(data_dir: Path) -> dict:
     """
-    todo comment
-    :param data_dir: todo data_dir
-    :return: todo return
+    Read the metadata of a dataset (`x_shape.json`). Datasets made before the layout was recorded are in the `epochs`
+    layout (n_epochs x n_vertices x n_times)
+    :param data_dir: directory of the dataset
+    :return:
+        metadata dictionary, with at least `layout`
     """
 
     json_path = data_dir / "x_shape.json"
+    meta = load_json(json_path) if json_path.exists() else {}
+    meta.setdefault("layout", "epochs")
+    return meta
+
+
+def read_data(data_dir: Path, mode="r"):
+    """
+    Read the data of a dataset, as a memory map when it was generated with `memmap=True`, or as a `ChunkedArray` for
+    chunked datasets. The array is in the layout and data type recorded in the metadata, see `read_metadata`. The
+    values of `int16` datasets are quantized, see `read_scale`
+    :param data_dir: directory of the dataset
+    :param mode: mode of the memory map, read-only by default. Chunked datasets are always read-only
+    :return:
+        data array
+    """
+
+    json_path = data_dir / "x_shape.json"
+    if json_path.exists() and read_metadata(data_dir).get("container") == "chunked":
+        from src.utils.chunked import ChunkedArray  # imported here, src.utils.chunked depends on this module
+        return ChunkedArray(data_dir)
+
     if json_path.exists():
 
         x_path = data_dir / "x.dat"
 
         if x_path.exists():
             json_data = load_json(data_dir / "x_shape.json")
-            print(tuple(json_data["shape"]))
-            x = np.memmap(str(x_path), dtype="float64", mode="r+", shape=tuple(json_data["shape"]))
+            logger.debug(f"Dataset of shape {tuple(json_data['shape'])} in {data_dir}")
+            x = np.memmap(str(x_path), dtype=json_data.get("dtype", "float64"), mode=mode,
+                          shape=tuple(json_data["shape"]))
             return x
         else:
             raise FileNotFoundError(f"'x.dat' file was not found in {data_dir}")
@@ -296,3 +372,150 @@ def read_data(data_dir: Path):
             raise FileNotFoundError(f"Neither JSON file nor 'x.npy' file was found in {data_dir}")
 
 
+def read_scale(data_dir: Path) -> Union[np.array, None]:
+    """
+    Read the quantization of an `int16` dataset
+    :param data_dir: directory of the dataset
+    :return:
+        scale and offset per vertex (float32, 2 x n_vertices), None if the dataset is not quantized
+    """
+
+    if read_metadata(data_dir).get("dtype") != "int16":
+        return None
+    return np.load(str(data_dir / SCALE_FNAME)).astype("float32")
+
+
+def dequantize(data: np.array, scale: Union[np.array, None], axis=1) -> np.array:
+    """
+    Convert a slice of an `int16` dataset back to float32. Only apply it to the slices that are used, not to the
+    whole dataset
+    :param data: slice of the dataset
+    :param scale: see `read_scale`. The data is returned as is if None
+    :param axis: axis of the vertices in `data`
+    :return:
+        float32 array, same shape as `data`
+    """
+
+    if scale is None:
+        return data
+
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    data = data.astype("float32")
+    data *= scale[0].reshape(shape)
+    data += scale[1].reshape(shape)
+    return data
+
+
+class Dataset:
+    """
+    Lazy view of a dataset: the data array (memory map or `ChunkedArray`) with a selection of trials and a time window.
+    Selecting (`select`) never reads anything, `read` only materializes the selected trials of the requested samples.
+    Trials are read in increasing order and by blocks, so that the memory map is scanned forward and int16 data is
+    converted to float32 one block at a time.
+    """
+
+    def __init__(self, data_dir: Path, block_size=256):
+        """
+        :param data_dir: directory of the dataset
+        :param block_size: number of trials read at a time
+        """
+
+        self.data_dir = Path(data_dir)
+        self.block_size = block_size
+
+        self.meta = read_metadata(self.data_dir)
+        self.scale = read_scale(self.data_dir)
+        self.x = read_data(self.data_dir, mode="r")
+
+        shape = tuple(self.meta["shape"]) if "shape" in self.meta else self.x.shape
+        n_trials, self.n_vertices, n_times = (shape[1], shape[2], shape[0]) if self.layout == "times" else shape
+
+        self.rows = np.arange(n_trials)
+        self.times = (0, n_times)
+
+    @property
+    def layout(self) -> str:
+        """
+        Layout of the data on disk, see `read_metadata`. Reads are always returned as trials x vertices x times
+        """
+        return self.meta["layout"]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """
+        Shape of the view, (n_trials, n_vertices, n_times)
+        """
+        return len(self.rows), self.n_vertices, self.times[1] - self.times[0]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def select(self, trials=None, subjects=None, times=None) -> "Dataset":
+        """
+        Narrow the view, without reading any data
+        :param trials: trials to keep, boolean mask or indices relative to the current view (e.g. `included`)
+        :param subjects: names of the subjects to keep, see the `subjects` metadata
+        :param times: (start, stop) samples to keep, relative to the current view
+        :return:
+            new view
+        """
+
+        view = copy(self)
+        view.meta = dict(self.meta)
+
+        if trials is not None:
+            view.rows = view.rows[np.asarray(trials)]
+
+        if subjects is not None:
+            subject_rows = [np.arange(*self.meta["subjects"][subject]) for subject in subjects]
+            view.rows = view.rows[np.isin(view.rows, np.concatenate(subject_rows))]
+
+        if times is not None:
+            start, stop = times
+            if not 0 <= start < stop <= self.shape[2]:
+                raise IndexError(f"Samples {start} - {stop} are out of the {self.shape[2]} samples of the view")
+            view.times = (self.times[0] + start, self.times[0] + stop)
+            if "tmin" in self.meta and "sfreq" in self.meta:
+                view.meta["tmin"] = self.meta["tmin"] + start / self.meta["sfreq"]
+
+        return view
+
+    def read(self, times=None) -> np.array:
+        """
+        Read the selected trials
+        :param times: (start, stop) samples to read, relative to the view. The whole time window of the view if None
+        :return:
+            n_trials x n_vertices x n_samples, in the order of the selection. float32 for int16 datasets
+        """
+
+        start, stop = (0, self.shape[2]) if times is None else times
+        if not 0 <= start <= stop <= self.shape[2]:
+            raise IndexError(f"Samples {start} - {stop} are out of the {self.shape[2]} samples of the view")
+        start, stop = self.times[0] + start, self.times[0] + stop
+
+        dtype = self.x.dtype if self.scale is None else np.dtype("float32")
+        out = np.empty((len(self.rows), self.n_vertices, stop - start), dtype=dtype)
+
+        order = np.argsort(self.rows, kind="stable")
+        for block_start in range(0, len(order), self.block_size):
+            block = order[block_start: block_start + self.block_size]
+            out[block] = dequantize(self._read_rows(self.rows[block], start, stop), self.scale)
+
+        return out
+
+    def _read_rows(self, rows: np.array, start: int, stop: int) -> np.array:
+        """
+        Read sorted rows of the whole dataset
+        :param rows: sorted trial indices
+        :param start: first sample
+        :param stop: last sample (excluded)
+        :return:
+            n_rows x n_vertices x n_samples, as stored
+        """
+
+        if self.meta.get("container") == "chunked":
+            return self.x.read(trials=rows, times=slice(start, stop))
+        if self.layout == "times":
+            return np.moveaxis(np.asarray(self.x[start: stop, rows]), 0, -1)
+        return np.asarray(self.x[..., start: stop][rows])
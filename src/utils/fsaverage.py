@@ -0,0 +1,201 @@
+import logging
+import os
+import pickle
+import re
+
+from functools import lru_cache
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from mne import Label, read_labels_from_annot, read_source_spaces
+
+from src.utils.file_access import read_json, write_json
+from src.utils.logger import get_logger
+
+logger = get_logger(file_name="fsaverage")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# FSAVERAGE RESOURCES                                                                                                  #
+########################################################################################################################
+# The fsaverage source space and parcellations are the same for every subject and every job. They are read once,       #
+# reduced to a compact vertex -> label index (int16) and a label name table, saved next to the source space and        #
+# memory-mapped by all the jobs afterwards.                                                                            #
+########################################################################################################################
+
+DATA_DIR = Path(__file__).parent.parent.parent / "data"
+
+# Target source space of the morphs, `<subjects_dir>/fsaverage/bem/<name>-src.fif`. Coarser spaces such as
+# `fsaverage-ico-4` or `fsaverage-oct-6` can be made with `mne.setup_source_space` and selected with `src-name`
+DEFAULT_SRC_NAME = "fsaverage-ico-5"
+
+
+class FsaverageResources:
+    """
+    Source space vertices, normals and vertex -> label index of a parcellation on fsaverage.
+    `label_index[row]` is the index of the label (as in `data/<parcellation>-idx_to_name.pickle`) of the source estimate
+    row `row` (left hemisphere first), or -1 if the vertex does not belong to any label of interest.
+    """
+
+    def __init__(self, vertices: List[np.array], label_index: np.array, names: List[str], normals=None):
+        """
+        :param vertices: vertices of the source space, [left hemisphere, right hemisphere]
+        :param label_index: vertex -> label index, int16 array of shape (n_vertices,)
+        :param names: label names, `names[idx]` is the name of the label with index `idx`
+        :param normals: surface normals of the source space vertices, n_vertices x 3, rows in the same order as
+            `label_index`. Needed for the sign flips of the label summaries
+        """
+
+        self.vertices = vertices
+        self.normals = normals
+        self.label_index = label_index
+        self.names = names
+        self.name_to_idx = {name: idx for idx, name in enumerate(names)}
+
+    def get_rows(self, name: str) -> np.array:
+        """
+        Rows of the source estimate that belong to a label, same as `stc.in_label(label)`
+        :param name: name of the label, e.g. `bankssts-lh`
+        :return:
+            sorted array of row indices
+        """
+        return np.flatnonzero(self.label_index == self.name_to_idx[name])
+
+    def get_label_rows(self) -> dict:
+        """
+        Rows of all the labels at once
+        :return:
+            {label name: sorted array of row indices}, in the order of the name table
+        """
+
+        order = np.argsort(self.label_index, kind="stable")
+        bounds = np.searchsorted(self.label_index[order], np.arange(len(self.names) + 1))
+        return {name: order[bounds[idx]: bounds[idx + 1]] for idx, name in enumerate(self.names)}
+
+
+@lru_cache(maxsize=None)
+def get_fsaverage_resources(subjects_dir, parcellation: str, src_name=DEFAULT_SRC_NAME,
+                            resource_dir=None) -> FsaverageResources:
+    """
+    Get the fsaverage resources for a parcellation. Built and saved on the first call, memory-mapped afterwards.
+    Results are also kept in memory for the lifetime of the process.
+    :param subjects_dir: FreeSurfer subjects directory
+    :param parcellation: name of the parcellation, e.g. `aparc` or `aparc_sub`
+    :param src_name: name of the fsaverage source space, `<subjects_dir>/fsaverage/bem/<src_name>-src.fif`
+    :param resource_dir: directory in which the resources are saved, `<subjects_dir>/fsaverage/resources` by default
+    :return:
+        FsaverageResources
+    """
+
+    if resource_dir is None:
+        resource_dir = Path(subjects_dir) / "fsaverage" / "resources"
+    resource_dir = Path(resource_dir)
+
+    index_path = resource_dir / f"{parcellation}-{src_name}-label-index.npy"
+    names_fname = f"{parcellation}-names.json"
+    vertices_paths = [resource_dir / f"{src_name}-vertices-{hemi}.npy" for hemi in ("lh", "rh")]
+    normals_path = resource_dir / f"{src_name}-normals.npy"
+
+    paths = [index_path, resource_dir / names_fname, normals_path] + vertices_paths
+    if not all(path.exists() for path in paths):
+        _build_resources(subjects_dir, parcellation, src_name, resource_dir)
+
+    vertices = [np.load(str(path), mmap_mode="r") for path in vertices_paths]
+    normals = np.load(str(normals_path), mmap_mode="r")
+    label_index = np.load(str(index_path), mmap_mode="r")
+    names = read_json(resource_dir, names_fname)["names"]
+
+    return FsaverageResources(vertices=vertices, label_index=label_index, names=names, normals=normals)
+
+
+def _build_resources(subjects_dir, parcellation: str, src_name: str, resource_dir: Path) -> None:
+    """
+    Read the fsaverage source space and labels and save the vertices, normals, vertex -> label index and name table
+    :param subjects_dir: FreeSurfer subjects directory
+    :param parcellation: name of the parcellation
+    :param src_name: name of the fsaverage source space
+    :param resource_dir: directory in which the resources are saved
+    """
+
+    logger.info(f"Building fsaverage resources for {parcellation} on {src_name}")
+
+    if not resource_dir.exists():
+        os.makedirs(resource_dir, exist_ok=True)
+
+    src = read_source_spaces(str(Path(subjects_dir) / "fsaverage" / "bem" / f"{src_name}-src.fif"), verbose=False)
+    vertices = [s["vertno"] for s in src]
+    normals = np.concatenate([s["nn"][s["vertno"]] for s in src])
+
+    labels = read_labels_from_annot("fsaverage", parcellation, "both", subjects_dir=subjects_dir, verbose=False)
+    names = get_label_names(parcellation, labels)
+    name_to_idx = {name: idx for idx, name in enumerate(names)}
+
+    label_index = np.full(sum(len(v) for v in vertices), -1, dtype="int16")
+    for label in labels:
+        if label.name in name_to_idx:
+            label_index[get_label_rows(vertices, label)] = name_to_idx[label.name]
+
+    # Write to temporary files first, concurrent jobs may be building the same resources
+    suffix = f".{os.getpid()}.npy"
+    for hemi, vertno in zip(("lh", "rh"), vertices):
+        _save_atomic(resource_dir / f"{src_name}-vertices-{hemi}.npy", vertno, suffix)
+    _save_atomic(resource_dir / f"{src_name}-normals.npy", normals, suffix)
+    _save_atomic(resource_dir / f"{parcellation}-{src_name}-label-index.npy", label_index, suffix)
+
+    tmp_fname = f".{parcellation}-names.{os.getpid()}.json"
+    write_json(resource_dir, file_name=tmp_fname, data={"names": names})
+    os.replace(resource_dir / tmp_fname, resource_dir / f"{parcellation}-names.json")
+
+
+def _save_atomic(path: Path, array: np.array, suffix: str) -> None:
+    """
+    Save an array under a temporary name and rename it
+    :param path: final path of the `.npy` file
+    :param array: array to save
+    :param suffix: suffix of the temporary file
+    """
+
+    tmp_path = path.parent / f".{path.stem}{suffix}"
+    np.save(str(tmp_path), array)
+    os.replace(tmp_path, path)
+
+
+def get_label_names(parcellation: str, labels: List[Label]) -> List[str]:
+    """
+    Get the label name table of a parcellation. Uses `data/<parcellation>-idx_to_name.pickle` when available, so that
+    label indices match the area IDs of the Slurm jobs, otherwise the relevant labels in the order of the annotation.
+    :param parcellation: name of the parcellation
+    :param labels: labels of the parcellation
+    :return:
+        list of names, the position in the list is the label index
+    """
+
+    pickle_path = DATA_DIR / f"{parcellation}-idx_to_name.pickle"
+    if pickle_path.exists():
+        with open(pickle_path, "rb") as handle:
+            idx_to_name = pickle.load(handle)
+        return [idx_to_name[idx] for idx in range(len(idx_to_name))]
+
+    # Ignore irrelevant labels
+    return [label.name for label in labels
+            if not re.match(r".*(unknown|\?|deeper|cluster|default|ongur|medial\.wall).*", label.name.lower())]
+
+
+def get_label_rows(vertices: List[np.array], label: Label) -> np.array:
+    """
+    Find the rows of a source estimate that belong to a label. Equivalent to `stc.in_label(label)` but only computes
+    the indices, so that they can be reused for every epoch.
+    :param vertices: vertices of the source estimate, [left hemisphere, right hemisphere]
+    :param label: cortical area of interest
+    :return:
+        sorted array of row indices
+    """
+
+    if label.hemi == "lh":
+        offset, vertno = 0, vertices[0]
+    else:
+        offset, vertno = len(vertices[0]), vertices[1]
+
+    return offset + np.flatnonzero(np.isin(vertno, label.vertices))
@@ -0,0 +1,224 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+from src.utils.file_access import get_file_hash
+from src.utils.logger import get_logger
+from src.utils.source_store import STORE_NAME, read_store_index
+
+logger = get_logger(file_name="manifest")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# MANIFEST                                                                                                             #
+########################################################################################################################
+# Index of the epochs directory, `epochs-dir/manifest.jsonl`. Each line is a JSON record describing one file of one    #
+# subject (epochs, events or source store) with its shape, dtype and content hash. The records are appended by the     #
+# preprocessing and source localization jobs, the later records of a file replace the earlier ones. Consumers read the #
+# manifest once instead of listing the directory and opening every subject directory. Subjects processed before the    #
+# manifest existed (or without it) are not in it, `build_manifest` indexes them.                                       #
+########################################################################################################################
+
+MANIFEST_FNAME = "manifest.jsonl"
+
+
+def add_record(epoch_dir: Path, record: dict) -> None:
+    """
+    Append a record to the manifest. The file is locked while writing, many subjects are processed at the same time
+    :param epoch_dir: directory containing all epochs
+    :param record: JSON serializable record, should contain `subject` and `kind`
+    """
+
+    with open(epoch_dir / MANIFEST_FNAME, "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.write(_to_line(record))
+            file.flush()
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def read_manifest(epoch_dir: Path) -> dict:
+    """
+    Read the manifest of the epochs directory
+    :param epoch_dir: directory containing all epochs
+    :return:
+        {subject: {"epochs": record, "events": record, "stores": {store name: record}}}, empty if there is no manifest
+    """
+
+    manifest_path = epoch_dir / MANIFEST_FNAME
+    if not manifest_path.exists():
+        return {}
+
+    subjects = {}
+    with open(manifest_path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+
+            subject = subjects.setdefault(record["subject"], {"stores": {}})
+            if record["kind"] == "store":
+                subject["stores"][record["name"]] = record
+            else:
+                subject[record["kind"]] = record
+
+    return subjects
+
+
+def record_epochs(epoch_dir: Path, subject: str, epochs_path: Path, n_epochs: int) -> None:
+    """
+    Add the epochs file of a subject to the manifest
+    :param epoch_dir: directory containing all epochs
+    :param subject: name of the subject
+    :param epochs_path: path to the `-epo.fif` file
+    :param n_epochs: number of epochs
+    """
+    add_record(epoch_dir, _epochs_record(epoch_dir, subject, epochs_path, n_epochs))
+
+
+def record_events(epoch_dir: Path, subject: str, events_path: Path) -> None:
+    """
+    Add the events array of a subject to the manifest
+    :param epoch_dir: directory containing all epochs
+    :param subject: name of the subject
+    :param events_path: path to `events.npy`
+    """
+    add_record(epoch_dir, _events_record(epoch_dir, subject, events_path))
+
+
+def record_store(epoch_dir: Path, subject: str, stc_dir: Path, name=STORE_NAME) -> None:
+    """
+    Add a (complete) source store of a subject to the manifest, with the vertex slice of every label
+    :param epoch_dir: directory containing all epochs
+    :param subject: name of the subject
+    :param stc_dir: directory of the subject source data
+    :param name: name of the store
+    """
+
+    record = _store_record(epoch_dir, subject, stc_dir, name)
+    if record is None:
+        raise FileNotFoundError(f"No complete source store {name} found in {stc_dir}")
+    add_record(epoch_dir, record)
+
+
+def build_manifest(epoch_dir: Path) -> None:
+    """
+    Create the manifest from the content of an existing epochs directory, e.g. for subjects processed before the
+    manifest was introduced. Replaces any existing manifest. `.npy` files of single labels are not indexed.
+    :param epoch_dir: directory containing all epochs
+    """
+
+    records = []
+    for subject in sorted(os.listdir(epoch_dir)):
+        subject_dir = epoch_dir / subject
+        if not re.match(r"^sub-[AV]\d+$", subject) or not subject_dir.is_dir():
+            continue
+
+        events_path = subject_dir / "events.npy"
+        if events_path.exists():
+            records.append(_events_record(epoch_dir, subject, events_path))
+
+            # The events are saved together with the epochs, one event per epoch
+            epochs_path = subject_dir / f"{subject}-epo.fif"
+            if epochs_path.exists():
+                records.append(_epochs_record(epoch_dir, subject, epochs_path, records[-1]["shape"][0]))
+
+        stc_dir = subject_dir / "stc"
+        if stc_dir.exists():
+            store_names = [fname[:-len(".json")] for fname in sorted(os.listdir(stc_dir))
+                           if fname.startswith(STORE_NAME) and fname.endswith(".json")]
+            records.extend(record for record in (_store_record(epoch_dir, subject, stc_dir, name)
+                                                 for name in store_names) if record is not None)
+
+    tmp_fname = f".{MANIFEST_FNAME}.{os.getpid()}"
+    with open(epoch_dir / tmp_fname, "w") as file:
+        file.writelines(_to_line(record) for record in records)
+    os.replace(epoch_dir / tmp_fname, epoch_dir / MANIFEST_FNAME)
+
+    logger.info(f"Manifest built with {len(records)} records in {epoch_dir}")
+
+
+def _epochs_record(epoch_dir: Path, subject: str, epochs_path: Path, n_epochs: int) -> dict:
+    """
+    Record of an epochs file, see `record_epochs`
+    """
+    return {"subject": subject, "kind": "epochs", "path": _relative(epoch_dir, epochs_path),
+            "n-epochs": int(n_epochs), "hash": get_file_hash(epochs_path)}
+
+
+def _events_record(epoch_dir: Path, subject: str, events_path: Path) -> dict:
+    """
+    Record of an events array, see `record_events`
+    """
+
+    events = np.load(str(events_path), mmap_mode="r")
+    return {"subject": subject, "kind": "events", "path": _relative(epoch_dir, events_path),
+            "shape": list(events.shape), "dtype": events.dtype.name, "hash": get_file_hash(events_path)}
+
+
+def _store_record(epoch_dir: Path, subject: str, stc_dir: Path, name: str) -> Union[dict, None]:
+    """
+    Record of a source store, see `record_store`. None if the store is missing or incomplete
+    """
+
+    index = read_store_index(stc_dir, name=name)
+    if index is None:
+        return None
+
+    store_path = stc_dir / f"{name}.dat"
+    record = {key: value for key, value in index.items() if key != "complete"}
+    record.update({"subject": subject, "kind": "store", "name": name, "path": _relative(epoch_dir, store_path),
+                   "hash": _get_store_hash(stc_dir, name)})
+    return record
+
+
+def _get_store_hash(stc_dir: Path, name: str) -> str:
+    """
+    Fingerprint of a source store: SHA-1 of its index (labels, shape, dtype, time axis) with the size and modification
+    time of the data file. The data itself (several GB per subject) is not read
+    :param stc_dir: directory of the subject source data
+    :param name: name of the store
+    :return:
+        hexadecimal digest
+    """
+
+    stat = os.stat(stc_dir / f"{name}.dat")
+    with open(stc_dir / f"{name}.json", "rb") as file:
+        sha = hashlib.sha1(file.read())
+    sha.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return sha.hexdigest()
+
+
+def _to_line(record: dict) -> str:
+    """
+    Serialize a record to a line of the manifest, with the time it was written
+    """
+    return json.dumps(dict(record, time=time.strftime("%Y-%m-%dT%H:%M:%S")), ensure_ascii=False) + "\n"
+
+
+def _relative(epoch_dir: Path, path: Path) -> str:
+    """
+    Paths are saved relative to the epochs directory, so that the directory can be moved
+    :param epoch_dir: directory containing all epochs
+    :param path: path of a file inside the epochs directory
+    :return:
+        relative path
+    """
+    return str(Path(path).relative_to(epoch_dir))
+
+
+if __name__ == "__main__":
+
+    # Build the manifest of an existing epochs directory, e.g. `python -m src.utils.manifest <epochs-dir>`
+    build_manifest(Path(sys.argv[1]))
@@ -0,0 +1,135 @@
+import logging
+import os
+
+from pathlib import Path
+from typing import Tuple, Union
+
+import numpy as np
+
+from src.utils.file_access import load_json, write_json
+from src.utils.logger import get_logger
+
+logger = get_logger(file_name="source-store")
+logger.setLevel(logging.INFO)
+
+########################################################################################################################
+# SOURCE STORE                                                                                                         #
+########################################################################################################################
+# Per-subject store of the source localization results: a single preallocated memmap `stc/store.dat` of shape          #
+# (n_epochs, n_vertices, n_times) holding the vertices of all the labels one after the other, and an index             #
+# `stc/store.json` mapping each label to its vertex slice. One label is read as a view, without copying.               #
+# Label summaries (see `LabelSummary`) are written next to it in stores with the same layout, e.g. `store-mean_flip`.  #
+########################################################################################################################
+
+STORE_NAME = "store"
+STORE_FNAME = f"{STORE_NAME}.dat"
+INDEX_FNAME = f"{STORE_NAME}.json"
+
+
+def get_summary_store_name(mode: str) -> str:
+    """
+    Name of the store holding the label summaries of a given mode
+    :param mode: summary mode, e.g. `mean_flip`
+    :return:
+        store name, e.g. `store-mean_flip`
+    """
+    return f"{STORE_NAME}-{mode}"
+
+
+def create_store(stc_dir: Path, label_slices: dict, shape: tuple, dtype="float32", meta=None,
+                 name=STORE_NAME) -> np.memmap:
+    """
+    Preallocate the store of a subject. The index is marked as incomplete until `close_store` is called.
+    :param stc_dir: directory of the subject source data, e.g. `epochs-dir/sub-V1001/stc`
+    :param label_slices: {label name: (start, stop)} along the vertex axis
+    :param shape: (n_epochs, n_vertices, n_times)
+    :param dtype: data type of the store
+    :param meta: additional information to save in the index, e.g. `tmin` and `sfreq`
+    :param name: name of the store, files are `<name>.dat` and `<name>.json`
+    :return:
+        writable memory map
+    """
+
+    if not stc_dir.exists():
+        os.makedirs(stc_dir)
+
+    index = {"shape": list(shape), "dtype": np.dtype(dtype).name,
+             "labels": {name: [int(start), int(stop)] for name, (start, stop) in label_slices.items()},
+             "complete": False}
+    index.update(meta or {})
+    write_json(stc_dir, file_name=f"{name}.json", data=index)
+
+    logger.info(f"Creating source store {name}.dat of shape {tuple(shape)} in {stc_dir}")
+    return np.memmap(str(stc_dir / f"{name}.dat"), dtype=dtype, mode="w+", shape=tuple(shape))
+
+
+def close_store(stc_dir: Path, x_map: np.memmap, name=STORE_NAME) -> None:
+    """
+    Flush the store to disk and mark it as complete
+    :param stc_dir: directory of the subject source data
+    :param x_map: memory map returned by `create_store`
+    :param name: name of the store
+    """
+
+    x_map.flush()
+
+    index = load_json(stc_dir / f"{name}.json")
+    index["complete"] = True
+    write_json(stc_dir, file_name=f"{name}.json", data=index)
+
+
+def read_store_index(stc_dir: Path, name=STORE_NAME) -> Union[dict, None]:
+    """
+    Read the index of the store of a subject
+    :param stc_dir: directory of the subject source data
+    :param name: name of the store
+    :return:
+        index dictionary, or None if there is no complete store in the directory
+    """
+
+    index_path = stc_dir / f"{name}.json"
+    if not index_path.exists():
+        return None
+
+    index = load_json(index_path)
+    if not index.get("complete", False):
+        logger.info(f"Source store in {stc_dir} is incomplete. Ignoring...")
+        return None
+    return index
+
+
+def read_store(stc_dir: Path, mode="r", name=STORE_NAME) -> Tuple[np.memmap, dict]:
+    """
+    Open the store of a subject
+    :param stc_dir: directory of the subject source data
+    :param mode: memmap mode
+    :param name: name of the store
+    :return:
+        memory map of shape (n_epochs, n_vertices, n_times), index
+    """
+
+    index = read_store_index(stc_dir, name=name)
+    if index is None:
+        raise FileNotFoundError(f"No complete source store {name} found in {stc_dir}")
+
+    x_map = np.memmap(str(stc_dir / f"{name}.dat"), dtype=index["dtype"], mode=mode, shape=tuple(index["shape"]))
+    return x_map, index
+
+
+def read_label(stc_dir: Path, label_name: str, name=STORE_NAME) -> np.memmap:
+    """
+    Read the data of a single label, as a view of the store (no copy)
+    :param stc_dir: directory of the subject source data
+    :param label_name: exact name of the label, e.g. `bankssts-lh`
+    :param name: name of the store
+    :return:
+        n_epochs x n_label_vertices x n_times (n_components instead of n_label_vertices for a summary store)
+    """
+
+    x_map, index = read_store(stc_dir, name=name)
+
+    if label_name not in index["labels"]:
+        raise KeyError(f"Label {label_name} is not in the source store of {stc_dir}")
+
+    start, stop = index["labels"][label_name]
+    return x_map[:, start: stop]
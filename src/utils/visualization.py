@@ -1,11 +1,15 @@
+import re
+
 import numpy as np
 import seaborn as sns
 
-from mne import read_source_spaces, SourceEstimate
+from pathlib import Path
+
+from mne import SourceEstimate
 from matplotlib import pyplot as plt
 from matplotlib import gridspec
 
-from src.utils.file_access import read_labels
+from src.utils.fsaverage import get_fsaverage_resources
 
 
 # todo finish this file
@@ -181,32 +185,64 @@ def plot_multiple_areas(result_list, stats, figsize=(15, 5), alpha=.9,
     return fig
 
 
-def _make_source_estimate(meta, data, src_path, parc, hemi, subjects_dir, center_chance=True, percentage=True):
-    src = read_source_spaces(src_path)
-    labels = read_labels(parc=parc, subject="fsvaverage", hemi=hemi, subjects_dir=subjects_dir)
-
-    n_times = data.shape[1]
-    accuracy = np.zeros((src[0]["np"] * 2, n_times))  # 2 (hemispheres) x number sources, time steps
+def _make_source_estimate(meta, data, src_path, parc, hemi, subjects_dir, center_chance=True, percentage=True,
+                          names=None):
+    """
+    Source estimate of the scores of the labels, for plotting. The score of a label is given to the vertices of the
+    fsaverage source space `src_path` that belong to the label (e.g. 10242 vertices per hemisphere for ico-5), not to
+    every vertex of the surface. MNE interpolates between them when the source estimate is plotted
+    :param meta: results metadata, should contain `sfreq`
+    :param data: scores, cv x time steps x labels, e.g. from `read_scores`
+    :param src_path: path to the fsaverage source space, `<subjects_dir>/fsaverage/bem/<src_name>-src.fif`
+    :param parc: parcellation of the labels
+    :param hemi: hemisphere to show, `lh`, `rh` or `both`
+    :param subjects_dir: FreeSurfer subjects directory
+    :param center_chance: if true, chance level (.5) is shown as 0
+    :param percentage: if true, scores are shown in percent
+    :param names: label of every column of `data`. By default the columns are all the labels of the parcellation sorted
+        by name, the order in which `read_scores` loads the results files (`<label name>.pickle`)
+    :return:
+        source estimate, n_vertices x time steps
+    """
+
+    src_name = re.sub(r"-src\.fif$", "", Path(src_path).name)
+    resources = get_fsaverage_resources(subjects_dir, parc, src_name=src_name)
 
     center = .5 if center_chance else 0.
     rescale = 100 if percentage else 1
 
-    for i, label in enumerate(labels):
-        if label.name.startswith("unknown"):
-            continue
+    names = sorted(resources.names) if names is None else list(names)
+    if len(names) != data.shape[2]:
+        raise ValueError(f"The scores have {data.shape[2]} labels, {len(names)} label names given")
 
-        vertices = label.get_vertices_used(np.arange(src[0]["np"]))
-        accuracy[vertices] = (data.mean(axis=0)[:, i] - center) * rescale
+    # Column of `data` of every label of the name table, -1 if the label has no scores
+    columns = np.full(len(resources.names), -1)
+    columns[[resources.name_to_idx[name] for name in names]] = np.arange(len(names))
+
+    # Average score per time step and label
+    scores = (data.mean(axis=0) - center) * rescale
+
+    # Vertices of the labels to show
+    label_index = np.asarray(resources.label_index)
+    in_hemi = np.array([hemi == "both" or name.endswith(f"-{hemi}") for name in resources.names])
+    inside = label_index >= 0
+    inside[inside] = in_hemi[label_index[inside]] & (columns[label_index[inside]] >= 0)
+
+    n_times = data.shape[1]
+    accuracy = np.zeros((label_index.size, n_times))  # number of sources (both hemispheres), time steps
+    accuracy[inside] = scores[:, columns[label_index[inside]]].T
 
     tstep = 1e3 / meta["sfreq"]
-    stc = SourceEstimate(accuracy, tmin=0, tstep=tstep, vertices=[np.arange(src[0]["np"]), np.arange(src[0]["np"])],
+    stc = SourceEstimate(accuracy, tmin=0, tstep=tstep, vertices=[np.asarray(v) for v in resources.vertices],
                          subject="fsaverage")
     return stc
 
 
-def plot_spatiotemporal_accuracy(meta, data, src_path, parc, hemi, subjects_dir, center_chance=True, percentage=True):
+def plot_spatiotemporal_accuracy(meta, data, src_path, parc, hemi, subjects_dir, center_chance=True, percentage=True,
+                                 names=None):
     stc = _make_source_estimate(meta=meta, data=data, src_path=src_path, parc=parc, hemi=hemi,
-                                subjects_dir=subjects_dir, center_chance=center_chance, percentage=percentage)
+                                subjects_dir=subjects_dir, center_chance=center_chance, percentage=percentage,
+                                names=names)
 
 
 def plot_pie(df, key, labels, title, colors, figsize=(5, 5)):
@@ -0,0 +1,149 @@
+"""
+Shared fixtures: a small epochs directory as written by the source localization (one source store `stc/store.dat` and
+one events array per subject, random data of 3 labels / 9 vertices at 10 Hz from -0.5 s), a small EEG sphere model
+standing in for a subject of the source localization, and a stand-in for the fsaverage source space and parcellations.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import mne
+
+from src.utils import fsaverage as fsaverage_module
+from src.utils.source_store import close_store, create_store
+
+TMIN, SFREQ, N_TIMES = -0.5, 10., 20
+
+
+@pytest.fixture(scope="session")
+def labels() -> dict:
+    """
+    {label name: (first vertex, last vertex excluded)} of the source stores
+    """
+
+    return {"bankssts-lh": (0, 3), "bankssts_1-lh": (3, 5), "fusiform-rh": (5, 9)}
+
+
+@pytest.fixture(scope="session")
+def make_subject(labels):
+    """
+    Write the source store and the events of a subject, see `_make_subject`
+    """
+
+    def _make_subject(epoch_dir: Path, subject: str, n_epochs: int, rng: np.random.Generator,
+                      dtype="float32") -> tuple:
+        """
+        :param epoch_dir: epochs directory
+        :param subject: name of the subject, e.g. `sub-V1000`
+        :param n_epochs: number of epochs
+        :param rng: random generator of the data and of the event codes
+        :param dtype: data type of the store
+        :return:
+            source data (n_epochs x n_vertices x n_times) and event codes
+        """
+
+        subject_dir = epoch_dir / subject
+        subject_dir.mkdir(parents=True)
+
+        x = rng.standard_normal((n_epochs, 9, N_TIMES)).astype(dtype)
+        store = create_store(subject_dir / "stc", labels, x.shape, dtype=dtype, meta={"tmin": TMIN, "sfreq": SFREQ})
+        store[:] = x
+        close_store(subject_dir / "stc", store)
+
+        events = np.zeros((n_epochs, 3), dtype=int)
+        events[:, 2] = rng.integers(1, 3, n_epochs)
+        np.save(str(subject_dir / "events.npy"), events)
+        return x, events[:, 2]
+
+    return _make_subject
+
+
+@pytest.fixture
+def epoch_dir(tmp_path, make_subject) -> tuple:
+    """
+    Epochs directory of 3 subjects, subject i has 10 + i epochs
+    :return:
+        path to the directory, {subject: (source data, event codes)}
+    """
+
+    rng = np.random.default_rng(0)
+    epoch_dir = tmp_path / "epochs"
+    truth = {f"sub-V10{i:02d}": make_subject(epoch_dir, f"sub-V10{i:02d}", 10 + i, rng) for i in range(3)}
+    return epoch_dir, truth
+
+
+@pytest.fixture(scope="session")
+def get_expected(labels):
+    """
+    Data and labels a dataset of an area should hold, see `_get_expected`
+    """
+
+    def _get_expected(truth: dict, subjects: list, area: str, t_start=0, t_stop=N_TIMES) -> tuple:
+        """
+        :param truth: {subject: (source data, event codes)}, see `epoch_dir`
+        :param subjects: subjects of the dataset in its order, see `x_shape.json`
+        :param area: name of the area
+        :param t_start: first time sample
+        :param t_stop: last time sample (excluded)
+        :return:
+            n_epochs x n_vertices x n_times data, event codes
+        """
+
+        v_start, v_stop = labels[area]
+        x = np.concatenate([truth[subject][0][:, v_start: v_stop, t_start: t_stop] for subject in subjects])
+        y = np.concatenate([truth[subject][1] for subject in subjects])
+        return x, y
+
+    return _get_expected
+
+
+@pytest.fixture(scope="session")
+def sphere_subject() -> tuple:
+    """
+    Epochs, free orientation forward solution and noise covariance of an EEG sphere model with a volume source space
+    """
+
+    mne.set_log_level("ERROR")
+    montage = mne.channels.make_standard_montage("standard_1020")
+    info = mne.create_info(montage.ch_names[:60], 200., "eeg")
+    info.set_montage(montage)
+
+    sphere = mne.make_sphere_model("auto", "auto", info)
+    src = mne.setup_volume_source_space(sphere=sphere, pos=25.)
+    fwd = mne.make_forward_solution(info, None, src, sphere)
+
+    rng = np.random.default_rng(0)
+    epochs = mne.EpochsArray(rng.standard_normal((12, 60, 50)) * 1e-6, info, tmin=-0.1)
+    epochs.set_eeg_reference(projection=True)
+    cov = mne.compute_covariance(epochs, tmax=0.)
+    return epochs, fwd, cov
+
+
+@pytest.fixture
+def fsaverage(tmp_path, monkeypatch) -> tuple:
+    """
+    Stand-in for fsaverage: a source space of 10 + 8 vertices and two parcellations, `parc_a` (with an `unknown` label
+    that is ignored) and `parc_b`. The label vertices include vertices that are not in the source space.
+    :return:
+        subjects directory, vertices of the source space, {parcellation: labels}
+    """
+
+    vertices = [np.arange(0, 20, 2), np.arange(3, 11)]
+    normals = np.random.default_rng(0).normal(size=(18, 3))
+    src = [{"vertno": vertices[0], "nn": np.zeros((20, 3))}, {"vertno": vertices[1], "nn": np.zeros((11, 3))}]
+    src[0]["nn"][vertices[0]], src[1]["nn"][vertices[1]] = normals[:10], normals[10:]
+
+    parcellations = {
+        "parc_a": [mne.Label(np.arange(0, 7), hemi="lh", name="a1-lh"),
+                   mne.Label(np.array([8, 10, 11, 12]), hemi="lh", name="a2-lh"),
+                   mne.Label(np.array([14, 16]), hemi="lh", name="unknown-lh"),
+                   mne.Label(np.arange(0, 6), hemi="rh", name="a1-rh")],
+        "parc_b": [mne.Label(np.array([16, 18]), hemi="lh", name="b1-lh"),
+                   mne.Label(np.arange(6, 11), hemi="rh", name="b1-rh")]}
+
+    monkeypatch.setattr(fsaverage_module, "read_source_spaces", lambda *args, **kwargs: src)
+    monkeypatch.setattr(fsaverage_module, "read_labels_from_annot",
+                        lambda subject, parcellation, *args, **kwargs: parcellations[parcellation])
+    return tmp_path / "subjects", vertices, parcellations
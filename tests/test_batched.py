@@ -0,0 +1,89 @@
+"""
+The batched fits must give the decision functions of a reference fitted at each time point on its own: the sklearn
+pipeline for `Ridge`, the shrinkage LDA written out for `LDA`. Both with fewer features than trials (primal form) and
+with more (dual form).
+"""
+
+import numpy as np
+import pytest
+
+from sklearn.covariance import ledoit_wolf_shrinkage
+from sklearn.linear_model import RidgeClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from src.mvpa.batched import classify_batched, fit_batched
+from src.mvpa.classification import classify
+from src.mvpa.folds import FoldPlan
+
+N_TIMES, N_TRIALS = 3, 40
+
+
+def _get_data(n_features: int) -> tuple:
+    """
+    Random windows with a class effect on the first features, and their fold plan
+    """
+
+    rng = np.random.default_rng(n_features)
+    x = rng.normal(size=(N_TIMES, N_TRIALS, n_features))
+    y = np.repeat([1, 2], N_TRIALS // 2)
+    x[:, y == 2, :3] += 1.
+    return x, y, FoldPlan.from_labels(y, 5, seed=0)
+
+
+def _get_lda_decision(x_train: np.array, y_train: np.array, x_test: np.array) -> np.array:
+    """
+    Decision function of a shrinkage LDA on standardized features: pooled within-class covariance, Ledoit-Wolf
+    shrinkage of the trials centered on their class means
+    """
+
+    mean, std = x_train.mean(axis=0), x_train.std(axis=0)
+    z = (x_train - mean) / std
+    classes = np.unique(y_train)
+    class_means = np.stack([z[y_train == c].mean(axis=0) for c in classes], axis=1)
+
+    centered = z - class_means.T[np.searchsorted(classes, y_train)]
+    emp_cov = centered.T @ centered / len(z)
+    shrinkage = ledoit_wolf_shrinkage(centered, assume_centered=True)
+    cov = (1 - shrinkage) * emp_cov + shrinkage * np.trace(emp_cov) / z.shape[1] * np.eye(z.shape[1])
+
+    coef = np.linalg.solve(cov, class_means)
+    priors = np.array([np.mean(y_train == c) for c in classes])
+    return ((x_test - mean) / std) @ coef - 0.5 * np.sum(class_means * coef, axis=0) + np.log(priors)
+
+
+@pytest.mark.parametrize("n_features", [5, 200])
+def test_ridge(n_features):
+    x, y, folds = _get_data(n_features)
+    for (train_idx, test_idx), (coef, intercept) in zip(folds.split(), fit_batched(x, y, folds, "Ridge", alpha=2.)):
+        for t in range(N_TIMES):
+            clf = make_pipeline(StandardScaler(), RidgeClassifier(alpha=2.)).fit(x[t, train_idx], y[train_idx])
+            decision = x[t, test_idx] @ coef[t] + intercept[t]
+            np.testing.assert_allclose(decision[:, 1], clf.decision_function(x[t, test_idx]), atol=1e-10)
+            np.testing.assert_allclose(decision[:, 0], -decision[:, 1], atol=1e-10)
+
+
+@pytest.mark.parametrize("n_features", [5, 200])
+def test_lda(n_features):
+    x, y, folds = _get_data(n_features)
+    for (train_idx, test_idx), (coef, intercept) in zip(folds.split(), fit_batched(x, y, folds, "LDA")):
+        for t in range(N_TIMES):
+            expected = _get_lda_decision(x[t, train_idx], y[train_idx], x[t, test_idx])
+            np.testing.assert_allclose(x[t, test_idx] @ coef[t] + intercept[t], expected, atol=1e-10)
+
+
+def test_scores():
+    x, y, folds = _get_data(5)
+    scores, _ = classify_batched(x, y, folds, "Ridge")
+
+    clf = make_pipeline(StandardScaler(), RidgeClassifier())
+    for t in range(N_TIMES):
+        expected, _ = classify(x[t], y[None], folds.n_splits, clf, roc_auc_score, folds=folds)
+        np.testing.assert_allclose(scores[:, t], expected)
+
+
+def test_dual_penalty():
+    x, y, folds = _get_data(200)
+    with pytest.raises(ValueError):
+        next(fit_batched(x, y, folds, "Ridge", alpha=0.))
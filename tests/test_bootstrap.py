@@ -0,0 +1,61 @@
+"""
+The vectorized intervals must be the percentiles of the means of explicit resamples of the folds, be reproducible with a
+seed, and not depend on how the time points were split between jobs or between blocks of columns.
+"""
+
+import numpy as np
+
+from src.mvpa.bootstrap import get_confidence_intervals, get_resample_counts
+from src.mvpa.classification import classify_temporal
+
+SCORES = np.random.default_rng(1).uniform(.4, 1., size=(20, 30))
+
+
+def test_resample_counts():
+    counts = get_resample_counts(20, n_bootstraps=100, seed=0)
+    assert counts.shape == (100, 20)
+    np.testing.assert_array_equal(counts.sum(axis=1), 20)
+
+
+def test_confidence_intervals():
+    lowers, uppers = get_confidence_intervals(SCORES, ci=.9, n_bootstraps=500, seed=0)
+
+    # Same draws, resampled explicitly
+    indices = np.random.default_rng(0).integers(0, len(SCORES), size=(500, len(SCORES)))
+    means = SCORES[indices].mean(axis=1)
+    np.testing.assert_allclose(lowers, np.percentile(means, 5, axis=0))
+    np.testing.assert_allclose(uppers, np.percentile(means, 95, axis=0))
+    assert np.all(lowers <= SCORES.mean(axis=0)) and np.all(uppers >= SCORES.mean(axis=0))
+
+    # Each column on its own gives the same bounds
+    lower, upper = get_confidence_intervals(SCORES[:, 3:4], ci=.9, n_bootstraps=500, seed=0)
+    np.testing.assert_allclose([lower[0], upper[0]], [lowers[3], uppers[3]])
+
+
+def test_blocks():
+    counts = get_resample_counts(len(SCORES), n_bootstraps=500, seed=0)
+    expected = get_confidence_intervals(SCORES, ci=.9, counts=counts, block_size=SCORES.shape[1])
+    np.testing.assert_allclose(get_confidence_intervals(SCORES, ci=.9, counts=counts, block_size=7), expected,
+                               rtol=1e-12)
+    np.testing.assert_allclose(get_confidence_intervals(SCORES, ci=.9, n_bootstraps=500, seed=0, block_size=1),
+                               expected, rtol=1e-12)
+
+
+def test_seed():
+    first = get_confidence_intervals(SCORES, seed=0)
+    np.testing.assert_array_equal(first, get_confidence_intervals(SCORES, seed=0))
+    assert not np.array_equal(first, get_confidence_intervals(SCORES, seed=1))
+
+
+def test_jobs():
+    rng = np.random.default_rng(2)
+    y = np.repeat([1, 2], 30)
+    x = rng.normal(size=(60, 6, 20))
+    x[y == 2, :2, 8:] += 1.5
+    params = {"epochs-tmin": -0.5, "epochs-tmax": 1.5, "sfreq": 10, "classification-tmin": 0.,
+              "classification-tmax": 1., "window-size": -1, "cv": 5, "seed": 0, "n-bootstraps": 500, "max-iter": 1000}
+
+    for clf in ("LinearSVC", "LDA"):
+        results = classify_temporal(x, y[None], dict(params, clf=clf), n_jobs=1)["data"]
+        for key, value in classify_temporal(x, y[None], dict(params, clf=clf), n_jobs=2)["data"].items():
+            np.testing.assert_array_equal(value, results[key], err_msg=key)
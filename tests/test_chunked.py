@@ -0,0 +1,73 @@
+"""
+A chunked dataset must read back as its dense data through any selection: views of views, relative trial indices,
+single trials, integer time indices and the last, partial, block of trials.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from src.processing.dataset import generate_dataset
+from src.utils.chunked import CHUNK_DIR, ChunkedArray
+
+AREA = "fusiform-rh"
+
+
+@pytest.fixture
+def chunked(tmp_path, epoch_dir, get_expected) -> tuple:
+    """
+    Chunked dataset of 33 trials in blocks of 7 trials and 6 time samples
+    :return:
+        array over the dataset, dense data
+    """
+
+    epoch_dir, truth = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA, dtype="float32",
+                     chunks={"trial-block": 7, "time-block": 6})
+
+    x = ChunkedArray(tmp_path / "dataset", n_jobs=2)
+    return x, get_expected(truth, sorted(truth), AREA)[0]
+
+
+def test_files(chunked):
+    x, dense = chunked
+    assert sorted(os.listdir(x.data_dir)) == [CHUNK_DIR, "x_shape.json", "y.npy"]
+
+    # 33 trials: 4 full blocks of 7 and one of 5
+    assert x.shape == dense.shape == (33, 4, 20)
+    assert len(os.listdir(x.data_dir / CHUNK_DIR)) == 5 * 4
+    np.testing.assert_array_equal(x.read(), dense)
+    np.testing.assert_array_equal(x[30:], dense[30:])
+
+
+def test_sub_view(chunked):
+    x, dense = chunked
+    view = x[10:20]
+    assert isinstance(view, ChunkedArray) and len(view) == 10
+
+    # Trials relative to the view
+    np.testing.assert_array_equal(view.read(trials=[0, 3]), dense[[10, 13]])
+    np.testing.assert_array_equal(view.read(trials=[9], times=slice(4, 9)), dense[[19], :, 4: 9])
+    np.testing.assert_array_equal(view[2: 5].read(trials=[1]), dense[[13]])
+
+    included = np.zeros(33, dtype=bool)
+    included[::4] = True
+    np.testing.assert_array_equal(x[included].read(trials=[1, 2]), dense[included][[1, 2]])
+
+
+def test_single_trial(chunked):
+    x, dense = chunked
+    np.testing.assert_array_equal(x[12], dense[12])
+    np.testing.assert_array_equal(x[-1], dense[-1])
+    np.testing.assert_array_equal(x[10:20][0], dense[10])
+    np.testing.assert_array_equal(x[12, :, 3: 8], dense[12, :, 3: 8])
+
+
+def test_time_index(chunked):
+    x, dense = chunked
+    np.testing.assert_array_equal(x[:, :, 5], dense[:, :, 5])
+    np.testing.assert_array_equal(x[..., -1], dense[..., -1])
+    np.testing.assert_array_equal(x[10:20][:, 1, 7], dense[10:20, 1, 7])
+    assert x[3, 1, 4] == dense[3, 1, 4]
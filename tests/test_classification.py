@@ -0,0 +1,77 @@
+"""
+Classifying the lazy `Dataset` view of a dataset (any layout, cropped or not) must give the results of the dense array
+in the epochs layout, on the same folds. The diagonal of the temporal generalization is the temporal decoding.
+"""
+
+import numpy as np
+import pytest
+
+from src.mvpa.classification import classify_generalization, classify_temporal, get_time_range
+from src.mvpa.folds import FoldPlan
+from src.processing.dataset import generate_dataset
+from src.utils.file_access import Dataset, read_metadata
+
+AREA = "fusiform-rh"
+
+PARAMS = {"epochs-tmin": -0.5, "epochs-tmax": 1.5, "sfreq": 10, "classification-tmin": 0., "classification-tmax": 1.,
+          "window-size": 200, "cv": 5, "seed": 0, "n-bootstraps": 200, "max-iter": 1000, "clf": "LinearSVC"}
+
+
+@pytest.fixture
+def dataset(tmp_path, epoch_dir) -> tuple:
+    """
+    Datasets of an area in both layouts, and cropped to the classification period
+    :return:
+        {name: path to the dataset}, labels of the dataset
+    """
+
+    epoch_dir, _ = epoch_dir
+    dst_dirs = {"epochs": {}, "times": {"layout": "times"}, "cropped": {"time_range": get_time_range(PARAMS)}}
+    for name, kwargs in dst_dirs.items():
+        (tmp_path / "datasets" / name).mkdir(parents=True)
+        generate_dataset(epoch_dir, tmp_path / "datasets" / name, AREA, **kwargs)
+
+    dst_dirs = {name: tmp_path / "datasets" / name for name in dst_dirs}
+    return dst_dirs, np.load(str(dst_dirs["epochs"] / "y.npy"))[None]
+
+
+def _assert_results_equal(results, expected):
+    assert results["data"].keys() == expected["data"].keys()
+    for key, value in expected["data"].items():
+        np.testing.assert_allclose(results["data"][key], value, rtol=1e-10, atol=1e-12, err_msg=key)
+
+
+@pytest.mark.parametrize("clf", ["LinearSVC", "LDA", "Ridge"])
+@pytest.mark.parametrize("name", ["epochs", "times", "cropped"])
+def test_view(dataset, clf, name):
+    dst_dirs, y = dataset
+    params = dict(PARAMS, clf=clf)
+    trials = np.random.default_rng(1).random(y.shape[1]) > .2
+    folds = FoldPlan.from_labels(y[0, trials], params["cv"], seed=params["seed"])
+
+    # Dense data of all the time points, epochs layout
+    x = Dataset(dst_dirs["epochs"]).read()
+    meta = dict(read_metadata(dst_dirs["epochs"]), layout="epochs")
+    expected = classify_temporal(x[trials], y[:, trials], params, meta=meta, folds=folds)
+
+    view = Dataset(dst_dirs[name]).select(trials=trials)
+    _assert_results_equal(classify_temporal(view, y[:, trials], params, n_jobs=2, folds=folds), expected)
+
+
+@pytest.mark.parametrize("clf", ["LinearSVC", "LDA", "Ridge"])
+def test_generalization(dataset, clf):
+    dst_dirs, y = dataset
+    params = dict(PARAMS, clf=clf)
+    view = Dataset(dst_dirs["times"])
+
+    expected = classify_temporal(view, y, params)
+    results = classify_generalization(view, y, params, n_jobs=2)
+
+    n_times = expected["data"]["scores"].shape[1]
+    assert results["data"]["scores"].shape == (params["cv"], n_times, n_times)
+    for key, value in expected["data"].items():
+        np.testing.assert_allclose(np.diagonal(results["data"][key], axis1=-2, axis2=-1), value, atol=1e-12,
+                                   err_msg=key)
+
+    np.testing.assert_array_equal(classify_generalization(view, y, params, n_jobs=1)["data"]["scores"],
+                                  results["data"]["scores"])
@@ -0,0 +1,175 @@
+"""
+Every layout, data type, crop and chunking of a dataset must read back as the source stores it was built from (n_epochs
+x n_vertices x n_times through the `Dataset` view), with the labels of the events in the same order.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from src.processing.dataset import generate_all_datasets, generate_dataset
+from src.utils.file_access import Dataset, load_json, read_metadata, write_json
+
+AREA = "fusiform-rh"
+
+# Time range of the crops and the samples it keeps, with stores from -0.5 s at 10 Hz
+TIME_RANGE, T_START, T_STOP = (0., 1.), 5, 15
+
+CHUNKS = {"trial-block": 7, "time-block": 6}
+
+
+def _check_dataset(dst_dir, truth, get_expected, area=AREA, dtype="float64", time_range=None):
+    """
+    Compare a dataset to the data of its subjects
+    """
+
+    meta = read_metadata(dst_dir)
+    t_range = {"t_start": T_START, "t_stop": T_STOP} if time_range else {}
+    x, y = get_expected(truth, list(meta["subjects"]), area, **t_range)
+
+    data = Dataset(dst_dir).read()
+    assert data.shape == x.shape
+
+    # int16 datasets are quantized over the range of each vertex
+    atol = np.ptp(x) / 2 ** 15 if dtype == "int16" else 0
+    np.testing.assert_allclose(data, x, rtol=0, atol=atol)
+    np.testing.assert_array_equal(np.load(str(dst_dir / "y.npy")), y)
+
+    if time_range:
+        assert np.isclose(meta["tmin"], time_range[0])
+
+
+@pytest.mark.parametrize("layout", ["epochs", "times"])
+@pytest.mark.parametrize("dtype", ["float64", "float32", "int16"])
+@pytest.mark.parametrize("time_range", [None, TIME_RANGE])
+def test_round_trip(tmp_path, epoch_dir, get_expected, layout, dtype, time_range):
+    epoch_dir, truth = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA, layout=layout, dtype=dtype, time_range=time_range)
+    _check_dataset(tmp_path / "dataset", truth, get_expected, dtype=dtype, time_range=time_range)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int16"])
+@pytest.mark.parametrize("codec", [None, "lzma"])
+def test_chunked(tmp_path, epoch_dir, get_expected, dtype, codec):
+    epoch_dir, truth = epoch_dir
+    chunks = dict(CHUNKS, codec=codec) if codec else CHUNKS
+    (tmp_path / "dataset").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA, dtype=dtype, chunks=chunks, time_range=TIME_RANGE)
+
+    assert read_metadata(tmp_path / "dataset")["container"] == "chunked"
+    _check_dataset(tmp_path / "dataset", truth, get_expected, dtype=dtype, time_range=TIME_RANGE)
+
+
+def test_chunked_times_layout(tmp_path, epoch_dir):
+    epoch_dir, _ = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    with pytest.raises(ValueError):
+        generate_dataset(epoch_dir, tmp_path / "dataset", AREA, layout="times", chunks=CHUNKS)
+    assert not os.listdir(tmp_path / "dataset")
+
+    with pytest.raises(ValueError):
+        generate_all_datasets(epoch_dir, tmp_path / "all", layout="times", chunks=CHUNKS)
+    assert not (tmp_path / "all").exists() or not os.listdir(tmp_path / "all")
+
+
+@pytest.mark.parametrize("option", [{"layout": "times"}, {"chunks": CHUNKS}, {"time_range": TIME_RANGE},
+                                    {"dtype": "float32"}, {"append": True}])
+def test_npy_options(tmp_path, epoch_dir, option):
+    epoch_dir, _ = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    with pytest.raises(ValueError):
+        generate_dataset(epoch_dir, tmp_path / "dataset", AREA, memmap=False, **option)
+    assert not os.listdir(tmp_path / "dataset")
+
+
+@pytest.mark.parametrize("layout", ["epochs", "times"])
+def test_all_datasets(tmp_path, epoch_dir, labels, get_expected, layout):
+    epoch_dir, truth = epoch_dir
+    generate_all_datasets(epoch_dir, tmp_path / "all", n_areas=2, n_jobs=2, layout=layout, dtype="float32")
+
+    for area in labels:
+        _check_dataset(tmp_path / "all" / area, truth, get_expected, area=area, dtype="float32")
+
+
+def test_view(tmp_path, epoch_dir, get_expected):
+    epoch_dir, truth = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA, layout="times")
+    x, _ = get_expected(truth, list(read_metadata(tmp_path / "dataset")["subjects"]), AREA)
+
+    trials = np.random.default_rng(1).random(len(x)) > .4
+    view = Dataset(tmp_path / "dataset").select(trials=trials).select(times=(3, 13))
+    assert len(view) == trials.sum()
+    np.testing.assert_array_equal(view.read(), x[trials, :, 3: 13])
+    np.testing.assert_array_equal(view.read(times=(2, 4)), x[trials, :, 5: 7])
+
+    # The view never writes to the dataset
+    assert not view.x.flags.writeable
+    with pytest.raises(ValueError):
+        view.x[0] = 0
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_append(tmp_path, epoch_dir, make_subject, get_expected, dtype):
+    epoch_dir, truth = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA, dtype=dtype)
+
+    truth["sub-V1003"] = make_subject(epoch_dir, "sub-V1003", 13, np.random.default_rng(1))
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA, dtype=dtype, append=True)
+    _check_dataset(tmp_path / "dataset", truth, get_expected, dtype=dtype)
+
+    # Same dataset as a build from scratch, up to the order of the subjects
+    (tmp_path / "full").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "full", AREA, dtype=dtype)
+    assert load_json(tmp_path / "dataset" / "x_shape.json")["hashes"] == load_json(tmp_path / "full" /
+                                                                                    "x_shape.json")["hashes"]
+
+
+def test_append_duplicate(tmp_path, epoch_dir):
+    epoch_dir, _ = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA)
+    size, meta = os.path.getsize(tmp_path / "dataset" / "x.dat"), load_json(tmp_path / "dataset" / "x_shape.json")
+
+    # Same data under another name: refused before the dataset is touched
+    shutil.copytree(epoch_dir / "sub-V1000", epoch_dir / "sub-V1050")
+    with pytest.raises(ValueError):
+        generate_dataset(epoch_dir, tmp_path / "dataset", AREA, append=True)
+
+    assert os.path.getsize(tmp_path / "dataset" / "x.dat") == size
+    assert load_json(tmp_path / "dataset" / "x_shape.json") == meta
+
+
+@pytest.mark.parametrize("option", [{"dtype": "float64"}, {"time_range": None}, {"time_range": (0., 1.5)},
+                                    {"layout": "times"}, {"chunks": CHUNKS}])
+def test_append_options(tmp_path, epoch_dir, make_subject, option):
+    epoch_dir, _ = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    options = {"dtype": "float32", "time_range": TIME_RANGE}
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA, **options)
+    size, meta = os.path.getsize(tmp_path / "dataset" / "x.dat"), load_json(tmp_path / "dataset" / "x_shape.json")
+
+    # Other options than the ones of the dataset
+    make_subject(epoch_dir, "sub-V1003", 13, np.random.default_rng(1))
+    with pytest.raises(ValueError, match="generated with other options"):
+        generate_dataset(epoch_dir, tmp_path / "dataset", AREA, append=True, **dict(options, **option))
+
+    assert os.path.getsize(tmp_path / "dataset" / "x.dat") == size
+    assert load_json(tmp_path / "dataset" / "x_shape.json") == meta
+
+
+def test_append_legacy(tmp_path, epoch_dir):
+    epoch_dir, _ = epoch_dir
+    (tmp_path / "dataset").mkdir()
+    generate_dataset(epoch_dir, tmp_path / "dataset", AREA)
+
+    # Datasets generated before the subjects were recorded
+    meta = load_json(tmp_path / "dataset" / "x_shape.json")
+    del meta["subjects"]
+    write_json(tmp_path / "dataset", file_name="x_shape.json", data=meta)
+    with pytest.raises(ValueError, match="Generate the dataset again"):
+        generate_dataset(epoch_dir, tmp_path / "dataset", AREA, append=True)
@@ -0,0 +1,55 @@
+"""
+A fold plan must give the splits of `StratifiedKFold` with the same seed, and be reused from disk only for the same
+labels. The dummy classifiers must be seeded per time point.
+"""
+
+import numpy as np
+
+from sklearn.model_selection import StratifiedKFold
+
+from src.mvpa.batched import classify_batched
+from src.mvpa.folds import FoldPlan, get_fold_plan
+
+Y = np.random.default_rng(0).integers(1, 3, 53)
+
+
+def test_from_labels():
+    plan = FoldPlan.from_labels(Y, 5, seed=3)
+    assert len(plan) == 5
+
+    kf = StratifiedKFold(5, shuffle=True, random_state=3)
+    for (train_idx, test_idx), (expected_train, expected_test) in zip(plan.split(), kf.split(np.zeros((len(Y), 1)), Y)):
+        np.testing.assert_array_equal(train_idx, expected_train)
+        np.testing.assert_array_equal(test_idx, expected_test)
+
+
+def test_get_fold_plan(tmp_path):
+    plan = get_fold_plan(tmp_path / "folds", Y, cv=5, seed=0)
+    assert len(list((tmp_path / "folds").glob("folds-5-0-*.npz"))) == 1
+
+    # Loaded from disk
+    loaded = get_fold_plan(tmp_path / "folds", Y, cv=5, seed=0)
+    np.testing.assert_array_equal(loaded.fold, plan.fold)
+    assert loaded.seed == 0
+
+    # Other labels: a new plan saved next to the first one
+    y = Y[::-1].copy()
+    other = get_fold_plan(tmp_path / "folds", y, cv=5, seed=0)
+    np.testing.assert_array_equal(other.fold, FoldPlan.from_labels(y, 5, seed=0).fold)
+    assert len(list((tmp_path / "folds").glob("folds-5-0-*.npz"))) == 2
+    np.testing.assert_array_equal(get_fold_plan(tmp_path / "folds", Y, cv=5, seed=0).fold, plan.fold)
+
+
+def test_dummy_seeds():
+    plan = FoldPlan.from_labels(Y, 5, seed=0)
+    assert [plan.get_seed(t_idx) for t_idx in range(3)] == [0, 1, 2]
+    assert FoldPlan.from_labels(Y, 5).get_seed(2) is None
+
+    # A chance level that varies over the time points, the same for every batching of the times
+    x = np.random.default_rng(1).standard_normal((6, len(Y), 4))
+    _, dummy_scores = classify_batched(x, Y, plan, "LDA")
+    assert dummy_scores.shape == (5, 6)
+    assert len(np.unique(dummy_scores, axis=1).T) > 1
+
+    _, batch_scores = classify_batched(x[3:], Y, plan, "LDA", seeds=[plan.get_seed(t_idx) for t_idx in range(3, 6)])
+    np.testing.assert_array_equal(batch_scores, dummy_scores[:, 3:])
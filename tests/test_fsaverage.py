@@ -0,0 +1,43 @@
+"""
+The fsaverage resources must map every source estimate row (left hemisphere first) to the label it belongs to, as
+`stc.in_label`, keep the names of the relevant labels and be memory-mapped from disk once built.
+"""
+
+import numpy as np
+import pytest
+
+from src.utils import fsaverage as fsaverage_module
+from src.utils.fsaverage import get_fsaverage_resources
+
+
+def test_resources(fsaverage):
+    subjects_dir, vertices, parcellations = fsaverage
+    resources = get_fsaverage_resources(subjects_dir, "parc_a")
+
+    # `unknown` labels are left out of the name table
+    assert resources.names == ["a1-lh", "a2-lh", "a1-rh"]
+    for hemi_vertices, expected in zip(resources.vertices, vertices):
+        np.testing.assert_array_equal(hemi_vertices, expected)
+
+    # Rows of the right hemisphere come after the 10 rows of the left one
+    expected_rows = {"a1-lh": [0, 1, 2, 3], "a2-lh": [4, 5, 6], "a1-rh": [10, 11, 12]}
+    assert resources.label_index.dtype == np.int16
+    np.testing.assert_array_equal(resources.label_index, [0, 0, 0, 0, 1, 1, 1, -1, -1, -1, 2, 2, 2, -1, -1, -1, -1, -1])
+    for name, rows in resources.get_label_rows().items():
+        np.testing.assert_array_equal(rows, expected_rows[name])
+        np.testing.assert_array_equal(resources.get_rows(name), expected_rows[name])
+
+
+def test_resources_reused(fsaverage, monkeypatch):
+    subjects_dir, _, _ = fsaverage
+    resources = get_fsaverage_resources(subjects_dir, "parc_a")
+    assert get_fsaverage_resources(subjects_dir, "parc_a") is resources
+
+    # Another process memory-maps the saved resources without reading fsaverage again
+    get_fsaverage_resources.cache_clear()
+    monkeypatch.setattr(fsaverage_module, "read_source_spaces", pytest.fail)
+    loaded = get_fsaverage_resources(subjects_dir, "parc_a")
+    assert isinstance(loaded.label_index, np.memmap)
+    assert loaded.names == resources.names
+    np.testing.assert_array_equal(loaded.label_index, resources.label_index)
+    np.testing.assert_array_equal(loaded.normals, resources.normals)
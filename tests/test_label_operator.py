@@ -0,0 +1,108 @@
+"""
+The label operator must give the label rows of `apply_inverse_epochs` followed by the morph, for fixed and free
+orientations. A small EEG sphere model with a volume source space stands in for a subject, a random sparse matrix for
+the morph to fsaverage. The label summaries must give the time courses of `mne.extract_label_time_course` on a small
+surface source space.
+"""
+
+import numpy as np
+import pytest
+
+import mne
+
+from scipy.sparse import random as sparse_random
+
+from src.processing.label_operator import LabelOperator, LabelSummary
+from src.processing.source_localization import FsaverageMorph
+
+N_TARGETS = 30
+LABEL_ROWS = {"a": np.arange(0, 10), "b": np.arange(10, N_TARGETS)}
+
+
+def _get_inv(sphere_subject, fixed: bool):
+    epochs, fwd, cov = sphere_subject
+    if fixed:
+        fwd = mne.convert_forward_solution(fwd, force_fixed=True)
+        return mne.minimum_norm.make_inverse_operator(epochs.info, fwd, cov, fixed=True, depth=None)
+    return mne.minimum_norm.make_inverse_operator(epochs.info, fwd, cov, loose=1.)
+
+
+def _get_morph(inv) -> FsaverageMorph:
+    morph_mat = sparse_random(N_TARGETS, inv["nsource"], density=0.05, random_state=1, format="csr")
+    return FsaverageMorph(morph_mat, [inv["src"][0]["vertno"], np.array([], dtype=int)],
+                          [np.arange(N_TARGETS), np.array([], dtype=int)])
+
+
+@pytest.mark.parametrize("fixed", [True, False])
+@pytest.mark.parametrize("method", ["MNE", "dSPM", "sLORETA"])
+def test_apply_epochs(sphere_subject, fixed, method):
+    epochs = sphere_subject[0]
+    inv = _get_inv(sphere_subject, fixed)
+    morph = _get_morph(inv)
+
+    operator = LabelOperator(inv, morph, LABEL_ROWS, method=method)
+    data = np.concatenate([batch for _, _, batch in operator.apply_epochs(epochs, batch_size=5)])
+
+    stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, 1. / 9., method=method)
+    expected = np.stack([morph.morph_mat @ stc.data for stc in stcs])
+    np.testing.assert_allclose(data, expected, rtol=1e-10, atol=1e-12 * np.abs(expected).max())
+
+    labels = operator.split(data)
+    np.testing.assert_array_equal(labels["b"], data[:, 10:])
+
+
+def test_float32(sphere_subject):
+    epochs = sphere_subject[0]
+    inv = _get_inv(sphere_subject, fixed=False)
+    morph = _get_morph(inv)
+
+    data64 = np.concatenate([batch for _, _, batch in LabelOperator(inv, morph, LABEL_ROWS).apply_epochs(epochs)])
+    data32 = np.concatenate([batch for _, _, batch in LabelOperator(inv, morph, LABEL_ROWS,
+                                                                     dtype="float32").apply_epochs(epochs)])
+    assert data32.dtype == np.float32
+    np.testing.assert_allclose(data32, data64, rtol=0, atol=1e-5 * np.abs(data64).max())
+
+
+def _make_surface_src(rng: np.random.Generator) -> mne.SourceSpaces:
+    """
+    Surface source space of random points, every other vertex in use, normals spread around the vertical
+    """
+
+    hemis = []
+    coord_frame = mne.io.constants.FIFF.FIFFV_COORD_MRI
+    for n_points, hemi_id in ((40, 101), (30, 102)):
+        normals = rng.normal(size=(n_points, 3)) + [0., 0., 1.]
+        vertno = np.arange(0, n_points, 2)
+        inuse = np.zeros(n_points, dtype=int)
+        inuse[vertno] = 1
+        hemis.append(dict(type="surf", id=hemi_id, np=n_points, ntri=0, coord_frame=coord_frame,
+                          rr=rng.normal(size=(n_points, 3)) * .05,
+                          nn=normals / np.linalg.norm(normals, axis=1, keepdims=True), inuse=inuse, nuse=len(vertno),
+                          vertno=vertno, subject_his_id="sample", tris=None, use_tris=None, nuse_tri=0, dist=None,
+                          dist_limit=None, nearest=None, nearest_dist=None, patch_inds=None, pinfo=None))
+    return mne.SourceSpaces(hemis)
+
+
+@pytest.mark.parametrize("mode", ["mean", "mean_flip", "pca_flip"])
+def test_label_summary(mode):
+    rng = np.random.default_rng(2)
+    src = _make_surface_src(rng)
+    labels = [mne.Label(np.arange(0, 20), hemi="lh", name="a-lh", subject="sample"),
+              mne.Label(np.arange(5, 30), hemi="rh", name="b-rh", subject="sample")]
+
+    vertices = [s["vertno"] for s in src]
+    stcs = [mne.SourceEstimate(rng.normal(size=(sum(map(len, vertices)), 8)), vertices, 0., .1, subject="sample")
+            for _ in range(3)]
+    expected = np.stack(mne.extract_label_time_course(stcs, labels, src, mode=mode))
+
+    # Rows of the labels laid out one after the other, as in the output of the label operator
+    offsets = [0, len(vertices[0])]
+    rows = [offsets[idx] + np.flatnonzero(np.isin(vertices[idx], label.vertices))
+            for idx, label in enumerate(labels)]
+    bounds = np.cumsum([0] + [len(r) for r in rows])
+    normals = np.concatenate([src[idx]["nn"][vertices[idx][r - offsets[idx]]] for idx, r in enumerate(rows)])
+
+    summary = LabelSummary([label.name for label in labels], [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])],
+                           mode=mode, normals=None if mode == "mean" else normals)
+    data = np.stack([stc.data[np.concatenate(rows)] for stc in stcs])
+    np.testing.assert_allclose(summary.apply(data), expected, rtol=1e-10, atol=1e-12)
@@ -0,0 +1,110 @@
+"""
+The manifest must give back what the jobs recorded (the last record of a file wins), stay line-intact under concurrent
+writers, be rebuilt from an existing directory, and index the epochs directory like a scan of the subject directories.
+Subjects whose records are incomplete are read from their directory.
+"""
+
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from src.processing.dataset import _index_epoch_dir
+from src.utils.manifest import (MANIFEST_FNAME, _get_store_hash, add_record, build_manifest, read_manifest,
+                                record_events, record_store)
+
+
+def _add_records(epoch_dir, worker: int, n_records: int):
+    """
+    Append records from another process
+    """
+
+    for idx in range(n_records):
+        add_record(epoch_dir, {"subject": f"sub-V{worker:04d}", "kind": "events", "path": "x" * 1000, "idx": idx})
+
+
+def test_round_trip(epoch_dir):
+    epoch_dir, truth = epoch_dir
+    record_events(epoch_dir, "sub-V1000", epoch_dir / "sub-V1000" / "events.npy")
+    record_store(epoch_dir, "sub-V1000", epoch_dir / "sub-V1000" / "stc")
+
+    records = read_manifest(epoch_dir)["sub-V1000"]
+    assert records["events"]["path"] == os.path.join("sub-V1000", "events.npy")
+    assert records["events"]["shape"] == [len(truth["sub-V1000"][1]), 3]
+    store = records["stores"]["store"]
+    assert store["path"] == os.path.join("sub-V1000", "stc", "store.dat")
+    assert store["shape"] == list(truth["sub-V1000"][0].shape)
+    assert list(store["labels"]) == ["bankssts-lh", "bankssts_1-lh", "fusiform-rh"]
+
+    # A later record of the same file replaces the earlier one
+    add_record(epoch_dir, dict(store, shape=[1, 9, 20]))
+    assert read_manifest(epoch_dir)["sub-V1000"]["stores"]["store"]["shape"] == [1, 9, 20]
+
+
+def test_concurrent_writers(tmp_path):
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_add_records, args=(tmp_path, worker, 50)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    with open(tmp_path / MANIFEST_FNAME) as file:
+        records = [json.loads(line) for line in file]
+    assert len(records) == 200
+    for worker in range(4):
+        assert [r["idx"] for r in records if r["subject"] == f"sub-V{worker:04d}"] == list(range(50))
+
+
+def test_build_manifest(epoch_dir):
+    epoch_dir, truth = epoch_dir
+    for subject in truth:
+        record_events(epoch_dir, subject, epoch_dir / subject / "events.npy")
+        record_store(epoch_dir, subject, epoch_dir / subject / "stc")
+    recorded = read_manifest(epoch_dir)
+
+    build_manifest(epoch_dir)
+    built = read_manifest(epoch_dir)
+    assert list(built) == sorted(truth)
+    for subject, records in built.items():
+        for record, expected in ((records["events"], recorded[subject]["events"]),
+                                 (records["stores"]["store"], recorded[subject]["stores"]["store"])):
+            record.pop("time"), expected.pop("time")
+            assert record == expected
+
+
+def test_store_hash(epoch_dir):
+    epoch_dir, _ = epoch_dir
+    stc_dir = epoch_dir / "sub-V1000" / "stc"
+    digest = _get_store_hash(stc_dir, "store")
+    assert _get_store_hash(stc_dir, "store") == digest
+
+    # Rewritten data, same size
+    stat = os.stat(stc_dir / "store.dat")
+    os.utime(stc_dir / "store.dat", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert _get_store_hash(stc_dir, "store") != digest
+
+
+def test_index(epoch_dir, make_subject):
+    epoch_dir, truth = epoch_dir
+    scanned = _index_epoch_dir(epoch_dir, reject_list=["sub-V1001"])
+    assert list(scanned) == ["sub-V1000", "sub-V1002"]
+
+    build_manifest(epoch_dir)
+    assert _index_epoch_dir(epoch_dir, reject_list=["sub-V1001"]) == scanned
+
+    # Recorded without its store: read from its directory. Not recorded at all: not listed
+    make_subject(epoch_dir, "sub-V1003", 5, np.random.default_rng(1))
+    record_events(epoch_dir, "sub-V1003", epoch_dir / "sub-V1003" / "events.npy")
+    make_subject(epoch_dir, "sub-V1004", 5, np.random.default_rng(2))
+
+    indexed = _index_epoch_dir(epoch_dir, reject_list=[])
+    assert list(indexed) == ["sub-V1000", "sub-V1001", "sub-V1002", "sub-V1003"]
+    assert indexed["sub-V1003"] == {"events": epoch_dir / "sub-V1003" / "events.npy",
+                                    "areas": {name: epoch_dir / "sub-V1003" / "stc" / "store.dat"
+                                              for name in indexed["sub-V1000"]["areas"]}}
+
+    # Without the manifest, every subject directory
+    os.remove(epoch_dir / MANIFEST_FNAME)
+    assert list(_index_epoch_dir(epoch_dir, reject_list=[])) == [f"sub-V100{i}" for i in range(5)]
@@ -0,0 +1,166 @@
+"""
+The inverse operator and the morph are cached on disk and reused only for the same inputs, and the label rows and the
+parallel processing of the epochs give the same source stores as a single process.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+
+import mne
+import pytest
+
+from scipy.sparse import random as sparse_random
+
+from src.processing import source_localization
+from src.processing.source_localization import (FsaverageMorph, _get_label_rows, _process_all_labels, get_inv,
+                                                get_morph)
+from src.utils.source_store import read_store
+
+
+def _count_calls(monkeypatch, name: str) -> list:
+    """
+    Record the calls to a function of the source localization module
+    :return:
+        list to which each call appends its keyword arguments
+    """
+
+    calls, func = [], getattr(source_localization, name)
+
+    def wrapper(*args, **kwargs):
+        calls.append(kwargs)
+        return func(*args, **kwargs)
+
+    monkeypatch.setattr(source_localization, name, wrapper)
+    return calls
+
+
+def test_inverse_cache(tmp_path, monkeypatch, sphere_subject):
+    epochs, fwd, _ = sphere_subject
+    fwd_path = str(tmp_path / "sub-V1000-fwd.fif")
+    mne.write_forward_solution(fwd_path, fwd)
+    cov_calls = _count_calls(monkeypatch, "compute_covariance")
+    inv_calls = _count_calls(monkeypatch, "make_inverse_operator")
+
+    def get(**kwargs):
+        return get_inv(epochs, fwd_path, cache_dir=tmp_path / "cache", subject="sub-V1000", **kwargs)
+
+    inv = get(loose=1.)
+    assert (len(cov_calls), len(inv_calls)) == (1, 1)
+
+    # Hit: nothing computed again, same operator
+    cached = get(loose=1.)
+    assert (len(cov_calls), len(inv_calls)) == (1, 1)
+    assert cached["nsource"] == inv["nsource"]
+    np.testing.assert_allclose(cached["eigen_fields"]["data"], inv["eigen_fields"]["data"])
+
+    # Miss on the inverse operator only, the noise covariance is reused
+    get(loose=1., depth=None)
+    assert (len(cov_calls), len(inv_calls)) == (1, 2)
+    get(loose=.9, depth=None)
+    assert (len(cov_calls), len(inv_calls)) == (1, 3)
+
+    # Miss on both when the measurement info changes
+    epochs = epochs.copy()
+    epochs.info["bads"] = [epochs.ch_names[0]]
+    get(loose=1.)
+    assert (len(cov_calls), len(inv_calls)) == (2, 4)
+    assert len(list((tmp_path / "cache").glob("*-inv.fif"))) == 4
+
+
+def _make_morph(vertices_from: list, n_targets=30, seed=1) -> FsaverageMorph:
+    """
+    Random sparse morph from a source space to `n_targets` vertices of the left hemisphere
+    """
+
+    morph_mat = sparse_random(n_targets, sum(map(len, vertices_from)), density=.1, random_state=seed, format="csr")
+    return FsaverageMorph(morph_mat, vertices_from, [np.arange(n_targets), np.array([], dtype=int)])
+
+
+def _check_morph(morph: FsaverageMorph, expected: FsaverageMorph):
+    """
+    Compare the morph matrices and the vertices of two morphs
+    """
+
+    assert morph.morph_mat.shape == expected.morph_mat.shape
+    assert (morph.morph_mat != expected.morph_mat).nnz == 0
+    for vertices, expected_vertices in zip(morph.vertices_from + morph.vertices_to,
+                                           expected.vertices_from + expected.vertices_to):
+        np.testing.assert_array_equal(vertices, expected_vertices)
+
+
+def test_morph_round_trip(tmp_path):
+    morph = _make_morph([np.arange(0, 20, 2), np.arange(5)])
+    morph.save(tmp_path / "morph")
+    _check_morph(FsaverageMorph.load(tmp_path / "morph"), morph)
+
+
+def test_morph_cache(tmp_path, monkeypatch):
+    src = [{"vertno": np.arange(0, 20, 2)}, {"vertno": np.arange(5)}]
+    calls = []
+
+    # Stand-in for the morph computation, fsaverage is not available
+    def compute_source_morph(src, **kwargs):
+        calls.append(kwargs)
+        morph = _make_morph([s["vertno"] for s in src], seed=len(calls))
+        return SimpleNamespace(morph_mat=morph.morph_mat, vertices_to=morph.vertices_to)
+
+    monkeypatch.setattr(source_localization, "read_source_spaces", lambda *args, **kwargs: None)
+    monkeypatch.setattr(source_localization, "compute_source_morph", compute_source_morph)
+
+    morph = get_morph(src, "sub-V1000", tmp_path, tmp_path / "morphs")
+    assert len(calls) == 1
+
+    # Hit: read back from disk
+    _check_morph(get_morph(src, "sub-V1000", tmp_path, tmp_path / "morphs"), morph)
+    assert len(calls) == 1
+
+    # Miss: the source space of the subject changed
+    src[1] = {"vertno": np.arange(6)}
+    changed = get_morph(src, "sub-V1000", tmp_path, tmp_path / "morphs")
+    assert len(calls) == 2
+    np.testing.assert_array_equal(changed.vertices_from[1], np.arange(6))
+    _check_morph(FsaverageMorph.load(tmp_path / "morphs" / "sub-V1000-fsaverage-ico-5-morph"), changed)
+
+
+def test_label_rows(fsaverage):
+    subjects_dir, vertices, _ = fsaverage
+    morph = FsaverageMorph(None, [], vertices)
+    params = {"subjects-dir": subjects_dir, "parcellation": ["parc_a", "parc_b"], "hemi": "both"}
+
+    # Labels of all the parcellations, one parcellation after the other
+    label_rows = _get_label_rows(params, morph)
+    expected = {"a1-lh": [0, 1, 2, 3], "a2-lh": [4, 5, 6], "a1-rh": [10, 11, 12], "b1-lh": [8, 9],
+                "b1-rh": [13, 14, 15, 16, 17]}
+    assert list(label_rows) == list(expected)
+    for name, rows in label_rows.items():
+        np.testing.assert_array_equal(rows, expected[name])
+
+    # One hemisphere, every other vertex
+    label_rows = _get_label_rows(dict(params, hemi="lh", decimate=2), morph)
+    assert list(label_rows) == ["a1-lh", "a2-lh", "b1-lh"]
+    np.testing.assert_array_equal(label_rows["a1-lh"], [0, 2])
+
+    with pytest.raises(ValueError):
+        _get_label_rows(dict(params, parcellation=["parc_a", "parc_a"]), morph)
+    with pytest.raises(ValueError):
+        _get_label_rows(params, FsaverageMorph(None, [], [vertices[0], vertices[1][1:]]))
+
+
+def test_parallel_labels(tmp_path, sphere_subject):
+    epochs, fwd, cov = sphere_subject
+    inv = mne.minimum_norm.make_inverse_operator(epochs.info, fwd, cov, loose=1.)
+    morph = _make_morph([inv["src"][0]["vertno"]])
+    label_rows = {"a-lh": np.arange(0, 10), "b-lh": np.arange(12, 30)}
+    params = {"method": "dSPM", "pick-ori": None, "batch-size": 5, "n-chunks": 3}
+
+    stores = []
+    for n_jobs in (1, 2):
+        (tmp_path / str(n_jobs)).mkdir()
+        _process_all_labels(tmp_path / str(n_jobs), epochs, label_rows, inv, params, morph, n_jobs=n_jobs)
+        stores.append(read_store(tmp_path / str(n_jobs) / "stc"))
+
+    (x_serial, index_serial), (x_parallel, index_parallel) = stores
+    assert index_parallel == index_serial
+    np.testing.assert_allclose(x_parallel, x_serial, rtol=1e-6, atol=1e-6 * np.abs(x_serial).max())
+    assert np.abs(x_serial).max() > 0